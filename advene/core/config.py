@@ -235,6 +235,11 @@ class Config(object):
             # Custom up/down: use third-time-increment for up/down, do
             # not require Shift
             'custom-updown-keys': False,
+            # Above this number of notifications, the views are not
+            # updated for each notification of a batch of
+            # modifications (see controller.begin_batch), but
+            # rebuilt by a single PackageActivate
+            'batch-notify-threshold': 50,
             'timeline': {
                 'font-size': 10,
                 'button-height': 20,
@@ -258,6 +263,10 @@ class Config(object):
             'record-actions': False,
             # Imagecache save on exit: 'never', 'ask' or 'always'
             'imagecache-save-on-exit': 'ask',
+            # Memory budget (in bytes) for the snapshots of each
+            # imagecache. Beyond it, the least recently used snapshots
+            # are moved to disk. 0 means no limit.
+            'imagecache-max-memory': 64 * 1024 * 1024,
             'quicksearch-ignore-case': True,
             # quicksearch sources. If [], it is all package's annotations.
             # Else it is a list of TALES expression applied to the current package
@@ -268,6 +277,12 @@ class Config(object):
             'package-auto-save': 'never',
             # auto-save interval in ms. Every 5 minutes by default.
             'package-auto-save-interval': 5 * 60 * 1000,
+            # Keep a cache of parsed packages in the settings
+            # directory, so that reopening or importing them is faster
+            'package-parse-cache': True,
+            # Maximum size of the cache of parsed packages, in MB. The
+            # least recently used packages are removed beyond it.
+            'package-parse-cache-size': 100,
             # slave player automatic synchronization delay. 0 to disable.
             'slave-player-sync-delay': 3000,
             # Interface language. '' means system default.
@@ -327,6 +342,8 @@ class Config(object):
             'snapshot': True,
             'caption': True,
             'snapshot-width': 160,
+            # Number of processes for batch snapshots (0: one per processor)
+            'snapshot-workers': 0,
             'dvd-device': '/dev/dvd',
             'fullscreen-timestamp': False,
             # Name of audio device for gstrecorder
@@ -343,6 +360,9 @@ class Config(object):
             'displaymode': 'raw',
             # engine: simple (for SimpleHTTPServer) or cherrypy (for CherryPy)
             'engine': 'simple',
+            # Number of rendered package elements kept in memory
+            # (0 to disable the response cache)
+            'cache-size': 200,
             }
 
         # Global context options
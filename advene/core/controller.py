@@ -41,7 +41,6 @@ import StringIO
 import gobject
 import shlex
 import itertools
-import operator
 
 import advene.core.config as config
 
@@ -50,6 +49,7 @@ from gettext import gettext as _
 import advene.core.plugin
 from advene.core.mediacontrol import PlayerFactory
 from advene.core.imagecache import ImageCache
+from advene.core.eventindex import AnnotationEventIndex
 import advene.core.idgenerator
 
 from advene.rules.elements import RuleSet, RegisteredAction, SimpleQuery, Quicksearch
@@ -63,6 +63,7 @@ from libadvene.model.cam.tag import AnnotationType, RelationType
 from libadvene.model.cam.list import Schema
 from libadvene.model.cam.resource import Resource
 from libadvene.model.consts import ADVENE_NS_PREFIX
+from libadvene.model.backends.exceptions import InternalError
 from libadvene.model.content.register import register_textual_mimetype
 import libadvene.util.session
 from libadvene.model.cam.view import View
@@ -102,6 +103,35 @@ class ImageCacheProxy(object):
             raise Exception("%s is not a valid media identifier") % key
         return self.controller.imagecache.get(m.url)
 
+    def get_snapshot(self, key, position, width=None):
+        """Return the snapshot of media key at position.
+
+        See ImageCache.get for the width parameter.
+        """
+        return self[key].get(position, width=width)
+
+class BatchSection(object):
+    """The context manager returned by AdveneController.batch.
+    """
+    def __init__(self, controller, package):
+        self.controller=controller
+        self.package=package
+
+    def __enter__(self):
+        self.controller.begin_batch(self.package)
+        return self.controller
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.controller.end_batch()
+        else:
+            try:
+                self.controller.end_batch()
+            except InternalError:
+                # The original exception is more informative
+                pass
+        return False
+
 class AdveneController(object):
     """AdveneController class.
 
@@ -127,10 +157,8 @@ class AdveneController(object):
 
     @ivar active_annotations: the currently active annotations.
     @type active_annotations: list
-    @ivar future_begins: the annotations that should be activated next (sorted)
-    @type future_begins: list
-    @ivar future_ends: the annotations that should be desactivated next (sorted)
-    @type future_ends: list
+    @ivar annotation_events: the begin/end event indexes, by media uriref
+    @type annotation_events: dict of AnnotationEventIndex
 
     @ivar last_position: a cache to check whether an update is necessary
     @type last_position: int
@@ -179,8 +207,10 @@ class AdveneController(object):
 
         # List of active annotations
         self.active_annotations = []
-        self.future_begins = None
-        self.future_ends = None
+        # Begin/end event indexes, indexed by media uriref
+        self.annotation_events = {}
+        self._current_events = None
+        self._seek_events = True
         self.last_position = -1
 
         # List of (time, action) tuples, sorted along time
@@ -232,6 +262,12 @@ class AdveneController(object):
         self.modifying_events = self.event_handler.catalog.modifying_events
         self.event_queue = []
         self.tracers=[]
+        # Packages of the open batch sections (see begin_batch), and
+        # notifications postponed until the outermost one is closed
+        self.batch_packages = []
+        self.batch_events = None
+        self.batched_packages = []
+        self.cancelled_packages = []
 
         # Load default actions
         advene.rules.actions.register(self)
@@ -510,15 +546,19 @@ class AdveneController(object):
                     # There is a least one other annotation of the
                     # same type which is also active. We can just wait for its end.
                     return True
-                # future_begins holds a sorted list of (annotation, begin, end)
+                # Look for the next (annotation, begin, end) triplet
                 if self.restricted_annotations:
                     l=[(an, an.begin, an.end)
                        for an in self.restricted_annotations
                        if an.begin > a.end ]
                 else:
-                    l=[an
-                       for an in self.future_begins
-                       if an[0].type == t ]
+                    l=[]
+                    events=self.get_annotation_events()
+                    if events is not None:
+                        for an in events.iter_future_begins():
+                            if an[0].type == t:
+                                l.append(an)
+                                break
                 if l and l[0][1] > a.end:
                     self.queue_action(self.update_status, 'set', l[0][1])
                 else:
@@ -609,6 +649,9 @@ class AdveneController(object):
         result=[]
 
         for source in sources:
+            if source == 'package/all/annotations':
+                # Default source of quicksearch components
+                source='all_annotations'
             if source == 'ids':
                 # Special search.
                 res=[]
@@ -617,10 +660,20 @@ class AdveneController(object):
                     if e is not None:
                         result.append(e)
                 continue
+            elif source == 'all_annotations':
+                # Fetch the content data along with the annotations,
+                # since all of them will be tested. They are
+                # pre-selected through the full-text index of the
+                # backend, when available. Case-insensitive exceptions
+                # can be excluded by the index as well.
+                sourcedata=list(p.all.iter_annotations(with_content=True,
+                    data_matches=(mandatory, normal,
+                                  () if case_sensitive else exceptions)))
             else:
-                if source == 'all_annotations':
-                    source = 'here/all/annotations'
-                elif source == 'tags':
+                # Other sources are arbitrary TALES expressions (or
+                # tags, which have no content), that can not use the
+                # full-text index.
+                if source == 'tags':
                     source = 'here/all/tags'
                 c=self.build_context()
                 sourcedata=c.evaluate(source)
@@ -764,12 +817,19 @@ class AdveneController(object):
         except OSError:
             pass
 
+        if config.data.preferences['package-parse-cache']:
+            Package.parse_cache_dir=config.data.advenefile('parsed-packages', 'settings')
+            Package.parse_cache_max_size=config.data.preferences['package-parse-cache-size'] * 1024 * 1024
+
         # Read the default rules
         self.event_handler.read_ruleset_from_file(config.data.advenefile('default_rules.xml'),
                                                   type_='default', priority=100)
 
         self.event_handler.internal_rule (event="PackageLoad",
                                           method=self.manage_package_load)
+        for e in ('AnnotationCreate', 'AnnotationEditEnd', 'AnnotationDelete'):
+            self.event_handler.internal_rule (event=e,
+                                              method=self.update_annotation_events)
 
         media=None
         # Arguments handling
@@ -933,12 +993,107 @@ class AdveneController(object):
                 # We created an element. Make sure its id is registered in the _idgenerator
                 p._idgenerator.add(el.id)
 
-        if 'immediate' in kw:
-            self.event_handler.notify(event_name, *param, **kw)
+        # delete_element & co always pass immediate, possibly False: the
+        # event handler only checks for the presence of the key.
+        if kw.pop('immediate', False):
+            self.event_handler.notify(event_name, *param, immediate=True, **kw)
+        elif self.batch_events is not None:
+            self.batch_events.append( (event_name, param, kw) )
         else:
             self.queue_action(self.event_handler.notify, event_name, *param, **kw)
         return
 
+    def begin_batch(self, package=None):
+        """Enter a batch section on the given package (default: the current one).
+
+        Until the matching end_batch, all the modifications of the
+        package are grouped in a single backend transaction (see
+        Package.begin_batch), and the non-immediate notifications are
+        postponed. When the outermost section is closed, they are all
+        queued. If there are too many of them (see the
+        batch-notify-threshold preference), they are flagged with
+        batched=True, so that the GUI does not update the views for each
+        of them, and a PackageActivate notification is added to rebuild
+        the views once for each modified package.
+
+        Batch sections can be nested. Callers must ensure that
+        end_batch is called, which is best done by using L{batch}.
+        """
+        if package is None:
+            package=self.package
+        package.begin_batch()
+        self.batch_packages.append(package)
+        if self.batch_events is None:
+            self.batch_events=[]
+            self.batched_packages=[]
+            self.cancelled_packages=[]
+        if not package in self.batched_packages:
+            self.batched_packages.append(package)
+
+    def end_batch(self):
+        """Exit the innermost batch section (see begin_batch).
+
+        Raise an InternalError if the package could not commit the
+        section, in which case its modifications are cancelled, and the
+        notifications postponed about them are dropped.
+        """
+        package=self.batch_packages.pop()
+        try:
+            package.end_batch()
+        except InternalError:
+            self.cancelled_packages.append(package)
+            raise
+        finally:
+            if not self.batch_packages:
+                events=self.batch_events
+                self.batch_events=None
+                self.flush_batch_events(events, self.batched_packages,
+                                        self.cancelled_packages)
+                self.batched_packages=[]
+                self.cancelled_packages=[]
+
+    def batch(self, package=None):
+        """Return a context manager enclosing a batch section, for use as::
+
+            with controller.batch():
+                ...
+
+        If an exception is raised in the section, it is not masked by
+        the failure to commit the section.
+
+        @param package: the package (default: the current one)
+        @type package: Package
+        """
+        return BatchSection(self, package)
+
+    def flush_batch_events(self, events, packages, cancelled=()):
+        """Dispatch the notifications postponed by a batch section.
+
+        @param events: the postponed notifications
+        @param packages: the packages modified in the section
+        @param cancelled: the packages whose modifications were cancelled
+        """
+        if cancelled:
+            # Drop the notifications about cancelled modifications
+            events=[ (event_name, param, kw)
+                     for (event_name, param, kw) in events
+                     if not [ v for v in kw.itervalues()
+                              if getattr(v, 'owner', None) in cancelled ] ]
+        if len(events) > config.data.preferences['batch-notify-threshold']:
+            # Too many notifications: the views will rather rebuild
+            # themselves once for each modified package. The
+            # notifications are still dispatched for the rules and
+            # the undo manager.
+            for event_name, param, kw in events:
+                kw['batched']=True
+        else:
+            packages=cancelled
+        for event_name, param, kw in events:
+            self.queue_action(self.event_handler.notify, event_name, *param, **kw)
+        # The views may display elements whose creation was cancelled
+        for p in packages:
+            self.notify('PackageActivate', package=p)
+
     def set_volume(self, v):
         """Set the audio volume.
         """
@@ -955,12 +1110,15 @@ class AdveneController(object):
             v=0
         return v
 
-    def get_snapshot(self, annotation, epsilon=None):
+    def get_snapshot(self, annotation, epsilon=None, width=None):
         """Return the snapshot for the given annotation.
+
+        If width is given, a reduced version of the snapshot may be
+        returned (see ImageCache.get).
         """
         ic=self.imagecache.get(annotation.media.url)
         if ic is not None:
-            return ic.get(annotation.begin, epsilon)
+            return ic.get(annotation.begin, epsilon, width)
         else:
             return None
 
@@ -1315,7 +1473,7 @@ class AdveneController(object):
 
         if uri is not None and uri != "" and not uri in self.imagecache:
             # Not yet present. Initialize an imagecache
-            ic=ImageCache()
+            ic=ImageCache(max_memory=config.data.preferences['imagecache-max-memory'])
             self.imagecache[uri]=ic
             ic.load(helper.mediafile2id(uri))
             # Update package title and description if necessary
@@ -1342,15 +1500,17 @@ class AdveneController(object):
             self.notify('RelationDelete', relation=el, immediate=immediate_notify)
             el.delete()
         elif isinstance(el, AnnotationType):
-            for a in el.annotations:
-                self.delete_element(a, immediate_notify=True, batch=batch)
-            self.notify('AnnotationTypeDelete', annotationtype=el, immediate=immediate_notify)
-            el.delete()
+            with self.batch(el.owner):
+                for a in el.annotations:
+                    self.delete_element(a, batch=batch)
+                self.notify('AnnotationTypeDelete', annotationtype=el, immediate=immediate_notify)
+                el.delete()
         elif isinstance(el, RelationType):
-            for r in el.relations:
-                self.delete_element(r, immediate_notify=True, batch=batch)
-            self.notify('RelationTypeDelete', relationtype=el, immediate=immediate_notify)
-            el.delete()
+            with self.batch(el.owner):
+                for r in el.relations:
+                    self.delete_element(r, batch=batch)
+                self.notify('RelationTypeDelete', relationtype=el, immediate=immediate_notify)
+                el.delete()
         elif isinstance(el, Schema):
             self.notify('SchemaDelete', schema=el, immediate=immediate_notify)
             el.delete()
@@ -1457,7 +1617,7 @@ class AdveneController(object):
                 self.notify('EditSessionStart', element=annotation, immediate=True)
                 self.notify('AnnotationMove', annotation=annotation, comment="Transmute annotation")
                 self.notify('AnnotationDelete', annotation=annotation, comment="Transmute annotation")
-                annotation.delete()
+            annotation.delete()
         if notify:
             self.notify("AnnotationCreate", annotation=an, comment="Transmute annotation")
 
@@ -1768,6 +1928,12 @@ class AdveneController(object):
             self.unregister_package('new_pkg')
         self.packages[alias] = package
         self.aliases[package] = alias
+        if self.server is not None:
+            # let the webserver threads read the package without
+            # contending with the GUI for the sqlite connection
+            enable = getattr(package._backend, 'enable_concurrent_reads', None)
+            if enable is not None:
+                enable()
 
     def unregister_package (self, alias):
         """Remove a package from the loaded packages lists.
@@ -1910,7 +2076,7 @@ class AdveneController(object):
         # Instanciate imagecaches for all medias
         for m in p.all.medias:
             if not m.url in self.imagecache:
-                ic=ImageCache()
+                ic=ImageCache(max_memory=config.data.preferences['imagecache-max-memory'])
                 self.imagecache[m.url]=ic
                 # Load the imagecache
                 ic.load(helper.mediafile2id(m.url))
@@ -2223,55 +2389,60 @@ class AdveneController(object):
 
         return True
 
-    def generate_sorted_lists (self, position):
-        """Return two sorted lists and a list of active annotations valid for a given position.
-
-        (i.e. all annotations beginning or ending after the
-        position). The lists are sorted according to the begin and end
-        position respectively.
+    def get_annotation_events (self):
+        """Return the begin/end event index of the current media.
 
-        The elements of the begin/end lists are (annotation, begin,
-        end). The elements of active_annotations are annotations.
+        The index is built on first use, and then maintained by
+        update_annotation_events. Indexes built for another package
+        are discarded.
 
-        The update_display method only has to check the first element
-        of each list. If there is a match, it should trigger the
-        events and pop the element.
-
-        If there is a seek operation, we should regenerate the lists.
-
-        @param position: the current position
-        @type position: int
-        @return: a tuple of three lists containing triplets or simple annotations
-        @rtype: tuple
+        @return: the event index, or None if there is no current media
+        @rtype: AnnotationEventIndex
         """
-        if self.current_media is None:
-            return [], [], []
+        media = self.current_media
+        if media is None:
+            self._current_events = None
+            return None
+        events = self.annotation_events.get(media.uriref)
+        if events is None or events.package is not self.package:
+            if events is not None:
+                self.annotation_events.clear()
+            events = AnnotationEventIndex(self.package, media)
+            self.annotation_events[media.uriref] = events
+        if events is not self._current_events:
+            # The current media has changed: reposition the cursors
+            self._current_events = events
+            self.reset_annotation_lists()
+        return events
 
-        # Substract 20ms to the current position, so that in case the
-        # generate_sorted_lists is triggered due to selecting an
-        # annotation, the annotation is put in future_begins and its
-        # AnnotatioBegin gets correctly notified.
-        position -= 20
-        
-        l = [ (a, a.begin, a.end)
-              for a in self.package.all.iter_annotations(media=self.current_media)
-              if a.begin >= position or a.end >= position ]
-        future_begins = list(l)
-        future_ends = l
-        # FIXME: Adven2 - check validity of this line:
-        active = list(l)
-        future_begins.sort(key=operator.itemgetter(1))
-        future_ends.sort(key=operator.itemgetter(2))
-
-        #print "Position: %s" % helper.format_time(position)
-        #print "Begins: %s\nEnds: %s" % ([ a[0].id for a in future_begins[:4] ],
-        #                                [ a[0].id for a in future_ends[:4] ])
-        return future_begins, future_ends, active
+    def update_annotation_events (self, context, parameters):
+        """Internal rule keeping the event indexes up to date.
+        """
+        a=context.globals['annotation']
+        event=context.globals['event']
+        for events in self.annotation_events.itervalues():
+            if event == 'AnnotationDelete':
+                events.remove(a)
+            else:
+                events.update(a)
+        if a in self.active_annotations:
+            if (event == 'AnnotationDelete'
+                or not a.begin <= self.last_position < a.end):
+                self.active_annotations.remove(a)
+        elif (event != 'AnnotationDelete'
+              and a.get_media(None) is not None
+              and a.media.uriref == getattr(self.current_media, 'uriref', None)
+              and a.begin <= self.last_position < a.end):
+            self.active_annotations.append(a)
+        return True
 
     def reset_annotation_lists (self):
-        """Reset the future annotations lists."""
-        self.future_begins = None
-        self.future_ends = None
+        """Reset the active annotations.
+
+        The cursors of the event index are repositioned on the next
+        update.
+        """
+        self._seek_events = True
         self.active_annotations = []
 
     def update (self):
@@ -2294,9 +2465,8 @@ class AdveneController(object):
 
         if pos < self.last_position or pos > self.last_position + 1000:
             # We did a seek compared to the last time (backward, or
-            # more than 1s forward), so we invalidate the
-            # future_begins and future_ends lists as well as the
-            # active_annotations
+            # more than 1s forward), so we reposition the event index
+            # cursors and recompute the active_annotations
             self.reset_annotation_lists()
 
         self.last_position = pos
@@ -2322,43 +2492,35 @@ class AdveneController(object):
                 else:
                     t = 0
 
-        if self.future_begins is None or self.future_ends is None:
-            self.future_begins, self.future_ends, self.active_annotations = self.generate_sorted_lists(pos)
-            #print "New lists", [a.id for a in self.active_annotations], [t[0].id for t in self.future_begins ]
-
-        if self.future_begins and (p.status == p.PlayingStatus or p.status == p.PauseStatus):
-            a, b, e = self.future_begins[0]
-            #print "Future begin", a.id, b, pos
-            while b <= pos:
+        events = self.get_annotation_events()
+        if events is None:
+            self.active_annotations = []
+        elif self._seek_events:
+            # Substract 20ms to the current position, so that in case
+            # the reset is triggered due to selecting an annotation,
+            # its AnnotationBegin gets correctly notified. The
+            # annotations already started are notified by the next
+            # pop_begins, as well as the ones starting later.
+            events.seek(pos - 20)
+            self.active_annotations = []
+            self._seek_events = False
+
+        if events is not None and (p.status == p.PlayingStatus or p.status == p.PauseStatus):
+            for a, b, e in events.pop_begins(pos):
                 # Ignore if we were after the annotation end
-                self.future_begins.pop(0)
                 if e > pos:
-                    #print "AnnotationBegin", a.id, e, pos
                     self.notify ("AnnotationBegin",
                                  annotation=a,
                                  immediate=True)
                     self.active_annotations.append(a)
-                if self.future_begins:
-                    a, b, e = self.future_begins[0]
-                else:
-                    break
-
-        if self.future_ends and (p.status == p.PlayingStatus or p.status == p.PauseStatus):
-            a, b, e = self.future_ends[0]
-            while e <= pos:
-                #print "Comparing %d < %d for %s" % (e, pos, a.content.data)
+            for a, b, e in events.pop_ends(pos):
                 try:
                     self.active_annotations.remove(a)
                 except ValueError:
                     pass
-                self.future_ends.pop(0)
                 self.notify ("AnnotationEnd",
                              annotation=a,
                              immediate=True)
-                if self.future_ends:
-                    a, b, e = self.future_ends[0]
-                else:
-                    break
 
         if p.stream_duration > self.cached_duration + 2000:
             # Something wrong here. Can be a live stream, or a unknown
@@ -0,0 +1,184 @@
+#
+# Advene: Annotate Digital Videos, Exchange on the NEt
+# Copyright (C) 2008 Olivier Aubert <olivier.aubert@liris.cnrs.fr>
+#
+# Advene is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Advene is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Advene; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+"""Begin/end event index of the annotations of a media.
+
+The controller uses it to find out which annotations start or stop when
+the player position moves. The index is built once per media, and then
+maintained in place when annotations are created, edited or deleted, so
+that a seek only costs a couple of bisections.
+"""
+
+from bisect import bisect_left
+
+class AnnotationEventIndex(object):
+    """Sorted begin and end events of the annotations of one media.
+
+    The begin (resp. end) events are stored as (time, id, owner) triplets
+    in a sorted list, along with a cursor pointing to the first event
+    which has not been consumed yet. Only the ids of annotations are kept,
+    so that the index does not keep every annotation of the media alive;
+    they are fetched back from their owner package when needed.
+
+    @ivar package: the package for which the index was built
+    @ivar media: the indexed media
+    """
+    def __init__(self, package, media):
+        self.package = package
+        self.media = media
+        self._extents = {}
+        self._begins = []
+        self._ends = []
+        self._next_begin = 0
+        self._next_end = 0
+        self._pending = []
+        for a in package.all.iter_annotations(media=media):
+            self._extents[a._owner, a._id] = (a.begin, a.end)
+            self._begins.append( (a.begin, a._id, a._owner) )
+            self._ends.append( (a.end, a._id, a._owner) )
+        self._begins.sort()
+        self._ends.sort()
+
+    def __len__(self):
+        return len(self._extents)
+
+    def seek(self, position):
+        """Move the cursors to the given position.
+
+        The annotations which are already started at this position, but not
+        ended, are kept pending: they will be returned first by the next call
+        to `pop_begins`, so that their begin event is not lost.
+        """
+        self._next_begin = bisect_left(self._begins, (position,))
+        self._next_end = bisect_left(self._ends, (position,))
+        self._pending = sorted( (a.begin, a._id, a._owner)
+                                for a in self.package.all.iter_annotations(
+                                         media=self.media,
+                                         begin_max=position,
+                                         end_min=position)
+                                if a.begin < position )
+
+    def pop_begins(self, position):
+        """Consume the begin events up to the given position.
+
+        Return a list of (annotation, begin, end) triplets.
+        """
+        r = []
+        if self._pending:
+            r = [ t for t in ( self._resolve(e) for e in self._pending )
+                  if t is not None ]
+            self._pending = []
+        return r + self._pop(self._begins, '_next_begin', position)
+
+    def pop_ends(self, position):
+        """Consume the end events up to the given position.
+
+        Return a list of (annotation, begin, end) triplets.
+        """
+        return self._pop(self._ends, '_next_end', position)
+
+    def _pop(self, events, cursor, position):
+        i = start = getattr(self, cursor)
+        n = len(events)
+        while i < n and events[i][0] <= position:
+            i += 1
+        setattr(self, cursor, i)
+        return [ t for t in ( self._resolve(e) for e in events[start:i] )
+                 if t is not None ]
+
+    def _resolve(self, event):
+        _, id_, owner = event
+        a = owner.get_element(id_, None)
+        if a is None:
+            # the annotation was renamed or deleted behind our back
+            return None
+        b, e = self._extents[owner, id_]
+        return (a, b, e)
+
+    def iter_future_begins(self):
+        """Iter over the (annotation, begin, end) triplets of the annotations
+        which have not begun yet, sorted by begin time.
+
+        This includes the annotations kept pending by `seek`.
+        """
+        for e in self._pending:
+            t = self._resolve(e)
+            if t is not None:
+                yield t
+        for i in xrange(self._next_begin, len(self._begins)):
+            t = self._resolve(self._begins[i])
+            if t is not None:
+                yield t
+
+    def add(self, annotation):
+        """Insert the given annotation in the index.
+
+        Nothing is done if the annotation does not belong to the indexed
+        media.
+        """
+        media = annotation.get_media(None)
+        if media is None or media.uriref != self.media.uriref:
+            return
+        b, e = annotation.begin, annotation.end
+        id_, owner = annotation._id, annotation._owner
+        self._extents[owner, id_] = (b, e)
+        self._next_begin = _insert(self._begins, (b, id_, owner),
+                                   self._next_begin)
+        self._next_end = _insert(self._ends, (e, id_, owner),
+                                 self._next_end)
+
+    def remove(self, annotation):
+        """Remove the given annotation from the index, if present.
+
+        This works with deleted annotations as well.
+        """
+        id_, owner = annotation._id, annotation._owner
+        extent = self._extents.pop((owner, id_), None)
+        if extent is None:
+            return
+        b, e = extent
+        if self._pending:
+            self._pending = [ p for p in self._pending
+                              if p[1:] != (id_, owner) ]
+        self._next_begin = _remove(self._begins, (b, id_, owner),
+                                   self._next_begin)
+        self._next_end = _remove(self._ends, (e, id_, owner),
+                                 self._next_end)
+
+    def update(self, annotation):
+        """Reflect the modification of the given annotation in the index.
+        """
+        self.remove(annotation)
+        self.add(annotation)
+
+def _insert(events, event, cursor):
+    """Insert event in the sorted list events, and return the new cursor."""
+    i = bisect_left(events, event)
+    events.insert(i, event)
+    if i < cursor:
+        cursor += 1
+    return cursor
+
+def _remove(events, event, cursor):
+    """Remove event from the sorted list events, and return the new cursor."""
+    i = bisect_left(events, event)
+    if i < len(events) and events[i] == event:
+        del events[i]
+        if i < cursor:
+            cursor -= 1
+    return cursor
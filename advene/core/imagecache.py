@@ -21,12 +21,125 @@ Imagecache module for advene
 """
 
 import advene.core.config as config
-import operator
 
+from bisect import bisect_left, insort
+import mmap
 import os
 import re
+import struct
+import tempfile
+import StringIO
+
+try:
+    import Image
+except ImportError:
+    Image=None
+
+# Widths of the reduced versions of the snapshots (see ThumbnailsMixin)
+THUMBNAIL_WIDTHS=(160, 320)
+# Format of the reduced versions, cheaper to decode than PNG
+THUMBNAIL_FORMAT='JPEG'
+# Also keep the smallest version as raw RGB data (no decoding at all)
+RAW_THUMBNAILS=True
+
+class RawImage(str):
+    """Raw RGB data (3 bytes per pixel, no padding).
+    """
+    contenttype='image/x-raw-rgb'
+
+    def __new__(cls, data, width, height):
+        s=super(RawImage, cls).__new__(cls, data)
+        s.width=width
+        s.height=height
+        return s
+
+class ThumbnailsMixin(object):
+    """Mixin for snapshots, providing reduced versions of them.
+
+    The reduced versions are generated once, either explicitly by
+    L{make_thumbnails} (when the snapshot is captured) or on the first
+    call to L{thumbnail}. They are only kept in memory.
+
+    Classes using this mixin must provide a timestamp attribute, and
+    their str() must be the image data.
+    """
+    __thumbnails=None
+
+    def make_thumbnails(self):
+        """Generate the reduced versions of the snapshot.
 
-class CachedString:
+        Nothing is done if the Image module is not available.
+        """
+        self.__thumbnails={}
+        if Image is None:
+            return
+        try:
+            i=Image.open(StringIO.StringIO(str(self)))
+            i=i.convert('RGB')
+        except IOError:
+            # Invalid or empty data
+            return
+        # Reduce each version from the previous one, which is cheaper
+        for w in sorted(THUMBNAIL_WIDTHS, reverse=True):
+            if w >= i.size[0]:
+                continue
+            i=i.resize((w, max(1, i.size[1] * w / i.size[0])), Image.ANTIALIAS)
+            out=StringIO.StringIO()
+            i.save(out, THUMBNAIL_FORMAT)
+            t=TypedString(out.getvalue())
+            t.contenttype='image/' + THUMBNAIL_FORMAT.lower()
+            t.timestamp=self.timestamp
+            t.width, t.height = i.size
+            # A reduced version has no reduced versions of its own
+            t.__thumbnails={}
+            self.__thumbnails[w]=t
+        if RAW_THUMBNAILS and self.__thumbnails:
+            tobytes=getattr(i, 'tobytes', None) or i.tostring
+            r=RawImage(tobytes(), *i.size)
+            r.timestamp=self.timestamp
+            self.__thumbnails['raw']=r
+
+    def thumbnail(self, width=None, raw=False, height=None):
+        """Return the smallest version of the snapshot at least width wide
+        and height high.
+
+        The snapshot itself is returned if there is no such version. If raw
+        is True, the smallest version may be returned as a L{RawImage},
+        if it is large enough.
+        """
+        if self.__thumbnails is None:
+            self.make_thumbnails()
+        def large_enough(t):
+            return t.width >= (width or 0) and t.height >= (height or 0)
+        t=self.__thumbnails
+        if raw:
+            r=t.get('raw')
+            if r is not None and large_enough(r):
+                return r
+        for w in sorted(k for k in t if k != 'raw'):
+            if large_enough(t[w]):
+                return t[w]
+        return self
+
+    def thumbnails_size(self):
+        """Return the number of bytes used by the reduced versions.
+        """
+        if not self.__thumbnails:
+            return 0
+        return sum(len(t) for t in self.__thumbnails.itervalues())
+
+    def copy_thumbnails(self, other):
+        """Share the reduced versions of another snapshot of the same image.
+        """
+        if isinstance(other, ThumbnailsMixin):
+            self.__thumbnails=other.__thumbnails
+
+    def drop_thumbnails(self):
+        """Free the reduced versions. They are generated again when needed.
+        """
+        self.__thumbnails=None
+
+class CachedString(ThumbnailsMixin):
     """String cached in a file.
     """
     def __init__(self, filename):
@@ -50,7 +163,7 @@ class CachedString:
     def __repr__(self):
         return "Cached content from " + self._filename
 
-class TypedString(str):
+class TypedString(ThumbnailsMixin, str):
     """String with a mimetype and a timestamp attribute.
     """
     def __init__(self, *p):
@@ -58,12 +171,119 @@ class TypedString(str):
         self.contenttype='text/plain'
         self.timestamp=-1
 
+class PackFile(object):
+    """Append-only file of snapshots.
+
+    Each record is made of a (position, length) header followed by the
+    PNG data. A record of null length cancels the previous records for
+    the same position. The offset index is rebuilt by scanning the
+    headers when an existing file is opened. Data is read through mmap.
+
+    @ivar filename: the name of the file, or None for an anonymous
+                    temporary file
+    @ivar index: the (offset, length) of the data, indexed by position
+    @type index: dict
+    """
+    header=struct.Struct('>qI')
+
+    def __init__(self, filename=None):
+        self.filename=filename
+        self.index={}
+        self._map=None
+        if filename is None:
+            self._file=tempfile.TemporaryFile(prefix='advene-imagecache-')
+        else:
+            self._file=open(filename, 'a+b')
+            self._scan()
+
+    def _scan(self):
+        """Rebuild the offset index from the record headers.
+        """
+        f=self._file
+        f.seek(0)
+        offset=0
+        size=self.header.size
+        while True:
+            h=f.read(size)
+            if len(h) < size:
+                break
+            key, length=self.header.unpack(h)
+            offset += size
+            if length:
+                self.index[key]=(offset, length)
+            else:
+                self.index.pop(key, None)
+            offset += length
+            f.seek(offset)
+
+    def append(self, key, data):
+        """Append data for the given position.
+
+        @return: the offset of the data in the file
+        """
+        f=self._file
+        f.seek(0, 2)
+        offset=f.tell() + self.header.size
+        f.write(self.header.pack(key, len(data)))
+        f.write(data)
+        if self.filename is not None:
+            # Make the record visible to other readers of the file
+            f.flush()
+        if data:
+            self.index[key]=(offset, len(data))
+        else:
+            self.index.pop(key, None)
+        return offset
+
+    def read(self, offset, length):
+        """Return the data stored at the given offset.
+        """
+        if self._map is None or offset + length > len(self._map):
+            # The file has grown since it was mapped
+            self._file.flush()
+            if self._map is not None:
+                self._map.close()
+            self._map=mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map[offset:offset+length]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map=None
+        self._file.close()
+
+class PackedString(ThumbnailsMixin):
+    """String stored in a PackFile.
+    """
+    def __init__(self, pack, offset, length, timestamp=-1):
+        self._pack=pack
+        self._offset=offset
+        self._length=length
+        self.contenttype='image/png'
+        self.timestamp=timestamp
+
+    def __str__(self):
+        try:
+            return self._pack.read(self._offset, self._length)
+        except (IOError, OSError, ValueError):
+            return ''
+
+    def __len__(self):
+        return self._length
+
+    def __repr__(self):
+        return "Packed content from %s" % (self._pack.filename or 'spill file')
+
 class ImageCache(dict):
     """ImageCache class.
 
     It interacts with the player to return annotation snapshots. It approximates
     key values to a given precision (20 by default).
 
+    Along with the dictionary, it maintains two sorted lists of keys: the
+    positions holding a valid snapshot, and the positions waiting for one.
+    Approximate lookups are done by bisecting the former.
+
     @ivar not_yet_available_image: the image returned for not-yet-captured images
     @type not_yet_available_image: PNG data
     @ivar epsilon: the precision for key values
@@ -74,6 +294,12 @@ class ImageCache(dict):
     @type name: string
     @ivar autosync: if True, directly store snapshots on disk
     @type autosync: boolean
+    @ivar max_memory: if not None, the number of bytes of snapshots (and
+                      of their reduced versions) that are kept in memory.
+                      Least recently used snapshots are moved to a
+                      temporary pack file beyond this limit, then their
+                      reduced versions are freed if needed.
+    @type max_memory: integer
     """
     # The content of the not_yet_available_file file. We could use
     # CachedString but as it is frequently used, let us keep it in memory.
@@ -88,19 +314,36 @@ class ImageCache(dict):
     not_yet_available_image.contenttype='image/png'
     not_yet_available_image.timestamp=-1
 
-    def __init__ (self, name=None, epsilon=20):
+    def __init__ (self, name=None, epsilon=20, max_memory=None):
         """Initialize the Imagecache
 
         @param name: id of a previously saved ImageCache.
         @type name: string
         @param epsilon: value of the precision
         @type epsilon: integer
+        @param max_memory: the memory budget for snapshots, in bytes
+        @type max_memory: integer
         """
         # It is a dictionary whose keys are the positions
         # (in ms) and values the snapshot in PNG format.
         # value = self.not_yet_available_image if the image has
         # not yet been updated.
         dict.__init__ (self)
+        # Sorted lists of valid and missing positions
+        self._valid=[]
+        self._missing=[]
+
+        # Memory usage of the in-memory snapshots (total and per
+        # position), and their last access time (for LRU eviction)
+        self.max_memory=max_memory or None
+        self._memory=0
+        self._sizes={}
+        self._ticks={}
+        self._tick=0
+        # The pack file of the saved snapshots, and the temporary
+        # pack file for evicted snapshots
+        self._pack=None
+        self._spill=None
 
         self._modified=False
 
@@ -122,7 +365,7 @@ class ImageCache(dict):
         if key is None:
             return
         if not dict.has_key (self, key):
-            dict.__setitem__(self, key, self.not_yet_available_image)
+            self._store(key, self.not_yet_available_image)
 
     def has_key (self, key):
         if key is None:
@@ -147,22 +390,44 @@ class ImageCache(dict):
         if key is None:
             return self.not_yet_available_image
         key = self.approximate(key)
+        if key in self._ticks:
+            self._touch(key)
         return dict.__getitem__(self, key)
 
-    def get(self, key, epsilon=None):
+    def get(self, key, epsilon=None, width=None, height=None, raw=False):
         """Return a snapshot for the image corresponding to the position pos.
 
         The snapshot can be ImageCache.not_yet_available_image.
 
+        If width or height is given, a reduced version of the snapshot
+        may be returned (see L{ThumbnailsMixin.thumbnail}), in another
+        format than PNG.
+
         @param key: the key
         @type key: long
+        @param width: the width at which the image will be displayed
+        @type width: integer
+        @param height: the height at which the image will be displayed
+        @type height: integer
+        @param raw: if True, the reduced version may be raw RGB data
+        @type raw: boolean
         @return: an image
         @rtype: PNG data
         """
         if key is None:
-            return self.not_yet_available_image
-        key = self.approximate(key, epsilon)
-        return dict.__getitem__(self, key)
+            value = self.not_yet_available_image
+        else:
+            key = self.approximate(key, epsilon)
+            if key in self._ticks:
+                self._touch(key)
+            value = dict.__getitem__(self, key)
+        if (width or height) and value is not self.not_yet_available_image:
+            value=value.thumbnail(width, raw, height)
+            # The reduced versions may have been generated now
+            self._account(key)
+            if self.max_memory is not None and self._memory > self.max_memory:
+                self._evict()
+        return value
 
     def __setitem__ (self, key, value):
         """Set the snapshot for the image corresponding to the position key.
@@ -177,23 +442,162 @@ class ImageCache(dict):
         if value != self.not_yet_available_image:
             self._modified=True
             if self.autosync and self.name is not None:
-                d=os.path.join(config.data.path['imagecache'], self.name)
-                if not os.path.isdir(d):
-                    os.mkdir (d)
-                filename=os.path.join(d, "%010d.png" % key)
-                f = open(filename, 'wb')
-                f.write (value)
-                f.close ()
-                value=CachedString(filename)
-                value.contenttype='image/png'
+                if self._pack is None or self._pack.filename != self._pack_filename(self.name):
+                    self._open_pack(self.name)
+                value=str(value)
+                value=PackedString(self._pack, self._pack.append(key, value),
+                                   len(value), key)
             elif isinstance(value, basestring):
                 value=TypedString(value)
                 value.timestamp=key
                 value.contenttype='image/png'
-            return dict.__setitem__(self, key, value)
+            if isinstance(value, ThumbnailsMixin):
+                value.make_thumbnails()
+            self._store(key, value)
+            if self.max_memory is not None and self._memory > self.max_memory:
+                self._evict()
+            return value
         else:
             return self.not_yet_available_image
 
+    def __delitem__ (self, key):
+        self._forget(key)
+        dict.__delitem__(self, key)
+        if not _discard(self._valid, key):
+            _discard(self._missing, key)
+
+    def pop (self, key, *default):
+        if not dict.has_key(self, key):
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value=dict.__getitem__(self, key)
+        del self[key]
+        return value
+
+    def popitem (self):
+        for key in dict.iterkeys(self):
+            return key, self.pop(key)
+        raise KeyError('popitem(): dictionary is empty')
+
+    def setdefault (self, key, default=None):
+        if key is None:
+            return self.not_yet_available_image
+        if not dict.has_key(self, key):
+            if default is not None:
+                self[key]=default
+            # __setitem__ does not store not_yet_available_image
+            self.init_value(key)
+        return dict.__getitem__(self, key)
+
+    def update (self, *p, **kw):
+        for key, value in dict(*p, **kw).iteritems():
+            self[key]=value
+
+    def _touch (self, key):
+        """Mark an in-memory snapshot as recently used.
+        """
+        self._tick += 1
+        self._ticks[key]=self._tick
+
+    def _forget (self, key):
+        """Stop accounting for the in-memory snapshot at key, if any.
+        """
+        self._ticks.pop(key, None)
+        self._memory -= self._sizes.pop(key, 0)
+
+    def _account (self, key):
+        """Update the memory usage of the snapshot at key.
+
+        The data of TypedString snapshots and the reduced versions of
+        all snapshots are in memory.
+        """
+        self._memory -= self._sizes.pop(key, 0)
+        value=dict.__getitem__(self, key)
+        if value is self.not_yet_available_image:
+            size=0
+        else:
+            size=value.thumbnails_size()
+            if isinstance(value, TypedString):
+                size += len(value)
+        if size:
+            self._sizes[key]=size
+            self._memory += size
+            if key not in self._ticks:
+                self._touch(key)
+        else:
+            self._ticks.pop(key, None)
+
+    def _evict (self):
+        """Move the least recently used snapshots to the spill file.
+
+        Snapshots are evicted until a quarter of the budget is free, so
+        that the sort is amortized over several insertions. Their
+        (small) reduced versions are kept in memory, unless this is
+        not enough.
+        """
+        if self._spill is None:
+            self._spill=PackFile()
+        target=self.max_memory * 3 / 4
+        lru=sorted(self._ticks, key=self._ticks.get)
+        for key in lru:
+            if self._memory <= target:
+                return
+            data=dict.__getitem__(self, key)
+            if not isinstance(data, TypedString):
+                continue
+            packed=PackedString(self._spill, self._spill.append(key, data),
+                                len(data), key)
+            packed.copy_thumbnails(data)
+            dict.__setitem__(self, key, packed)
+            self._account(key)
+        for key in lru:
+            if self._memory <= target:
+                return
+            dict.__getitem__(self, key).drop_thumbnails()
+            self._account(key)
+
+    def _store (self, key, value):
+        """Store value for key, keeping the sorted key lists up to date.
+        """
+        if value is self.not_yet_available_image:
+            new, old = self._missing, self._valid
+        else:
+            new, old = self._valid, self._missing
+        if not dict.has_key(self, key):
+            insort(new, key)
+        else:
+            self._forget(key)
+            if _discard(old, key):
+                insort(new, key)
+        dict.__setitem__(self, key, value)
+        self._account(key)
+
+    def _reindex (self):
+        """Rebuild the sorted key lists from the dictionary content.
+        """
+        self._valid=sorted( k for k, v in self.iteritems()
+                            if v is not self.not_yet_available_image )
+        self._missing=sorted( k for k, v in self.iteritems()
+                              if v is self.not_yet_available_image )
+
+    def clear (self):
+        dict.clear(self)
+        self._valid=[]
+        self._missing=[]
+        self._memory=0
+        self._sizes.clear()
+        self._ticks.clear()
+        if self._spill is not None:
+            self._spill.close()
+            self._spill=None
+
+    def reset (self):
+        """Remove all snapshots from the cache.
+        """
+        self.clear()
+        self._modified=False
+
     def approximate (self, key, epsilon=None):
         """Return an approximate key value for key.
 
@@ -203,23 +607,22 @@ class ImageCache(dict):
         if key is None:
             return None
         key=long(key)
-        if dict.has_key(self, key) and dict.__getitem__(self, key) != self.not_yet_available_image:
-            return key
-
         if epsilon is None:
             epsilon=self.epsilon
-        valids = [ (pos, abs(pos-key))
-                   for pos in self.keys()
-                   if abs(pos - key) <= epsilon
-                   and dict.__getitem__(self, pos) != self.not_yet_available_image ]
-        valids.sort(key=operator.itemgetter(1))
-
-        if valids:
-            key = valids[0][0]
-#            print "Approximate key: %d (%d)" % valids[0]
-#            if len(valids) > 1:
-#                print "Imagecache: more than 1 valid snapshot for %d: %s" % (key,
-#                                                                              valids)
+
+        # The nearest valid positions are on both sides of the
+        # insertion point of key.
+        valid=self._valid
+        i=bisect_left(valid, key)
+        best=None
+        if i < len(valid) and valid[i] - key <= epsilon:
+            best=valid[i]
+        if i > 0 and key - valid[i-1] <= epsilon:
+            if best is None or key - valid[i-1] < best - key:
+                best=valid[i-1]
+
+        if best is not None:
+            key = best
         else:
             self.init_value (key)
 
@@ -236,8 +639,8 @@ class ImageCache(dict):
         if epsilon is None:
             epsilon=self.epsilon
         key = self.approximate(key, epsilon)
-        if dict.__getitem__(self, key) != self.not_yet_available_image:
-            dict.__setitem__(self, key, self.not_yet_available_image)
+        if dict.__getitem__(self, key) is not self.not_yet_available_image:
+            self._store(key, self.not_yet_available_image)
         return key
 
     def missing_snapshots (self):
@@ -245,18 +648,24 @@ class ImageCache(dict):
 
         @return: a list of keys
         """
-        return [ pos
-                 for pos in self.keys()
-                 if dict.__getitem__(self, pos) == self.not_yet_available_image ]
+        return list(self._missing)
+
+    def missing_count (self):
+        """Return the number of missing snapshots.
+        """
+        return len(self._missing)
 
     def valid_snapshots (self):
         """Return the list of positions of valid snapshots.
 
         @return: a list of keys
         """
-        return [ pos
-                 for pos in self.keys()
-                 if dict.__getitem__(self, pos) != self.not_yet_available_image ]
+        return list(self._valid)
+
+    def valid_count (self):
+        """Return the number of valid snapshots.
+        """
+        return len(self._valid)
 
     def is_initialized (self, key, epsilon=None):
         """Return True if the given key is initialized.
@@ -267,21 +676,15 @@ class ImageCache(dict):
         if key is None:
             return False
         key = self.approximate(key, epsilon)
-        if dict.__getitem__(self, key) == self.not_yet_available_image:
-            return False
-        else:
-            return True
-
-    def save (self, name):
-        """Save the content of the cache under a specified name (id).
+        return dict.__getitem__(self, key) is not self.not_yet_available_image
 
-        The method creates a directory in some other directory
-        (config.data.path['imagecache']) and saves the content.
+    def _pack_filename (self, name):
+        """Return the pack file name for the given imagecache id.
+        """
+        return os.path.join(config.data.path['imagecache'], name + '.pack')
 
-        @param name: the name
-        @type name: string
-        @return: the created directory
-        @rtype: string
+    def _check_directory (self):
+        """Make sure that the imagecache directory exists.
         """
         directory=config.data.path['imagecache']
         if not os.path.isdir (directory):
@@ -291,59 +694,100 @@ class ImageCache(dict):
             else:
                 os.mkdir (directory)
 
-        d = os.path.join (directory, name)
+    def _open_pack (self, name):
+        """Open (or create) the pack file for the given imagecache id.
+        """
+        self._check_directory()
+        self._pack=PackFile(self._pack_filename(name))
+        return self._pack
 
-        if not os.path.isdir (d):
-            if os.path.exists (d):
-                # File exists, but is not a directory.
-                raise Exception("Fatal error: %s should be a directory" % d)
-            else:
-                os.mkdir (d)
+    def _use_pack (self):
+        """Serve all the snapshots of the pack file from it.
+        """
+        for k, (offset, length) in self._pack.index.iteritems():
+            packed=PackedString(self._pack, offset, length, k)
+            packed.copy_thumbnails(dict.get(self, k))
+            self._forget(k)
+            dict.__setitem__(self, k, packed)
+            self._account(k)
 
-        for k in self.iterkeys():
-            i=dict.__getitem__(self, k)
-            if i == self.not_yet_available_image:
-                continue
-            if isinstance(i, CachedString):
-                continue
-            f = open(os.path.join (d, "%010d.png" % k), 'wb')
-            f.write (i)
-            f.close ()
+    def save (self, name):
+        """Save the content of the cache under a specified name (id).
 
+        The method writes all valid snapshots in a single pack file in
+        some directory (config.data.path['imagecache']). The snapshots
+        are then served from this file, and no longer kept in memory.
+
+        @param name: the name
+        @type name: string
+        @return: the pack file name
+        @rtype: string
+        """
+        self._check_directory()
+        filename=self._pack_filename(name)
+        if os.path.exists(filename + '.new'):
+            os.remove(filename + '.new')
+        new=PackFile(filename + '.new')
+        for k in self._valid:
+            data=str(dict.__getitem__(self, k))
+            if data:
+                new.append(k, data)
+        new.close()
+        if self._pack is not None:
+            # Its content has been copied into the new file
+            self._pack.close()
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(new.filename, filename)
+
+        self._open_pack(name)
+        self._use_pack()
+        if self._spill is not None:
+            self._spill.close()
+            self._spill=None
         self._modified=False
-        return d
+        return filename
 
     def load (self, name):
         """Add new images to an ImageCache, from the specified imagecache id.
 
-        @param name: the name of the origin imagecache directory.
+        Snapshots are read from the pack file of the imagecache, as well
+        as from the directory of individual PNG files used by former
+        versions.
+
+        @param name: the name of the origin imagecache.
         @type name: string
         """
         d = os.path.join (config.data.path['imagecache'], name)
+        filename = self._pack_filename(name)
 
-        if not os.path.isdir (d):
-            # The cache directory does not exist
+        if not os.path.isdir (d) and not os.path.exists (filename):
+            # The cache does not exist
             return
-        else:
-            self.name=name
-            for name in os.listdir (d):
-                (n, ext) = os.path.splitext(name)
+        self.name=name
+        if os.path.isdir (d):
+            for n in os.listdir (d):
+                (n, ext) = os.path.splitext(n)
                 # We must do some checks, in case there are non-well
                 # formatted filenames in the directory
                 if ext.lower() == '.png':
                     try:
-                        n=n.lstrip('0')
-                        if n == '':
-                            n=0
-                        i=long(n)
+                        i=long(n.lstrip('0') or 0)
                     except ValueError:
-                        print "Invalid filename in imagecache: " + name
+                        print "Invalid filename in imagecache: " + n + ext
                         continue
-                    s=CachedString(os.path.join (d, name))
+                    s=CachedString(os.path.join (d, n + ext))
                     s.contenttype='image/png'
+                    self._forget(i)
                     dict.__setitem__(self, i, s)
+        if os.path.exists (filename):
+            # Snapshots from the pack file supersede the individual files
+            self._open_pack(name)
+            self._use_pack()
+        self._reindex()
         self._modified=False
 
+
     def ids (self):
         """Return the list of currents ids.
         """
@@ -354,3 +798,14 @@ class ImageCache(dict):
 
     def __repr__ (self):
         return "ImageCache object (%d images)" % len(self)
+
+def _discard(keys, key):
+    """Remove key from the sorted list keys.
+
+    @return: True if key was present
+    """
+    i=bisect_left(keys, key)
+    if i < len(keys) and keys[i] == key:
+        del keys[i]
+        return True
+    return False
@@ -387,7 +387,10 @@ class AdveneGUI(object):
             if s:
                 m.append(gtk.MenuItem(_("Snapshotter activity")))
                 m.append(gtk.SeparatorMenuItem())
-                m.append(gtk.MenuItem(_("%d queued requests") % s.timestamp_queue.qsize()))
+                n = s.timestamp_queue.qsize()
+                if s.batch is not None:
+                    n += s.batch.pending
+                m.append(gtk.MenuItem(_("%d queued requests") % n))
                 i = gtk.MenuItem(_("Cancel all requests"))
                 i.connect('activate', lambda i: s.clear() or True)
                 m.append(i)
@@ -628,6 +631,21 @@ class AdveneGUI(object):
             p.UndefinedStatus: _("Undefined"),
             }
 
+    def update_views(self, context, method, **kw):
+        """Call the given update method of the views, with kw.
+
+        Nothing is done for the notifications flagged by a batch
+        section, since a PackageActivate follows them (see
+        controller.begin_batch).
+        """
+        if context.globals.get('batched'):
+            return
+        for v in self.adhoc_views:
+            try:
+                getattr(v, method)(**kw)
+            except AttributeError:
+                pass
+
     def annotation_lifecycle(self, context, parameters):
         """Method used to update the active views.
 
@@ -638,11 +656,7 @@ class AdveneGUI(object):
         if annotation.owner != self.controller.package:
             return True
         self.updated_element(event, annotation)
-        for v in self.adhoc_views:
-            try:
-                v.update_annotation(annotation=annotation, event=event)
-            except AttributeError:
-                pass
+        self.update_views(context, 'update_annotation', annotation=annotation, event=event)
         # Update the content indexer
         if event.endswith('EditEnd') or event.endswith('Create'):
             # Update the type fieldnames
@@ -664,11 +678,7 @@ class AdveneGUI(object):
         if relation.owner != self.controller.package:
             return True
         self.updated_element(event, relation)
-        for v in self.adhoc_views:
-            try:
-                v.update_relation(relation=relation, event=event)
-            except AttributeError:
-                pass
+        self.update_views(context, 'update_relation', relation=relation, event=event)
         # Refresh the edit popup for the members
         for e in [ e for e in self.edit_popups if e.element in relation ]:
             e.refresh()
@@ -684,11 +694,7 @@ class AdveneGUI(object):
         if view.owner != self.controller.package:
             return True
         self.updated_element(event, view)
-        for v in self.adhoc_views:
-            try:
-                v.update_view(view=view, event=event)
-            except AttributeError:
-                pass
+        self.update_views(context, 'update_view', view=view, event=event)
 
         if view.content.mimetype == 'application/x-advene-ruleset':
             # Update the combo box
@@ -710,11 +716,7 @@ class AdveneGUI(object):
         if query.owner != self.controller.package:
             return True
         self.updated_element(event, query)
-        for v in self.adhoc_views:
-            try:
-                v.update_query(query=query, event=event)
-            except AttributeError:
-                pass
+        self.update_views(context, 'update_query', query=query, event=event)
         return True
 
     def resource_lifecycle(self, context, parameters):
@@ -728,11 +730,7 @@ class AdveneGUI(object):
             return True
         self.updated_element(event, resource)
 
-        for v in self.adhoc_views:
-            try:
-                v.update_resource(resource=resource, event=event)
-            except AttributeError:
-                pass
+        self.update_views(context, 'update_resource', resource=resource, event=event)
         return True
 
     def schema_lifecycle(self, context, parameters):
@@ -746,11 +744,7 @@ class AdveneGUI(object):
             return True
         self.updated_element(event, schema)
 
-        for v in self.adhoc_views:
-            try:
-                v.update_schema(schema=schema, event=event)
-            except AttributeError:
-                pass
+        self.update_views(context, 'update_schema', schema=schema, event=event)
         return True
 
     def annotationtype_lifecycle(self, context, parameters):
@@ -764,11 +758,7 @@ class AdveneGUI(object):
             return True
 
         self.updated_element(event, at)
-        for v in self.adhoc_views:
-            try:
-                v.update_annotationtype(annotationtype=at, event=event)
-            except AttributeError:
-                pass
+        self.update_views(context, 'update_annotationtype', annotationtype=at, event=event)
         # Update the current type menu
         self.update_gui()
         # Update the content indexer
@@ -787,11 +777,7 @@ class AdveneGUI(object):
             return True
 
         self.updated_element(event, rt)
-        for v in self.adhoc_views:
-            try:
-                v.update_relationtype(relationtype=rt, event=event)
-            except AttributeError:
-                pass
+        self.update_views(context, 'update_relationtype', relationtype=rt, event=event)
         # Update the content indexer
         if event.endswith('Create'):
             self.controller.package._indexer.element_update(rt)
@@ -3130,7 +3116,7 @@ class AdveneGUI(object):
         # Check snapshotter activity
         s = getattr(c.player, 'snapshotter', None)
         if s:
-            if s.timestamp_queue.empty():
+            if s.timestamp_queue.empty() and not (s.batch and s.batch.is_running()):
                 self.snapshotter_monitor_icon.set_state('idle')
             else:
                 self.snapshotter_monitor_icon.set_state('running')
@@ -4789,8 +4775,14 @@ class AdveneGUI(object):
         if missing:
             dialog.message_dialog(_("Updating %d snapshots") % len(missing), modal=False)
             print "Updating %d missing snapshots: " % len(missing), ", ".join(helper.format_time(t) for t in sorted(missing))
-            for t in sorted(missing):
-                self.controller.player.async_snapshot(t)
+            batch=getattr(self.controller.player, 'batch_snapshot', None)
+            if batch is not None:
+                if self.controller.player.snapshot_notify is None:
+                    self.controller.player.snapshot_notify=self.controller.snapshot_taken
+                batch(missing)
+            else:
+                for t in sorted(missing):
+                    self.controller.player.async_snapshot(t)
         else:
             dialog.message_dialog(_("No snapshot to update"), modal=False)
         return True
@@ -4811,7 +4803,7 @@ class AdveneGUI(object):
         p=c.player
         ic=self.controller.imagecache.get(movie)
         if ic is None:
-            self.controller.imagecache[movie]=ImageCache()
+            self.controller.imagecache[movie]=ImageCache(max_memory=config.data.preferences['imagecache-max-memory'])
 
         def do_cancel(b, pb):
             if pb.event_source_generate is not None:
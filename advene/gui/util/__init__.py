@@ -60,17 +60,32 @@ else:
 
 def png_to_pixbuf (png_data, width=None, height=None):
     """Load PNG data into a pixbuf
+
+    If png_data is a snapshot from the imagecache, its smallest version
+    large enough for width and height is used, which may be in another
+    format.
     """
-    loader = gtk.gdk.PixbufLoader ('png')
-    if not isinstance(png_data, str):
-        png_data=str(png_data)
-    try:
-        loader.write (png_data, len (png_data))
-        pixbuf = loader.get_pixbuf ()
-        loader.close ()
-    except gobject.GError:
-        # The PNG data was invalid.
-        pixbuf=gtk.gdk.pixbuf_new_from_file(config.data.advenefile( ( 'pixmaps', 'notavailable.png' ) ))
+    if (width or height) and hasattr(png_data, 'thumbnail'):
+        png_data=png_data.thumbnail(width, raw=True, height=height)
+    contenttype=getattr(png_data, 'contenttype', 'image/png')
+    if contenttype == 'image/x-raw-rgb':
+        pixbuf=gtk.gdk.pixbuf_new_from_data(png_data, gtk.gdk.COLORSPACE_RGB, False, 8,
+                                            png_data.width, png_data.height,
+                                            png_data.width * 3)
+    else:
+        if contenttype.startswith('image/'):
+            loader = gtk.gdk.PixbufLoader (contenttype[6:])
+        else:
+            loader = gtk.gdk.PixbufLoader ('png')
+        if not isinstance(png_data, str):
+            png_data=str(png_data)
+        try:
+            loader.write (png_data, len (png_data))
+            pixbuf = loader.get_pixbuf ()
+            loader.close ()
+        except gobject.GError:
+            # The image data was invalid.
+            pixbuf=gtk.gdk.pixbuf_new_from_file(config.data.advenefile( ( 'pixmaps', 'notavailable.png' ) ))
 
     if width and not height:
         height = width * pixbuf.get_height() / pixbuf.get_width()
@@ -86,7 +101,7 @@ def image_from_position(controller, position=None, width=None, height=None, epsi
     i=gtk.Image()
     if position is None:
         position=controller.player.current_position_value
-    pb=png_to_pixbuf (controller.gui.imagecache.get(position, epsilon), width=width, height=height)
+    pb=png_to_pixbuf (controller.gui.imagecache.get(position, epsilon, width=width, height=height, raw=True), width=width, height=height)
     i.set_from_pixbuf(pb)
     return i
 
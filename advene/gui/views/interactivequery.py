@@ -94,7 +94,7 @@ class InteractiveQuery(AdhocView):
             el.title=_("Interactive query")
 
             # Create a basic query
-            q=SimpleQuery(source=self.source,
+            q=SimpleQuery(sources=[ self.source ],
                           rvalue="element")
             q.add_condition(Condition(lhs="element/content/data",
                                       operator="contains",
@@ -345,8 +345,9 @@ class InteractiveResult(AdhocView):
             if not at.description:
                 at.description=_("Copied result of the '%s' query") % self.query
             self.controller.notify('AnnotationTypeEditEnd', annotationtype=at)
-            for a in l:
-                self.controller.transmute_annotation(a, at)
+            with self.controller.batch():
+                for a in l:
+                    self.controller.transmute_annotation(a, at)
         return True
 
     def search_replace(self, *p):
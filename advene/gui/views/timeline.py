@@ -672,7 +672,7 @@ class TimeLine(AdhocView):
         for t in l:
             w=t[0]
             # Iterate only on the first one (if any)
-            png=self.controller.gui.imagecache.get(pos)
+            png=self.controller.gui.imagecache.get(pos, height=self.scale_layout.height, raw=True)
             w.set_from_pixbuf(png_to_pixbuf (png, height=self.scale_layout.height))
             w.timestamp=png.timestamp
             break
@@ -1174,11 +1174,12 @@ class TimeLine(AdhocView):
             return self.transmuted_annotation
 
         def copy_selection(i, sel, typ, delete=False):
-            for an in sel:
-                # FIXME: if sel.typ == an.typ
-                self.transmuted_annotation=self.controller.transmute_annotation(an,
-                                                                                typ,
-                                                                                delete=delete)
+            with self.controller.batch():
+                for an in sel:
+                    # FIXME: if sel.typ == an.typ
+                    self.transmuted_annotation=self.controller.transmute_annotation(an,
+                                                                                    typ,
+                                                                                    delete=delete)
             self.unselect_all()
             return self.transmuted_annotation
 
@@ -1308,54 +1309,52 @@ class TimeLine(AdhocView):
         """Display a popup menu to copy the source annotation type to the dest annotation type.
         """
         def copy_annotations(i, at, typ, delete=False):
-            # More than 50 annotations takes too much time to notify
-            # individually. In this case, deactive individual
-            # notifications and notify an UpdateModel at the end
-            notify=not len(at.annotations) > 50
-            for an in at.annotations:
-                self.transmuted_annotation=self.controller.transmute_annotation(an,
-                                                                                typ,
-                                                                                delete=delete,
-                                                                                notify=notify)
-            if not notify:
-                 self.controller.notify('PackageActivate', package=self.controller.package)
+            # The batch section takes care of rebuilding the views
+            # once, rather than updating them for each annotation, if
+            # there are too many of them
+            with self.controller.batch():
+                for an in at.annotations:
+                    self.transmuted_annotation=self.controller.transmute_annotation(an,
+                                                                                    typ,
+                                                                                    delete=delete)
             return self.transmuted_annotation
 
         def copy_annotations_filtered(i, at, typ, delete=False):
             s=dialog.entry_dialog(title=_("Annotation filter"),
                                   text=_("Enter the searched string"))
             if s:
-                for an in at.annotations:
-                    if s in an.content.data:
-                        self.transmuted_annotation=self.controller.transmute_annotation(an,
-                                                                                        typ,
-                                                                                        delete=delete)
+                with self.controller.batch():
+                    for an in at.annotations:
+                        if s in an.content.data:
+                            self.transmuted_annotation=self.controller.transmute_annotation(an,
+                                                                                            typ,
+                                                                                            delete=delete)
             return self.transmuted_annotation
 
         def DTWalign_annotations(i, at, typ, mode, delete=True):
-            sa = at.annotations
-            sa.sort(key=lambda a: a.begin)
-            da = typ.annotations
-            da.sort(key=lambda a: a.begin)
+            # Work on columns rather than on annotations, since the
+            # bounds are accessed len(sb)*len(db) times
+            st = self.controller.package.all.get_annotation_table(type=at)
+            dt = self.controller.package.all.get_annotation_table(type=typ)
+            sb, se, sd = st.begins.tolist(), st.ends.tolist(), st.durations().tolist()
+            db, de, dd = dt.begins.tolist(), dt.ends.tolist(), dt.durations().tolist()
             bestpath = []
             bestdist = []
 
-            mindist = (abs(sa[0].begin - da[0].begin)
-                       + abs(sa[0].end - da[0].end) 
-                       + abs((sa[0].end - sa[0].begin) 
-                             - (da[0].end - da[0].begin)))
+            mindist = (abs(sb[0] - db[0])
+                       + abs(se[0] - de[0])
+                       + abs(sd[0] - dd[0]))
             bestdist.append(mindist)
             bestpath.append([])
             bestpath[0].append(0)
             
-            for j in range(1,len(sa)):
+            for j in range(1,len(sb)):
                 bestpath.append([])
                 bestpath[j].append(j)
 
-                dist = (abs(sa[j].begin - da[0].begin)
-                        + abs(sa[j].end - da[0].end) 
-                        + abs((sa[j].end - sa[j].begin)
-                              - (da[0].end - da[0].begin)))
+                dist = (abs(sb[j] - db[0])
+                        + abs(se[j] - de[0])
+                        + abs(sd[j] - dd[0]))
                 if dist < mindist:
                     mindist = dist
                     bestpath[j] = [j]
@@ -1364,16 +1363,15 @@ class TimeLine(AdhocView):
                     bestpath[j] = list(bestpath[j-1])
                     bestdist.append(bestdist[j-1] + dist)
             
-            for i in range(1,len(da)):
+            for i in range(1,len(db)):
                 currentdist = 0
                 prevsubdist = 0
                 currentpath = []
                 prevsubpath = []
-                for j in range(0,len(sa)):
-                    dist = (abs(sa[j].begin - da[i].begin)
-                            + abs(sa[j].end - da[i].end) 
-                            + abs((sa[j].end - sa[j].begin) 
-                                  - (da[i].end - da[i].begin)))
+                for j in range(0,len(sb)):
+                    dist = (abs(sb[j] - db[i])
+                            + abs(se[j] - de[i])
+                            + abs(sd[j] - dd[i]))
                     
                     if j == 0:
                         currentpath = list(bestpath[0])
@@ -1411,14 +1409,14 @@ class TimeLine(AdhocView):
 
             # Update annotation timestamp/contents
             batch_id=object()
-            for (i,j) in enumerate(bestpath[len(sa)-1]):
-                annotation=da[i]
+            for (i,j) in enumerate(bestpath[len(sb)-1]):
+                annotation=dt.get_annotation(i)
                 self.controller.notify('EditSessionStart', element=annotation, immediate=True)
                 if mode == 'time':
-                    annotation.begin = sa[j].begin
-                    annotation.end = sa[j].end
+                    annotation.begin = sb[j]
+                    annotation.end = se[j]
                 elif mode == 'content':
-                    annotation.content.data = sa[j].content.data
+                    annotation.content.data = st.get_annotation(j).content.data
                 self.controller.notify('AnnotationEditEnd', annotation=annotation, batch=batch_id)
                 self.controller.notify('EditSessionEnd', element=annotation)
             return True
@@ -2026,7 +2024,7 @@ class TimeLine(AdhocView):
             ic=self.controller.gui.imagecache
             if ic is None:
                 return False
-            png=ic.get(widget.mark, epsilon=step/2)
+            png=ic.get(widget.mark, epsilon=step/2, height=max(20, h), raw=True)
             if (png == ic.not_yet_available_image 
                 and 'async-snapshot' in self.controller.player.player_capabilities):
                 self.controller.update_snapshot(widget.mark)
@@ -3223,8 +3221,9 @@ class TimeLine(AdhocView):
                 sources=[ self.controller.package.get(uri) for uri in unicode(selection.data, 'utf8').split('\n') ]
                 if sources:
                     batch_id=object()
-                    for a in sources:
-                        self.controller.delete_element(a, batch=batch_id)
+                    with self.controller.batch():
+                        for a in sources:
+                            self.controller.delete_element(a, batch=batch_id)
                 return True
             return False
 
@@ -3549,8 +3548,9 @@ class TimeLine(AdhocView):
         if selection is None:
             selection=self.get_selected_annotation_widgets()
         batch_id=object()
-        for w in selection:
-            self.controller.delete_element(w.annotation, batch=batch_id)
+        with self.controller.batch():
+            for w in selection:
+                self.controller.delete_element(w.annotation, batch=batch_id)
         return True
 
     def selection_as_table(self, widget, selection):
@@ -56,7 +56,7 @@ except ImportError:
 
 import gtk
 
-from advene.util.snapshotter import Snapshotter
+from advene.util.snapshotter import Snapshotter, BatchSnapshotter
 try:
     import advene.util.svgoverlay
 except ImportError:
@@ -370,6 +370,35 @@ class Player:
         if self.snapshotter:
             self.snapshotter.enqueue(t)
         
+    def batch_snapshot(self, positions):
+        """Take snapshots for many positions at once.
+
+        The snapshots are taken by worker processes (see
+        L{BatchSnapshotter}), and passed to snapshot_notify as they come.
+        A batch still running is cancelled, and its remaining positions are
+        taken along with the new ones.
+        """
+        uri=self.player.get_property('uri')
+        if not uri or self.snapshotter is None:
+            return
+        positions=[ long(self.position2value(p)) for p in positions ]
+        previous=self.snapshotter.batch
+        if previous is not None and previous.is_running():
+            positions.extend(previous.remaining())
+            previous.cancel()
+        def notify(t, data):
+            if self.snapshot_notify:
+                self.snapshot_notify(Snapshot( { 'data': data,
+                                                 'type': 'PNG',
+                                                 'date': t,
+                                                 'width': 160,
+                                                 'height': 100 } ))
+        b=BatchSnapshotter(uri, notify,
+                           width=config.data.player['snapshot-width'],
+                           workers=config.data.player['snapshot-workers'] or None)
+        self.snapshotter.batch=b
+        b.start(positions)
+
     def snapshot(self, position):
         if not self.check_uri():
             return None
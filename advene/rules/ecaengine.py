@@ -48,6 +48,97 @@ class MyThread(threading.Thread):
         if self._target:
             self._target()
 
+class RuleIndex:
+    """Index of the rules associated to an event.
+
+    The conditions of the rules are analyzed (see
+    L{advene.rules.elements.Condition.get_prefilter}) so that the
+    rules which can not match the parameters of an event are skipped
+    without building a context: rules checking the type of an element
+    are indexed by type id, and other simple checks are done on the
+    event parameters themselves.
+
+    If a check can not be done (missing parameter, unexpected
+    element...), the rule is considered as a candidate, and its
+    condition will be evaluated normally.
+
+    @ivar skipped: the number of rules skipped by the index
+    @type skipped: int
+    """
+    def __init__(self, rules):
+        # Per-variable dict of the rules indexed by type id
+        self.types={}
+        # Rules which are not indexed by type
+        self.others=[]
+        self.skipped=0
+        for position, rule in enumerate(rules):
+            guards=self.get_prefilters(rule.condition)
+            for g in guards:
+                if g[0] == 'type':
+                    guards.remove(g)
+                    self.types.setdefault(g[1], {}).setdefault(g[2], []).append( (position, rule, guards) )
+                    break
+            else:
+                self.others.append( (position, rule, guards) )
+        self.size=len(rules)
+
+    def get_prefilters(self, condition):
+        """Return the list of prefilters which must hold for the condition to match.
+        """
+        if isinstance(condition, advene.rules.elements.ConditionList):
+            if condition.composition != 'and':
+                return []
+            conditions=condition
+        else:
+            conditions=[ condition ]
+        res=[]
+        for c in conditions:
+            try:
+                p=c.get_prefilter()
+            except AttributeError:
+                p=None
+            if p is not None:
+                res.append(p)
+        return res
+
+    def check(self, guard, kw):
+        """Check a prefilter against the event parameters.
+
+        Return False only if the prefilter can not hold.
+        """
+        operator, var, value=guard
+        try:
+            element=kw[var]
+            if operator == 'type':
+                return advene.rules.elements.convert_value(element.type.id) == value
+            elif operator == 'contains':
+                return value in element.content.data
+        except Exception:
+            pass
+        return True
+
+    def candidates(self, kw):
+        """Return the rules which may match the given event parameters.
+
+        They are returned in the order of the original rule list.
+        """
+        res=[]
+        for var, d in self.types.iteritems():
+            try:
+                key=advene.rules.elements.convert_value(kw[var].type.id)
+            except Exception:
+                for l in d.itervalues():
+                    res.extend(l)
+            else:
+                res.extend(d.get(key, ()))
+        res.extend(self.others)
+        rules=[ (position, rule)
+                for (position, rule, guards) in res
+                if all(self.check(g, kw) for g in guards) ]
+        rules.sort()
+        self.skipped += self.size - len(rules)
+        return [ rule for position, rule in rules ]
+
 class ECAEngine:
     """ECAEngine class.
 
@@ -61,10 +152,17 @@ class ECAEngine:
     indexed by class name ('internal', 'default', 'user'). Upon every
     update, it rebuilds the L{self.ruledict} dictionary, which is
     indexed by EventName and keeps a list of all rules associated to
-    this EventName.
+    this EventName, and the L{self.ruleindex} dictionary, which holds
+    a L{RuleIndex} for each EventName.
+
+    Note that the rules are analyzed when they are added to the
+    engine: if a rule condition is modified in place, update_rulesets
+    must be called.
 
     @ivar ruledict: the global rules dictionary, indexed by EventName
     @type ruledict: dict
+    @ivar ruleindex: the rule indexes, indexed by EventName
+    @type ruleindex: dict
     @ivar rulesets: dictionary holding the rules indexed by classname
     @type rulesets: dict
     @ivar controller: the Advene controller
@@ -84,6 +182,7 @@ class ECAEngine:
         """
         self.clear_state()
         self.ruledict = {}
+        self.ruleindex = {}
         # History of events
         self.event_history = []
         self.controller=controller
@@ -192,6 +291,9 @@ class ECAEngine:
         for type_ in ('internal', 'default', 'user'):
             for rule in self.rulesets[type_]:
                 self.ruledict.setdefault(rule.event, []).append(rule)
+        self.ruleindex.clear()
+        for event, rules in self.ruledict.iteritems():
+            self.ruleindex[event]=RuleIndex(rules)
 
     def schedule(self, action, context, delay=0, immediate=False):
         """Schedule an action for execution.
@@ -342,10 +444,24 @@ class ECAEngine:
             print "Trying to remove non-existant rule %s from %s ruleset" % (str(rule), type_)
             pass
 
+    def get_rule_statistics(self):
+        """Return statistics about the evaluation of the rule conditions.
+
+        @return: a list of (event name, rule name, evaluations, matches,
+                 total evaluation time in s) tuples, the most costly rules first
+        @rtype: list
+        """
+        res=[ (event, rule.name, rule.evaluations, rule.matches, rule.match_time)
+              for event, rules in self.ruledict.iteritems()
+              for rule in rules ]
+        res.sort(key=lambda t: t[4], reverse=True)
+        return res
+
     def dump(self):
         res=[]
         for k in sorted(self.ruledict.keys()):
-            res.append("%s: %s" % (k, len(self.ruledict[k])))
+            res.append("%s: %s (%d skipped)" % (k, len(self.ruledict[k]),
+                                                self.ruleindex[k].skipped))
         return res
             
     def notify (self, event_name, *param, **kw):
@@ -389,17 +505,26 @@ class ECAEngine:
             del kw['delay']
             print "Delay specified: %f" % delay
 
-        context=self.build_context(event_name, **kw)
         try:
-            a=self.ruledict[event_name]
+            index=self.ruleindex[event_name]
         except KeyError:
             return
+        candidates=index.candidates(kw)
+        if not candidates:
+            return
 
-        rules=sorted( (rule
-                       for rule in a
-                       if rule.condition.match(context) ),
-                      key=lambda e: e.priority,
-                      reverse=True)
+        context=self.build_context(event_name, **kw)
+        rules=[]
+        for rule in candidates:
+            t=time.time()
+            try:
+                if rule.condition.match(context):
+                    rules.append(rule)
+                    rule.matches += 1
+            finally:
+                rule.evaluations += 1
+                rule.match_time += time.time() - t
+        rules.sort(key=lambda e: e.priority, reverse=True)
 
         context.pushLocals()
         for rule in rules:
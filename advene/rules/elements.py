@@ -22,14 +22,19 @@ The event framework makes it possible to bind actions to specific
 events that match a condition."""
 
 import re
+import math
 import StringIO
 import urllib
 import itertools
 
 import xml.etree.ElementTree as ET
+from simpletal.simpleTALES import PathNotFoundException
 
 import advene.core.config as config
 from libadvene.model.cam.annotation import Annotation
+from libadvene.model.cam.consts import CAM_TYPE
+from libadvene.model.core.all_group import AllGroup
+from libadvene.model.core.own_group import OwnGroup
 
 from gettext import gettext as _
 
@@ -129,6 +134,76 @@ class ConditionList(list):
                     return True
             return False
 
+_simple_path=re.compile(r'^[A-Za-z_][\w-]*(/[\w-]+)*$')
+
+def compile_expression(expr):
+    """Compile a TALES expression into a function.
+
+    The returned function takes a context as parameter, and returns
+    the value of the expression in this context. Its constant
+    attribute is True if the expression does not depend on the
+    context (in which case None can be passed as context).
+
+    Only plain paths and string literals are actually compiled, other
+    expressions are evaluated through the context. As with evaluate,
+    a path which can not be traversed evaluates to None.
+    """
+    e=(expr or '').strip()
+    if e.startswith('string:') and not '$' in e:
+        value=e[7:].lstrip()
+        f=lambda context: value
+        f.constant=True
+        return f
+    if _simple_path.match(e) and e not in ('nothing', 'default'):
+        path=e.split('/')
+        def f(context):
+            try:
+                return context.traverse_path_list(path)
+            except PathNotFoundException:
+                return None
+    else:
+        f=lambda context: context.evaluate(expr)
+    f.constant=False
+    return f
+
+def convert_value(element, mode='begin'):
+    """Converts a value (Annotation or number) into a number.
+
+    Mode is used for Annotation and tells wether to consider begin or
+    end.
+    """
+    if isinstance(element, Annotation):
+        rv=getattr(element, mode)
+    else:
+        try:
+            rv=float(element)
+        except (ValueError, TypeError):
+            rv=element
+    return rv
+
+def _overlaps(left, right):
+    # left and right MUST be annotations
+    assert isinstance(left, Annotation), "overlap only applies to annotations (invalid left value)"
+    assert isinstance(right, Annotation), "overlap only applies to annotations (invalid right value)"
+    return (left.begin in right or right.begin in left)
+
+_binary_operators={
+    'equals': lambda l, r: convert_value(l, 'begin') == convert_value(r, 'begin'),
+    'different': lambda l, r: convert_value(l, 'begin') != convert_value(r, 'begin'),
+    'contains': lambda l, r: r in l,
+    # If it is possible to convert the values to floats, then do
+    # it. Else, compare string values
+    'greater': lambda l, r: convert_value(l, 'end') >= convert_value(r, 'begin'),
+    'lower': lambda l, r: convert_value(l, 'end') <= convert_value(r, 'begin'),
+    'before': lambda l, r: convert_value(l, 'end') <= convert_value(r, 'begin'),
+    'matches': lambda l, r: re.search(r, l),
+    'meets': lambda l, r: convert_value(l, 'end') == convert_value(r, 'begin'),
+    'overlaps': _overlaps,
+    'during': lambda l, r: l in r,
+    'starts': lambda l, r: convert_value(l, 'begin') == convert_value(r, 'begin'),
+    'finishes': lambda l, r: convert_value(l, 'end') == convert_value(r, 'end'),
+    }
+
 class Condition:
     """The Condition class.
 
@@ -179,77 +254,77 @@ class Condition:
         """Converts a value (Annotation or number) into a number.
         Mode is used for Annotation and tells wether to consider
         begin or end."""
-        if isinstance(element, Annotation):
-            rv=getattr(element, mode)
-        else:
-            try:
-                rv=float(element)
-            except ValueError:
-                rv=element
-        return rv
+        return convert_value(element, mode)
 
     def match(self, context):
         """Test if the condition matches the context."""
+        key=(self.lhs, self.operator, self.rhs)
+        if self._compiled_key != key:
+            self._compiled=self.compile()
+            self._compiled_key=key
+        return self._compiled(context)
+
+    # The compiled version of the condition (see compile), and the
+    # (lhs, operator, rhs) values it was compiled from
+    _compiled=None
+    _compiled_key=None
+
+    def compile(self):
+        """Compile the condition into a function.
+
+        The returned function takes a context as parameter, and
+        returns the same value as match. The TALES expressions and
+        the operator are analyzed once, so that matching does not
+        re-parse them.
+        """
         if self.operator in self.binary_operators:
-            # Binary operator
-            left=context.evaluate(self.lhs)
-            right=context.evaluate(self.rhs)
-            if self.operator == 'equals':
-                return self.convert_value(left) == self.convert_value(right)
-            elif self.operator == 'different':
-                return self.convert_value(left) != self.convert_value(right)
-            elif self.operator == 'contains':
-                return right in left
-            elif self.operator == 'greater':
-                # If it is possible to convert the values to
-                # floats, then do it. Else, compare string values
-                lv=self.convert_value(left, 'end')
-                rv=self.convert_value(right, 'begin')
-                return lv >= rv
-            elif self.operator == 'lower' or self.operator == 'before':
-                # If it is possible to convert the values to
-                # floats, then do it. Else, compare string values
-                lv=self.convert_value(left, 'end')
-                rv=self.convert_value(right, 'begin')
-                return lv <= rv
-            elif self.operator == 'matches':
-                return re.search(rv, lv)
-            elif self.operator == 'meets':
-                lv=self.convert_value(left, 'end')
-                rv=self.convert_value(right, 'begin')
-                return lv == rv
-            elif self.operator == 'overlaps':
-                # lv, rv MUST be annotations
-                assert isinstance(lv, Annotation), "overlap only applies to annotations (invalid left value)"
-                assert isinstance(rv, Annotation), "overlap only applies to annotations (invalid right value)"
-                lv=left
-                rv=right
-                return (lv.begin in rv or rv.begin in lv)
-            elif self.operator == 'during':
-                return lv in rv
-            elif self.operator == 'starts':
-                lv=self.convert_value(left, 'begin')
-                rv=self.convert_value(right, 'begin')
-                return lv == rv
-            elif self.operator == 'finishes':
-                lv=self.convert_value(left, 'end')
-                rv=self.convert_value(right, 'end')
-                return lv == rv
-            else:
-                raise Exception("Unknown operator: %s" % self.operator)
+            left=compile_expression(self.lhs)
+            right=compile_expression(self.rhs)
+            if self.operator == 'matches' and right.constant:
+                regexp=re.compile(right(None))
+                def compiled(context):
+                    return regexp.search(left(context))
+                return compiled
+            op=_binary_operators[self.operator]
+            def compiled(context):
+                return op(left(context), right(context))
+            return compiled
         elif self.operator in self.unary_operators:
-            # Unary operator
             # Note: self.rhs is ignored, whatever its value is.
-            left=context.evaluate(self.lhs)
+            left=compile_expression(self.lhs)
             if self.operator == 'not':
-                return not left
-            elif self.operator == 'value':
-                return left
+                def compiled(context):
+                    return not left(context)
+                return compiled
             else:
-                raise Exception("Unknown operator: %s" % self.operator)
+                return left
         else:
             raise Exception("Unknown operator: %s" % self.operator)
 
+    def get_prefilter(self):
+        """Return a description of the condition which can be checked
+        without building a context, or None.
+
+        The description is a tuple (operator, variable, value) where
+        operator is either 'type' (the id of the type of the element
+        named variable in the event parameters is value) or
+        'contains' (the content data of the element named variable
+        contains value).
+        """
+        if self.rhs is None or not self.lhs:
+            return None
+        right=compile_expression(self.rhs)
+        if not right.constant:
+            return None
+        path=self.lhs.strip().split('/')
+        if (self.operator == 'equals' and len(path) == 3
+            and path[1:] == ['type', 'id']):
+            return ('type', path[0], self.convert_value(right(None)))
+        elif (self.operator == 'contains' and len(path) == 3
+              and path[1:] == ['content', 'data']):
+            return ('contains', path[0], right(None))
+        return None
+
     def truematch(self, context):
         """Condition which always return True.
 
@@ -404,8 +479,18 @@ class Rule(EtreeMixin):
     @type origin: URL
     @ivar priority: the rule priority
     @type priority: int
+    @ivar evaluations: the number of evaluations of the condition by the ECAEngine
+    @type evaluations: int
+    @ivar matches: the number of evaluations which matched
+    @type matches: int
+    @ivar match_time: the total evaluation time of the condition (in s)
+    @type match_time: float
     """
 
+    evaluations=0
+    matches=0
+    match_time=0.0
+
     default_condition=Condition()
     default_condition.match=default_condition.truematch
     default_condition.composition='and'
@@ -660,6 +745,151 @@ class RuleSet(list, EtreeMixin):
             self.remove(s)
         return subviews
 
+# Temporal operators which can be translated into backend filters:
+# operator -> (mode of the left value, mode of the right value, comparison)
+# (see Condition.convert_value for the modes)
+_temporal_operators={
+    'equals': ('begin', 'begin', '='),
+    'greater': ('end', 'begin', '>='),
+    'lower': ('end', 'begin', '<='),
+    'before': ('end', 'begin', '<='),
+    'meets': ('end', 'begin', '='),
+    'starts': ('begin', 'begin', '='),
+    'finishes': ('end', 'end', '='),
+    }
+
+def _independent_expression(expr):
+    """Compile a TALES expression if it does not depend on the element.
+
+    Return None if the expression uses the 'element' variable, or may
+    use it.
+    """
+    f=compile_expression(expr)
+    if f.constant:
+        return f
+    e=expr.strip()
+    if _simple_path.match(e) and e.split('/')[0] != 'element':
+        return f
+    return None
+
+def _add_bound(filters, attr, comparison, value):
+    """Add a bound on the begin or end of the annotations to filters.
+
+    Return False if the bound can not be expressed as a backend filter.
+    """
+    if comparison == '=':
+        key=attr
+        if value != math.floor(value):
+            return False
+        value=long(value)
+    elif comparison == '>=':
+        key=attr + '_min'
+        value=long(math.ceil(value))
+    else:
+        key=attr + '_max'
+        value=long(math.floor(value))
+    # The backend ignores null values
+    if key in filters or not value:
+        return False
+    filters[key]=value
+    return True
+
+def _pushdown_condition(group, condition, context, filters, recheck):
+    """Try to translate a condition into iter_annotations filters.
+
+    The condition applies to the 'element' variable, iterating over
+    the annotations of group. If the condition is fully translated,
+    update the filters dict and return True. Translated conditions
+    which the backend can only check partially are appended to
+    recheck.
+    """
+    if (not isinstance(condition, Condition)
+        or not condition.operator in condition.binary_operators
+        or not condition.lhs or condition.rhs is None):
+        return False
+    right=_independent_expression(condition.rhs)
+    if right is None:
+        return False
+    path=condition.lhs.strip().split('/')
+    if path[0] != 'element':
+        return False
+    try:
+        value=right(context)
+    except Exception:
+        return False
+    op=condition.operator
+
+    if path == ['element', 'type', 'id'] and op == 'equals':
+        if (not isinstance(value, basestring)
+            or not hasattr(group, 'iter_annotation_types')):
+            # Not a CAM package
+            return False
+        v=convert_value(value)
+        types=[ t for t in group.owner.all.iter_annotation_types()
+                if convert_value(t.id) == v ]
+        if len(types) != 1:
+            return False
+        filters.setdefault('meta', []).append( (CAM_TYPE, types[0]) )
+        return True
+
+    elif path == ['element', 'content', 'data'] and op == 'contains':
+        if (not isinstance(value, basestring) or not value
+            or 'data_contains' in filters):
+            return False
+        filters['data_contains']=value
+        # The data of external contents is not checked by the backend
+        recheck.append(condition)
+        return True
+
+    elif len(path) == 4 and path[1] == 'meta' and op == 'equals':
+        # Numerical values are compared as floats
+        if (not isinstance(value, basestring)
+            or convert_value(value) is not value):
+            return False
+        if isinstance(group, AllGroup):
+            packages=[ p
+                       for be, pdict in group.owner._backends_dict.items()
+                       for p in pdict.itervalues() ]
+        else:
+            packages=[ group.owner ]
+        uris=set( p._get_ns_dict().get(path[2]) for p in packages )
+        if len(uris) != 1 or None in uris:
+            return False
+        filters.setdefault('meta', []).append( (uris.pop() + path[3], value) )
+        return True
+
+    elif path == ['element'] and op in ('overlaps', 'during'):
+        if not isinstance(value, Annotation):
+            return False
+        if op == 'overlaps':
+            bounds=( ('begin', '<=', value.end), ('end', '>=', value.begin) )
+        else:
+            bounds=( ('begin', '>=', value.begin), ('end', '<=', value.end) )
+
+    elif (path in (['element'], ['element', 'begin'], ['element', 'end'])
+          and op in _temporal_operators):
+        lmode, rmode, comparison=_temporal_operators[op]
+        if len(path) == 2:
+            lmode=path[1]
+        try:
+            v=convert_value(value, rmode)
+        except TypeError:
+            return False
+        if not isinstance(v, (int, long, float)):
+            return False
+        bounds=( (lmode, comparison, v), )
+
+    else:
+        return False
+
+    # Temporal bounds: translate all of them, or none
+    f=dict(filters)
+    for attr, comparison, v in bounds:
+        if not _add_bound(f, attr, comparison, v):
+            return False
+    filters.update(f)
+    return True
+
 class SimpleQuery(EtreeMixin):
     """SimpleQuery component.
 
@@ -756,9 +986,49 @@ class SimpleQuery(EtreeMixin):
 
         return qnode
 
+    def plan(self, source, context):
+        """Plan the evaluation of the condition on a source.
+
+        If the source is a group of annotations stored in backends,
+        the conditions which can be checked by the backend (annotation
+        type, begin and end bounds, temporal operators with a given
+        annotation, content data substring, metadata equality) are
+        translated into iter_annotations filters, so that only the
+        candidate annotations are built.
+
+        @param source: the evaluated source of the query
+        @param context: the context of the query
+        @return: None if nothing can be translated, else a tuple
+                 (elements, residual condition, recheck condition),
+                 where the recheck condition must only be checked on
+                 elements with an external content.
+        """
+        group=getattr(source, '_group', None)
+        if not isinstance(group, (OwnGroup, AllGroup)):
+            return None
+        if isinstance(self.condition, ConditionList):
+            if self.condition.composition != 'and':
+                return None
+            conditions=self.condition
+        else:
+            conditions=[ self.condition ]
+
+        filters={}
+        residual=ConditionList()
+        recheck=ConditionList()
+        for condition in conditions:
+            if not _pushdown_condition(group, condition, context, filters, recheck):
+                residual.append(condition)
+        if not filters:
+            return None
+        return (group.iter_annotations(**filters), residual, recheck)
+
     def execute(self, context):
         """Execute the query.
 
+        If possible, the condition is partly evaluated by the backend
+        (see L{plan}).
+
         @return: the list of elements matching the query or a boolean
         """
         result=[]
@@ -782,10 +1052,17 @@ class SimpleQuery(EtreeMixin):
                 # It is either a real list or a Bundle
                 # (for isinstance(someBundle, list) == False !
                 # FIXME: should we use a Bundle ?
+                condition=self.condition
+                recheck=None
+                plan=self.plan(s, context)
+                if plan is not None:
+                    s, condition, recheck=plan
                 context.pushLocals()
                 for e in s:
                     context.setLocal('element', e)
-                    if self.condition.match(context):
+                    if recheck and e.content_url and not recheck.match(context):
+                        continue
+                    if condition.match(context):
                         if self.rvalue is None or self.rvalue == 'element':
                             result.append(e)
                         else:
@@ -42,6 +42,11 @@ import urllib
 import cgi
 import socket
 import imghdr
+import time
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from hashlib import md5
+from threading import Lock
+from weakref import ref, WeakKeyDictionary
 
 from gettext import gettext as _
 
@@ -54,6 +59,7 @@ import advene.util.helper as helper
 from libadvene.model.cam.package import Package
 from libadvene.model.tales import AdveneContext
 from libadvene.model.exceptions import NoSuchElementError, UnreachableImportError
+from libadvene.util.clock_cache import ClockCache
 import libadvene.util.session
 
 from simpletal.simpleTALES import PathNotFoundException
@@ -65,6 +71,204 @@ def remove_tales_prefix(name):
     else:
         return name
 
+class ResponseCache:
+    """Cache of the responses of the /packages folder.
+
+    Rendering a package element (evaluating the TALES expression, applying
+    the view and generating the navigation interface) is expensive, while
+    most requests ask for the same pages again and again. The rendered
+    responses are kept here, keyed on the package alias, the TALES path and
+    the query. The whole cache is cleared as soon as any loaded package is
+    modified.
+
+    Responses depending on the state of the application rather than on the
+    package are not cached: the use of such globals of the TALES context
+    (see L{volatile}) is recorded by L{watch} during the rendering. Responses
+    using the C{package} global (the current package of the controller) are
+    only valid as long as it remains the current package.
+
+    Each response is given an ETag and a Last-Modified date, so that
+    clients can revalidate their own copy with a conditional GET.
+
+    @ivar hits: the number of requests answered from the cache
+    @ivar misses: the number of rendered responses
+    """
+    # package signals which may change the result of a rendering
+    signals = ("modified", "modified-meta", "created", "media", "annotation",
+               "relation", "tag", "list", "import", "query", "view",
+               "resource", "package-closed")
+    # paths of the TALES context that prevent caching
+    volatile = ("player", "packages", "options/controller")
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        if size:
+            self._entries = ClockCache(size)
+        self._lock = Lock()
+        self._watched = WeakKeyDictionary()
+
+    def key(self, alias, tales, query, displaymode):
+        """Return the cache key of a request, or None if it is not cacheable.
+
+        Expressions starting with C{options} are never cached, since they
+        depend on the state of the application rather than on the package.
+        """
+        if not self.size or tales.startswith('options'):
+            return None
+        return (cherrypy.request.base, alias, tales,
+                displaymode,
+                tuple(sorted( (k, repr(v)) for k, v in query.iteritems() )))
+
+    def get(self, key, package, current):
+        """Return the (etag, date, mimetype, body) entry for key, or None.
+
+        @param package: the package of the request
+        @param current: the current package of the controller
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            # the alias may have been given to another package in the meantime
+            if entry is None or entry[0]() is not package \
+                    or (entry[1] is not None and entry[1]() is not current):
+                self.misses += 1
+                return None
+            # mark the entry as recently used, so that it is not evicted
+            self._entries.touch(key, entry)
+            self.hits += 1
+        finally:
+            self._lock.release()
+        return entry[2:]
+
+    def watch(self, context):
+        """Record the use of the application state by a rendering context.
+
+        This must be called on the contexts used to render the response
+        of the current request, before evaluating anything.
+        """
+        uses = self._uses()
+        context.globals = _WatchedDict(context.globals, uses)
+        options = dict.get(context.globals, 'options')
+        if isinstance(options, dict):
+            dict.__setitem__(context.globals, 'options',
+                             _WatchedDict(options, uses, 'options/'))
+
+    def forbid(self):
+        """Do not cache the response of the current request.
+
+        This is used for the error pages sent with a 200 status.
+        """
+        self._uses().add(None)
+
+    def _uses(self):
+        uses = getattr(cherrypy.request, 'advene_cache_uses', None)
+        if uses is None:
+            uses = cherrypy.request.advene_cache_uses = set()
+        return uses
+
+    def store(self, key, package, current, mimetype, body):
+        """Store a rendered response, and return its entry (see L{get}).
+
+        Return None if the response can not be cached (see L{watch} and
+        L{forbid}).
+        """
+        uses = self._uses()
+        if None in uses or any(v in uses for v in self.volatile):
+            return None
+        watched = list(self._watch_candidates(package))
+        if 'package' in uses and current is not None:
+            current_ref = ref(current)
+            watched.append(current)
+        else:
+            current_ref = None
+        for p in watched:
+            if p not in self._watched:
+                for s in self.signals:
+                    p.connect(s, self._invalidate)
+                self._watched[p] = True
+        entry = ('"%s"' % md5(body).hexdigest(), time.time(), mimetype, body)
+        self._lock.acquire()
+        try:
+            self._entries.touch(key, (ref(package), current_ref) + entry)
+        finally:
+            self._lock.release()
+        return entry
+
+    def _watch_candidates(self, package):
+        yield package
+        for p in package.all.iter_imports():
+            try:
+                yield p.package
+            except UnreachableImportError:
+                pass
+
+    def _invalidate(self, *args):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Drop all the cached responses."""
+        if self.size:
+            self._invalidate()
+
+    def send(self, entry):
+        """Send the headers of a cached entry, and return the response body.
+
+        If the request is a conditional GET matching the entry, a Not
+        Modified (304) response is sent instead.
+        """
+        etag, date, mimetype, body = entry
+        headers = cherrypy.response.headers
+        headers['ETag'] = etag
+        headers['Last-Modified'] = formatdate(date, usegmt=True)
+        # clients may keep the response, but must revalidate it
+        headers['Cache-Control'] = 'no-cache'
+        if 'Pragma' in headers:
+            del headers['Pragma']
+        if self._not_modified(etag, date):
+            cherrypy.response.status = 304
+            if 'Content-type' in headers:
+                del headers['Content-type']
+            return ""
+        cherrypy.response.status = 200
+        headers['Content-type'] = mimetype
+        return body
+
+    def _not_modified(self, etag, date):
+        request_headers = cherrypy.request.headers
+        tags = request_headers.get('If-None-Match')
+        if tags is not None:
+            tags = [ t.strip() for t in tags.split(',') ]
+            return '*' in tags or etag in tags
+        since = request_headers.get('If-Modified-Since')
+        if since is not None:
+            since = parsedate_tz(since)
+            return since is not None and int(date) <= mktime_tz(since)
+        return False
+
+class _WatchedDict(dict):
+    """A copy of a dict recording which of its keys are read.
+
+    The keys are added to the set C{uses}, with the given prefix.
+    """
+    def __init__(self, d, uses, prefix=''):
+        dict.__init__(self, d)
+        self._uses = uses
+        self._prefix = prefix
+
+    def __getitem__(self, key):
+        self._uses.add(self._prefix + key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        self._uses.add(self._prefix + key)
+        return dict.get(self, key, default)
+
 DEBUG=True
 class Common:
     """Common functionalities for all cherrypy nodes.
@@ -487,6 +691,9 @@ class Packages(Common):
                          its specific mime-type
           - C{default} : default mode, with navigation interface
 
+        For snapshots, an optional C{width} parameter selects a reduced
+        version of the image.
+
         The C{display mode} has a default value at the server level,
         wich can be set through the C{/admin} folder.
 
@@ -521,7 +728,9 @@ class Packages(Common):
         # Define the package as root package for the model layer
         libadvene.util.session.session.package=self.controller.package
 
+        cache = self.controller.server.response_cache
         context = self.controller.build_context (here=p, alias=alias)
+        cache.watch(context)
         context.pushLocals()
         context.setLocal('request', query)
         # FIXME: the following line is a hack for having qname-keys work
@@ -531,15 +740,18 @@ class Packages(Common):
         try:
             objet = context.evaluate(expr)
         except PathNotFoundException, e:
+            cache.forbid()
             self.start_html (_("Error"), duplicate_title=True, mode='navigation')
             res.append (_("""The TALES expression %s is not valid.""") % tales)
             res.append (unicode(e.args).encode('utf-8'))
             return "".join(res)
         except NoSuchElementError, e:
+            cache.forbid()
             self.start_html (_("Error"), duplicate_title=True)
             res.append (_("""The element %s cannot be found.""") % unicode(e))
             return "".join(res)
         except UnreachableImportError, e:
+            cache.forbid()
             self.start_html (_("Error"), duplicate_title=True)
             res.append (_("""The element %s is in a package which could not be imported.""") % unicode(e))
             return "".join(res)
@@ -551,6 +763,15 @@ class Packages(Common):
         #    # It is a viewable, so display it using the default view
         #    objet.view(context=context)
 
+        # Snapshots can be requested at a given width
+        if query.has_key('width'):
+            width = query.pop('width')
+            if hasattr(objet, 'thumbnail'):
+                try:
+                    objet = objet.thumbnail(int(width))
+                except ValueError:
+                    pass
+
         displaymode = self.controller.server.displaymode
         # Hack to automatically switch to an image view for image objects.
         if query.has_key('mode'):
@@ -564,6 +785,7 @@ class Packages(Common):
         if hasattr (objet, 'view') and callable (objet.view):
 
             context = self.controller.build_context(here=objet, alias=alias)
+            cache.watch(context)
             context.pushLocals()
             context.setLocal('request', query)
             # FIXME: should be default view
@@ -577,6 +799,7 @@ class Packages(Common):
                     res.append( self.start_html(mimetype=v.contenttype, mode='raw') )
                     res.append(v)
             except PathNotFoundException, e:
+                cache.forbid()
                 res.append( self.start_html(_("Error")) )
                 res.append(_("<h1>Error</h1>"))
                 res.append(_("""<p>There was an error in the TALES expression.</p>
@@ -600,10 +823,12 @@ class Packages(Common):
                     res.append(str(objet))
                     return res
             except PathNotFoundException, e:
+                cache.forbid()
                 res.append(_("<h1>Error</h1>"))
                 res.append(_("""<p>There was an error.</p>
                 <pre>%s</pre>""") % cgi.escape(unicode(e.args[0]).encode('utf-8')))
             except TemplateParseException, e:
+                cache.forbid()
                 res.append(_("<h1>Error</h1>"))
                 res.append(_("""<p>There was an error in the template code.</p>
                 <p>Tag name: <strong>%(tagname)s</strong></p>
@@ -731,8 +956,26 @@ class Packages(Common):
         if cherrypy.request.method != 'GET':
             return self.send_error(400, 'Unknown method: %s' % cherrypy.request.method)
 
+        cache = self.controller.server.response_cache
+        key = cache.key(pkgid, tales, query, self.controller.server.displaymode)
+        if key is not None:
+            entry = cache.get(key, p, self.controller.package)
+            if entry is not None:
+                return cache.send(entry)
+
         try:
-            return self.display_package_element (p , tales, query)
+            res = self.display_package_element (p , tales, query)
+            if key is not None and cherrypy.response.status == 200:
+                if isinstance(res, list) \
+                        and all(isinstance(r, str) for r in res):
+                    res = "".join(res)
+                if isinstance(res, str):
+                    entry = cache.store(key, p, self.controller.package,
+                                        cherrypy.response.headers['Content-type'],
+                                        res)
+                    if entry is not None:
+                        return cache.send(entry)
+            return res
         except TemplateParseException, e:
             res=[ self.start_html(_("Error")) ]
             res.append(_("<h1>Error</h1>"))
@@ -848,6 +1091,7 @@ class AdveneWebServer:
         self.controller=controller
         self.urlbase = u"http://localhost:%d/" % port
         self.displaymode = config.data.webserver['displaymode']
+        self.response_cache = ResponseCache(config.data.webserver['cache-size'])
 
         settings = {
             'global': {
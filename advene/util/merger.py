@@ -31,6 +31,8 @@ import advene.core.config as config
 from libadvene.model.cam.package import Package
 from libadvene.model.cam.annotation import Annotation
 from libadvene.model.cam.relation import Relation
+from libadvene.model.core.element import ANNOTATION, RELATION, VIEW, QUERY
+from libadvene.model.core.diff import update_fingerprints, iter_changed_ids
 
 class Differ:
     """Returns a structure diff of two packages.
@@ -44,13 +46,29 @@ class Differ:
         # key is the id in the source package, the value the (new) id
         # in the destination package.
         self.translated_ids = {}
+        # packages whose fingerprints could not be updated by diff
+        self.stale_packages = []
 
     def diff(self):
         """Iterator returning a changelist.
 
         Structure of returned elements:
         (action_name, source_element, dest_element, action)
+
+        Annotations, relations, views and queries are first compared
+        through their fingerprints, so that only the modified elements
+        are compared attribute by attribute.
+
+        Note that the missing fingerprints of writable packages are
+        computed and stored in their backends beforehand (see
+        libadvene.model.core.diff.update_fingerprints). The packages
+        whose fingerprints could not be updated (read-only packages
+        for instance) are listed in self.stale_packages: their
+        elements without fingerprint are always compared attribute
+        by attribute.
         """
+        self.stale_packages=[ p for p in (self.source, self.destination)
+                              if not update_fingerprints(p) ]
         for m in (self.diff_schemas,
                   self.diff_annotation_types,
                   self.diff_relation_types,
@@ -163,12 +181,26 @@ class Differ:
                 yield ('new', s, None, lambda s, d: self.copy_relation_type(s) )
 
 
+    def iter_changed(self, element_type):
+        """Iterate over the own elements of the source which are not
+        identical in the destination.
+
+        Yield (source_element, destination_element) pairs, where
+        destination_element is None if it does not exist.
+        """
+        for id_, in_source, in_destination in iter_changed_ids(self.source,
+                                                               self.destination,
+                                                               element_type):
+            if not in_source:
+                continue
+            d=None
+            if in_destination:
+                d=self.destination.get(id_)
+            yield self.source.get(id_), d
+
     def diff_annotations(self):
-        ids = dict([ (s.id, s) for s in self.destination.own.annotations ])
-        self.source_ids['annotations']=ids
-        for s in self.source.own.annotations:
-            if s.id in ids:
-                d=ids[s.id]
+        for s, d in self.iter_changed(ANNOTATION):
+            if d is not None:
                 for c in self.diff_generic('annotation', s, d):
                     yield c
                     if c[0].startswith('new_'):
@@ -179,11 +211,8 @@ class Differ:
 
 
     def diff_relations(self):
-        ids = dict([ (s.id, s) for s in self.destination.own.relations ])
-        self.source_ids['relations']=ids
-        for s in self.source.own.relations:
-            if s.id in ids:
-                d=ids[s.id]
+        for s, d in self.iter_changed(RELATION):
+            if d is not None:
                 for c in self.diff_generic('relation', s, d):
                     yield c
                     if c[0].startswith('new_'):
@@ -198,12 +227,9 @@ class Differ:
                 yield ('new', s, None, lambda s, d: self.copy_relation(s) )
 
     def diff_views(self):
-        ids = dict([ (s.id, s) for s in self.destination.own.views ])
-        self.source_ids['views']=ids
-        for s in self.source.own.views:
-            if s.id in ids:
+        for s, d in self.iter_changed(VIEW):
+            if d is not None:
                 # Present. Check if it was modified
-                d=ids[s.id]
                 for c in self.diff_generic('view', s, d):
                     yield c
                     if c[0].startswith('new_'):
@@ -212,12 +238,9 @@ class Differ:
                 yield ('new', s, None, lambda s, d: self.copy_view(s) )
 
     def diff_queries(self):
-        ids = dict([ (s.id, s) for s in self.destination.own.queries ])
-        self.source_ids['queries']=ids
-        for s in self.source.own.queries:
-            if s.id in ids:
+        for s, d in self.iter_changed(QUERY):
+            if d is not None:
                 # Present. Check if it was modified
-                d=ids[s.id]
                 for c in self.diff_generic('query', s, d):
                     yield c
                     if c[0].startswith('new_'):
@@ -28,16 +28,25 @@ Command-line usage:
 snapshotter.py file://uri/to/movie/file.avi 1200 2400 4600
 
 This will capture snapshots for the given timestamps (in ms) and save them into /tmp.
+
+Batch usage:
+snapshotter.py --batch [--width=160] file://uri/to/movie/file.avi < timestamps
+
+This reads timestamps (one per line) on stdin, and writes the snapshots on
+stdout as a sequence of records (see L{RECORD}). It is used by
+L{BatchSnapshotter} to run worker processes.
 """
 import sys
 import os
+import struct
+import subprocess
 
 import gobject
 import gst
 import gtk
 gtk.gdk.threads_init ()
 
-from threading import Event, Thread
+from threading import Event, Thread, Lock
 import Queue
 try:
     from evaluator import Evaluator
@@ -86,6 +95,34 @@ class NotifySink(gst.BaseSink):
 gst.element_register(NotifySink, 'notifysink')
 gobject.type_register(NotifySink)
 
+# Header of the records written by batch workers: the timestamp (in ms),
+# then the length of the PNG data which follows.
+RECORD=struct.Struct('>qI')
+
+def plan_batch(timestamps, epsilon=0, workers=1):
+    """Prepare timestamps for batch extraction.
+
+    The timestamps are sorted, and those closer than epsilon to the
+    previous one are dropped. The result is then split into at most
+    workers contiguous chunks, so that each worker moves forward in its
+    own part of the movie.
+
+    @return: a list of sorted lists of timestamps
+    """
+    l=[]
+    for t in sorted(set(long(t) for t in timestamps)):
+        if not l or t - l[-1] > epsilon:
+            l.append(t)
+    workers=max(1, min(workers, len(l)))
+    size, extra=divmod(len(l), workers)
+    chunks=[]
+    start=0
+    for i in xrange(workers):
+        end=start + size + (i < extra)
+        chunks.append(l[start:end])
+        start=end
+    return [ c for c in chunks if c ]
+
 class Snapshotter(object):
     """Snapshotter class.
 
@@ -102,12 +139,29 @@ class Snapshotter(object):
     * call gtk.gdk.threads_init() at the beginning of you application
     * invoke the "start" method to start the thread.
     """
+    # Timestamps closer than this (in ms) after the current position are
+    # reached by decoding the following frames rather than by seeking.
+    step_threshold=2000
+
+    # Time (in s) to wait for a snapshot in a batch, before giving up.
+    batch_timeout=10
+
+    # Maximum distance (in ms) between a timestamp requested by
+    # process_batch and the frame captured for it. It must be larger
+    # than the duration of a frame.
+    position_tolerance=100
+
     def __init__(self, notify=None, width=None):
         self.notify=notify
         # Snapshot queue handling
         self.timestamp_queue=Queue.Queue()
         self.snapshot_ready=Event()
         self.thread_running=False
+        # Position (in ms) of the last captured frame, and timestamp
+        # requested by process_batch
+        self.position=None
+        self.requested_timestamp=None
+        self.batch=None
 
         # Pipeline building
         videobin=gst.Bin()
@@ -178,6 +232,50 @@ class Snapshotter(object):
             print "Error when sending event"
         return True
 
+    def step(self, t):
+        """Move forward to a specific time by decoding the next frames.
+
+        This is cheaper than a seek when t is close to the current
+        position, since no keyframe has to be looked for.
+
+        @return: False if the step could not be done.
+        """
+        if (self.position is None
+            or not 0 < t - self.position <= self.step_threshold
+            or not hasattr(gst, 'event_new_step')):
+            return False
+        event = gst.event_new_step(gst.FORMAT_TIME,
+                                   long((t - self.position) * gst.MSECOND),
+                                   1.0, True, False)
+        return self.player.send_event(event)
+
+    def process_batch(self, timestamps):
+        """Capture snapshots for a sorted list of timestamps.
+
+        Each timestamp is reached by stepping if it is close to the
+        previous one (see L{step_threshold}), by seeking otherwise. The
+        timestamp being processed is available in
+        L{requested_timestamp} when notify is called. Frames which are too
+        far from it (see L{position_tolerance}), e.g. the frame of a
+        previous timestamp arriving after L{batch_timeout}, are dropped.
+
+        This method blocks until all snapshots are taken: it must not be
+        run from the thread running the main loop.
+        """
+        # Wait for the preroll of the first frame
+        self.snapshot_ready.wait(self.batch_timeout)
+        for t in timestamps:
+            self.snapshot_ready.clear()
+            self.requested_timestamp=t
+            if not self.step(t):
+                self.snapshot(t)
+            if not self.snapshot_ready.wait(self.batch_timeout):
+                print >> sys.stderr, "No snapshot for", t
+                # The current position is unknown: seek for the next one
+                self.position=None
+        self.requested_timestamp=None
+        return True
+
     def enqueue(self, *l):
         """Enqueue timestamps to capture.
         """
@@ -208,6 +306,12 @@ class Snapshotter(object):
         It processes the captured buffer and unlocks the
         snapshot_event to process further timestamps.
         """
+        position=buffer.timestamp / gst.MSECOND
+        t=self.requested_timestamp
+        if t is not None and abs(position - t) > self.position_tolerance:
+            # Late frame, for a timestamp that process_batch gave up
+            return True
+        self.position=position
         if self.notify is not None:
             self.notify(buffer)
         # We are ready to process the next snapshot
@@ -221,7 +325,163 @@ class Snapshotter(object):
         t.setDaemon(True)
         t.start()
 
+    def clear(self):
+        """Cancel all pending requests, including a running batch.
+        """
+        try:
+            while True:
+                self.timestamp_queue.get_nowait()
+        except Queue.Empty:
+            pass
+        if self.batch is not None:
+            self.batch.cancel()
+            self.batch=None
+
+class BatchSnapshotter(object):
+    """Extract many snapshots with several worker processes.
+
+    The timestamps are sorted, deduplicated and split across workers
+    (see L{plan_batch}). Each worker is a separate process running its
+    own pipeline (see the --batch option of this module), which sends
+    back PNG snapshots as they are taken. For each of them, notify is
+    called with the requested timestamp and the PNG data, from a reader
+    thread.
+
+    @ivar pending: the number of timestamps which are not processed yet
+    """
+    def __init__(self, uri, notify, width=None, workers=None, epsilon=0):
+        self.uri=uri
+        self.notify=notify
+        self.width=width
+        if workers is None:
+            try:
+                import multiprocessing
+                workers=multiprocessing.cpu_count()
+            except (ImportError, NotImplementedError):
+                workers=1
+        self.workers=workers
+        self.epsilon=epsilon
+        self.pending=0
+        self._processes=[]
+        self._remaining=set()
+        self._lock=Lock()
+
+    def start(self, timestamps):
+        """Start extracting snapshots for the given timestamps.
+        """
+        script=os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        command=[ sys.executable, script, '--batch' ]
+        if self.width is not None:
+            command.append('--width=%d' % self.width)
+        command.append(self.uri)
+        for chunk in plan_batch(timestamps, self.epsilon, self.workers):
+            p=subprocess.Popen(command, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE)
+            self._lock.acquire()
+            try:
+                self.pending += len(chunk)
+                self._remaining.update(chunk)
+                self._processes.append(p)
+            finally:
+                self._lock.release()
+            t=Thread(target=self._read, args=(p, chunk))
+            t.setDaemon(True)
+            t.start()
+
+    def _read(self, process, chunk):
+        """Feed a worker with its timestamps, and read back the snapshots.
+        """
+        process.stdin.write("".join("%d\n" % t for t in chunk))
+        process.stdin.close()
+        out=process.stdout
+        size=RECORD.size
+        done=0
+        while True:
+            h=out.read(size)
+            if len(h) < size:
+                break
+            t, length=RECORD.unpack(h)
+            data=out.read(length)
+            if len(data) < length:
+                break
+            done += 1
+            self._lock.acquire()
+            self.pending -= 1
+            self._remaining.discard(t)
+            self._lock.release()
+            self.notify(t, data)
+        process.wait()
+        self._lock.acquire()
+        try:
+            # Forget timestamps for which no snapshot could be taken
+            self.pending -= len(chunk) - done
+            self._remaining.difference_update(chunk)
+            self._processes.remove(process)
+        finally:
+            self._lock.release()
+
+    def is_running(self):
+        return bool(self._processes)
+
+    def remaining(self):
+        """Return the timestamps still being processed.
+        """
+        self._lock.acquire()
+        try:
+            return list(self._remaining)
+        finally:
+            self._lock.release()
+
+    def cancel(self):
+        """Stop all the workers.
+        """
+        for p in list(self._processes):
+            try:
+                p.terminate()
+            except OSError:
+                # Already finished
+                pass
+
+def batch_worker(uri, width=None):
+    """Run a batch worker (see L{BatchSnapshotter}).
+
+    Timestamps are read from stdin, snapshots are written to stdout.
+    """
+    # Keep stdout for the snapshots, and redirect anything else to stderr
+    out=os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    timestamps=[ long(l) for l in sys.stdin if l.strip() ]
+
+    s=Snapshotter(width=width)
+    def write(buffer):
+        t=s.requested_timestamp
+        if t is not None:
+            out.write(RECORD.pack(t, len(buffer.data)))
+            out.write(buffer.data)
+            out.flush()
+    s.notify=write
+    s.set_uri(uri)
+
+    loop=gobject.MainLoop()
+    def run():
+        s.process_batch(timestamps)
+        gobject.idle_add(loop.quit)
+    t=Thread(target=run)
+    t.setDaemon(True)
+    t.start()
+    loop.run()
+    out.close()
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == [ '--batch' ]:
+        width=None
+        args=sys.argv[2:]
+        if args and args[0].startswith('--width='):
+            width=int(args.pop(0)[8:])
+        gobject.threads_init()
+        batch_worker(args[0], width)
+        sys.exit(0)
+
     try:
         uri=sys.argv[1]
         if uri.startswith('/'):
@@ -18,9 +18,12 @@ for which `_SqliteBackend` provides a reference implementation.
 from sqlite3 import dbapi2 as sqlite
 from os        import unlink
 from os.path   import exists
+from sys       import exc_info
+from threading import RLock, local
 from urllib    import url2pathname, pathname2url
 from weakref   import WeakKeyDictionary, WeakValueDictionary
 import re
+from hashlib import sha1
 
 from libadvene.model.backends.exceptions \
   import ClaimFailure, NoSuchPackage, InternalError, PackageInUse, WrongFormat
@@ -31,7 +34,7 @@ from libadvene.model.exceptions import ModelError
 from libadvene.util.reftools import WeakValueDictWithCallback
 
 
-BACKEND_VERSION = "1.2"
+BACKEND_VERSION = "1.5"
 
 IN_MEMORY_URL = "sqlite:%3Amemory%3A"
 
@@ -107,8 +110,10 @@ def claims_for_create(url):
         except Exception, e:
             return ClaimFailure(e)
         if cx is None: return ClaimFailure(WrongFormat(path))
-        r = not _contains_package(cx, pkgid)
-        cx.close()
+        try:
+            r = not _contains_package(cx, pkgid)
+        finally:
+            cx.close()
         return r or ClaimFailure(PackageInUse(url))
 
 def create(package, force=False, url=None):
@@ -142,6 +147,8 @@ def create(package, force=False, url=None):
     else:
         # check the following *before* sqlite.connect creates the file!
         must_init = (path == ":memory:" or not exists(path))
+        if not must_init:
+            _upgrade_file(path)
         conn = sqlite.connect(path, isolation_level=None, check_same_thread=False)
         curs = conn.cursor()
         curs.execute("BEGIN EXCLUSIVE")
@@ -169,12 +176,12 @@ def create(package, force=False, url=None):
                          (pkgid, "", "",))
         b._bind(pkgid, package)
     except sqlite.Error, e:
-        curs.execute("ROLLBACK")
+        b._rollback()
         raise InternalError("could not update", e)
     except:
-        curs.execute("ROLLBACK")
+        b._rollback()
         raise
-    curs.execute("COMMIT")
+    b._commit()
     return b, pkgid
 
 def claims_for_bind(url):
@@ -214,8 +221,10 @@ def claims_for_bind(url):
     if cx is None:
         return ClaimFailure(WrongFormat(path))
     # check that file does contains the required pkg
-    r = _contains_package(cx, pkgid)
-    cx.close()
+    try:
+        r = _contains_package(cx, pkgid)
+    finally:
+        cx.close()
     return r or ClaimFailure(NoSuchPackage(url))
 
 def bind(package, force=False, url=None):
@@ -245,19 +254,21 @@ def bind(package, force=False, url=None):
     path, pkgid = _strip_url(url)
     b = _cache.get(path)
     if b is None:
-        conn = sqlite.connect(path, isolation_level=None)
+        _upgrade_file(path)
+        conn = sqlite.connect(path, isolation_level=None,
+                              check_same_thread=False)
         b = _SqliteBackend(path, conn, force)
         _cache[path] = b
     b._begin_transaction("EXCLUSIVE")
     try:
         b._bind(pkgid, package)
     except InternalError:
-        b._curs.execute("ROLLBACK")
+        b._rollback()
         raise
     except:
-        b._curs.execute("ROLLBACK")
+        b._rollback()
         raise
-    b._curs.execute("COMMIT")
+    b._commit()
     return b, pkgid
 
 
@@ -279,18 +290,115 @@ def _strip_url(url):
     path = url2pathname(path)
     return path, pkgid
 
-def _get_connection(path):
+def _get_connection(path, upgrade=False):
+    """
+    Return a connection to the database at `path`, or None if it is not a
+    database created by this backend.
+
+    If the database has an older version, it is upgraded if `upgrade` is
+    set; else, it is only checked that an upgrade path exists. Note that
+    claims never upgrade databases, so that they have no side effect: this
+    is done by `create` and `bind`.
+    """
     try:
         cx = sqlite.connect(path)
-        c = cx.execute("SELECT version FROM Version")
-        for v in c:
-            if v[0] != BACKEND_VERSION: return None
-        return cx
-
-    except sqlite.DatabaseError:
-        return None
-    except sqlite.OperationalError:
+    except sqlite.Error:
         return None
+    ok = False
+    try:
+        try:
+            for v, in cx.execute("SELECT version FROM Version").fetchall():
+                if v == BACKEND_VERSION:
+                    continue
+                if upgrade:
+                    if not _upgrade(cx, v):
+                        return None
+                elif _upgrade_statements(v) is None:
+                    return None
+            ok = True
+        except sqlite.Error:
+            return None
+    finally:
+        if not ok:
+            cx.close()
+    return cx
+
+def _upgrade_file(path):
+    """
+    Upgrade the database at `path` if required.
+
+    Raise WrongFormat if it is not a database created by this backend, or
+    if it could not be upgraded.
+    """
+    cx = _get_connection(path, upgrade=True)
+    if cx is None:
+        raise WrongFormat(path)
+    cx.close()
+
+def _upgrade_statements(version):
+    """
+    Return the statements upgrading a database from the given version to
+    BACKEND_VERSION, following `sqlite_init.upgrades`, or None if no upgrade
+    path exists.
+    """
+    statements = []
+    while version != BACKEND_VERSION:
+        step = sqlite_init.upgrades.get(version)
+        if step is None:
+            return None
+        version, step_statements = step
+        statements.extend(step_statements)
+    return statements
+
+def _upgrade(cx, version):
+    """
+    Upgrade the database behind connection `cx` from the given version to
+    BACKEND_VERSION.
+
+    Return True on success, False if no upgrade path exists or if the database
+    could not be modified (in which case it is left unchanged). The connection
+    is not closed in either case.
+    """
+    statements = _upgrade_statements(version)
+    if statements is None:
+        return False
+
+    isolation_level = cx.isolation_level
+    cx.isolation_level = None # we manage the transaction ourselves
+    try:
+        try:
+            cx.execute("BEGIN EXCLUSIVE")
+        except sqlite.Error:
+            return False
+        try:
+            for sql in statements:
+                cx.execute(sql)
+            cx.execute("UPDATE Version SET version = ?", (BACKEND_VERSION,))
+        except sqlite.Error:
+            cx.execute("ROLLBACK")
+            return False
+        cx.execute("COMMIT")
+        return True
+    finally:
+        cx.isolation_level = isolation_level
+
+# the tables holding the data of a package (the other tables are maintained
+# from them by triggers); the first column of each is the package id
+_COPIED_TABLES = [
+    "Elements", "Meta", "Contents", "Medias", "Annotations",
+    "RelationMembers", "ListItems", "Imports", "Tagged",
+]
+
+def _copy_rows(src, src_pkgid, dst, dst_pkgid, table):
+    """
+    Copy all the rows of `table` concerning package `src_pkgid` in connection
+    `src` to package `dst_pkgid` in connection `dst`.
+    """
+    c = src.execute("SELECT * FROM %s WHERE package = ?" % table,
+                    (src_pkgid,))
+    q = "INSERT INTO %s VALUES (%s)" % \
+        (table, ",".join("?" for i in c.description))
+    dst.executemany(q, ( (dst_pkgid,) + r[1:] for r in c ))
 
 def _contains_package(cx, pkgid):
     c = cx.execute("SELECT id FROM Packages WHERE id = ?", (pkgid,))
@@ -318,6 +426,27 @@ def _split_uri_ref(uri_ref):
     sharp = uri_ref.find("#")
     return uri_ref[:sharp], uri_ref[sharp+1:]
 
+def _fulltext_expression(all_of=(), any_of=(), none_of=()):
+    """
+    Build a query of the full-text index matching the data that contain all
+    the strings in all_of, at least one of those in any_of, and none of those
+    in none_of.
+
+    Strings shorter than 3 characters can not be searched in the index, so
+    they are ignored. Return None if nothing can be pre-selected.
+    """
+    phrase = lambda s: '"%s"' % s.replace('"', '""')
+    pos = [ phrase(s) for s in all_of if len(s) >= 3 ]
+    if any_of and min( len(s) for s in any_of ) >= 3:
+        pos.append("(%s)" % " OR ".join( phrase(s) for s in any_of ))
+    if not pos:
+        return None
+    expr = " AND ".join(pos)
+    neg = [ phrase(s) for s in none_of if len(s) >= 3 ]
+    if neg:
+        expr = "(%s) NOT (%s)" % (expr, " OR ".join(neg))
+    return expr
+
 
 class _SqliteBackend(object):
     """I am the reference implementation of advene backend instances.
@@ -380,7 +509,7 @@ class _SqliteBackend(object):
         # for the sake of completeness only: this should not be useful, since
         # the URL is told to the backend by the package itself
         q = "SELECT url FROM Packages WHERE id = ?"
-        return self._curs.execute(q, (package_id,)).fetchone()[0]
+        return self._rcurs.execute(q, (package_id,)).fetchone()[0]
 
     def update_url(self, package_id, uri):
         q = "UPDATE Packages SET url = ? WHERE id = ?"
@@ -392,7 +521,7 @@ class _SqliteBackend(object):
 
     def get_uri(self, package_id):
         q = "SELECT uri FROM Packages WHERE id = ?"
-        return self._curs.execute(q, (package_id,)).fetchone()[0]
+        return self._rcurs.execute(q, (package_id,)).fetchone()[0]
 
     def update_uri(self, package_id, uri):
         q = "UPDATE Packages SET uri = ? WHERE id = ?"
@@ -449,15 +578,72 @@ class _SqliteBackend(object):
                 execute("DELETE FROM Imports WHERE package = ?", args)
                 execute("DELETE FROM Tagged WHERE package = ?", args)
             except sqlite.Error, e:
-                execute("ROLLBACK")
+                self._rollback()
                 raise InternalError("could not delete", e)
             except:
-                execute("ROLLBACK")
+                self._rollback()
                 raise
-            execute("COMMIT")
+            self._commit()
             del d[package_id]
         self._check_unused(package_id)
 
+    # bulk sections
+
+    def begin_bulk(self):
+        """Enter a bulk section.
+
+        All the modifications performed until the matching `end_bulk` are
+        done in a single transaction, and element identifiers are not checked
+        beforehand (their unicity is enforced by the primary key instead).
+        This is intended for massive insertions, typically by parsers.
+
+        A modification that fails before writing anything (e.g. because its
+        identifier is in use) does not affect the other modifications of the
+        section. If a modification fails after writing something, it can only
+        be cancelled with the whole section, so `end_bulk` will fail.
+
+        Bulk sections can be nested; only the outermost one is effective.
+        """
+        if self._bulk == 0:
+            self._begin_transaction("IMMEDIATE")
+        self._bulk += 1
+
+    def end_bulk(self):
+        """Exit a bulk section (see `begin_bulk`).
+
+        Raise an InternalError if the section could not be committed, in
+        which case all its modifications are cancelled.
+        """
+        assert _DF or self._bulk > 0
+        self._bulk -= 1
+        if self._bulk == 0:
+            for i in self._iterators.iterkeys():
+                i.flush()
+            failed = self._bulk_failed
+            self._bulk_failed = None
+            if failed is not None:
+                self._bulk_changes = 0
+                self._curs.execute("ROLLBACK")
+                raise InternalError("bulk section cancelled", failed)
+            try:
+                self._curs.execute("COMMIT")
+            except sqlite.Error, e:
+                self._curs.execute("ROLLBACK")
+                raise InternalError("bulk section cancelled", e)
+
+    def bulk(self):
+        """Return a context manager enclosing a bulk section, for use as::
+
+            with backend.bulk():
+                ...
+
+        If an exception is raised inside the section, it is not masked by
+        an error while exiting the section.
+
+        :see: `begin_bulk`
+        """
+        return _BulkSection(self)
+
     # element creation
 
     def create_media(self, package_id, id, url, frame_of_reference):
@@ -473,12 +659,12 @@ class _SqliteBackend(object):
             execute("INSERT INTO Medias VALUES (?,?,?,?)",
                     (package_id, id, url, frame_of_reference))
         except sqlite.Error, e:
-            execute("ROLLBACK")
+            self._rollback()
             raise InternalError("could not insert", e)
         except:
-            execute("ROLLBACK")
+            self._rollback()
             raise
-        execute("COMMIT")
+        self._commit()
 
     def create_annotation(self, package_id, id, media, begin, end,
                           mimetype, model, url):
@@ -518,12 +704,12 @@ class _SqliteBackend(object):
             execute("INSERT INTO Contents VALUES (?,?,?,?,?,?,?)",
                     (package_id, id, mimetype, sp, ss, url, "",))
         except sqlite.Error, e:
-            execute("ROLLBACK")
+            self._rollback()
             raise InternalError("could not insert", e)
         except:
-            execute("ROLLBACK")
+            self._rollback()
             raise
-        execute("COMMIT")
+        self._commit()
 
     def create_relation(self, package_id, id, mimetype, model, url):
         """Create a new empty relation and its associated content.
@@ -552,12 +738,12 @@ class _SqliteBackend(object):
             execute("INSERT INTO Contents VALUES (?,?,?,?,?,?,?)",
                     (package_id, id, mimetype, sp, ss, url, ""))
         except sqlite.Error, e:
-            execute("ROLLBACK")
+            self._rollback()
             raise InternalError("error in creating", e)
         except:
-            execute("ROLLBACK")
+            self._rollback()
             raise
-        execute("COMMIT")
+        self._commit()
 
     def create_view(self, package_id, id, mimetype, model, url):
         """Create a new view and its associated content.
@@ -586,12 +772,12 @@ class _SqliteBackend(object):
             execute("INSERT INTO Contents VALUES (?,?,?,?,?,?,?)",
                     (package_id, id, mimetype, sp, ss, url, "",))
         except sqlite.Error, e:
-            execute("ROLLBACK")
+            self._rollback()
             raise InternalError("error in creating", e)
         except:
-            execute("ROLLBACK")
+            self._rollback()
             raise
-        execute("COMMIT")
+        self._commit()
 
     def create_resource(self, package_id, id, mimetype, model, url):
         """Create a new resource and its associated content.
@@ -620,12 +806,12 @@ class _SqliteBackend(object):
             execute("INSERT INTO Contents VALUES (?,?,?,?,?,?,?)",
                     (package_id, id, mimetype, sp, ss, url, "",))
         except sqlite.Error, e:
-            execute("ROLLBACK")
+            self._rollback()
             raise InternalError("error in creating", e)
         except:
-            execute("ROLLBACK")
+            self._rollback()
             raise
-        execute("COMMIT")
+        self._commit()
 
     def create_tag(self, package_id, id):
         """Create a new tag.
@@ -637,12 +823,12 @@ class _SqliteBackend(object):
         try:
             _create_element(execute, package_id, id, TAG)
         except sqlite.Error, e:
-            execute("ROLLBACK")
+            self._rollback()
             raise InternalError("error in creating", e)
         except:
-            execute("ROLLBACK")
+            self._rollback()
             raise
-        execute("COMMIT")
+        self._commit()
 
     def create_list(self, package_id, id):
         """Create a new empty list.
@@ -654,12 +840,12 @@ class _SqliteBackend(object):
         try:
             _create_element(execute, package_id, id, LIST)
         except sqlite.Error, e:
-            execute("ROLLBACK")
+            self._rollback()
             raise InternalError("error in creating", e)
         except:
-            execute("ROLLBACK")
+            self._rollback()
             raise
-        execute("COMMIT")
+        self._commit()
 
     def create_query(self, package_id, id, mimetype, model, url):
         """Create a new query and its associated content.
@@ -688,12 +874,12 @@ class _SqliteBackend(object):
             execute("INSERT INTO Contents VALUES (?,?,?,?,?,?,?)",
                     (package_id, id, mimetype, sp, ss, url, "",))
         except sqlite.Error, e:
-            execute("ROLLBACK")
+            self._rollback()
             raise InternalError("error in creating",e)
         except:
-            execute("ROLLBACK")
+            self._rollback()
             raise
-        execute("COMMIT")
+        self._commit()
 
     def create_import(self, package_id, id, url, uri):
         """Create a new import.
@@ -707,12 +893,12 @@ class _SqliteBackend(object):
             execute("INSERT INTO Imports VALUES (?,?,?,?)",
                     (package_id, id, url, uri))
         except sqlite.Error, e:
-            execute("ROLLBACK")
+            self._rollback()
             raise InternalError("error in creating", e)
         except:
-            execute("ROLLBACK")
+            self._rollback()
             raise
-        execute("COMMIT")
+        self._commit()
 
     # element retrieval
 
@@ -723,7 +909,7 @@ class _SqliteBackend(object):
         the given type.
         """
         q = "SELECT typ FROM Elements WHERE package = ? and id = ?"
-        for i in self._curs.execute(q, (package_id, id,)):
+        for i in self._rcurs.execute(q, (package_id, id,)):
             return element_type is None or i[0] == element_type
         return False
 
@@ -745,7 +931,7 @@ class _SqliteBackend(object):
             "LEFT JOIN Contents c " \
                    "ON e.package = c.package AND e.id = c.element " \
             "WHERE e.package = ? AND e.id = ?"
-        r = self._curs.execute(q, (package_id, id,)).fetchone()
+        r = self._rcurs.execute(q, (package_id, id,)).fetchone()
         if r is None:
             return None
         t = r[0]
@@ -794,61 +980,38 @@ class _SqliteBackend(object):
         """
         assert _DF or not isinstance(package_ids, basestring)
         elt_u, elt_i = _split_uri_ref(element)
-        qmarks = "(" + ",".join("?" for i in package_ids) + ")"
-        q = """SELECT a.package, id, 'media'
-               FROM Annotations a
-               JOIN UriBases u ON a.package = u.package
-                               AND media_p = prefix
-               WHERE a.package IN %(pid_list)s
-               AND uri_base = ? AND media_i = ?
-            UNION
-               SELECT c.package, element, 'content_model'
-               FROM Contents c
-               JOIN UriBases u ON c.package = u.package
-                               AND model_p = prefix
-               WHERE c.package IN %(pid_list)s
-               AND uri_base = ? AND model_i = ?
-            UNION
-               SELECT r.package, relation, ':member '||ord
-               FROM RelationMembers r
+        q = """SELECT r.package, referrer, relation
+               FROM Refs r INDEXED BY RefsByTarget
                JOIN UriBases u ON r.package = u.package
-                               AND member_p = prefix
-               WHERE r.package IN %(pid_list)s
-               AND uri_base = ? AND member_i = ?
-            UNION
-               SELECT l.package, list, ':item '||ord
-               FROM ListItems l
-               JOIN UriBases u ON l.package = u.package
-                               AND item_p = prefix
-               WHERE l.package IN %(pid_list)s
-               AND uri_base = ? AND item_i = ?
-            UNION
-               SELECT t.package, '', ':tag '||join_id_ref(element_p, element_i)
-               FROM Tagged t
-               JOIN UriBases u ON t.package = u.package
-                               AND tag_p = prefix
-               WHERE t.package IN %(pid_list)s
-               AND uri_base = ? AND tag_i = ?
-            UNION
-               SELECT t.package, '', ':tagged '||join_id_ref(tag_p, tag_i)
-               FROM Tagged t
-               JOIN UriBases u ON t.package = u.package
-                               AND element_p = prefix
-               WHERE t.package IN %(pid_list)s
-               AND uri_base = ? AND element_i = ?
-            UNION
-               SELECT m.package, element, ':meta '||key
-               FROM Meta m
-               JOIN UriBases u ON m.package = u.package
-                               AND value_p = prefix
-               WHERE m.package IN %(pid_list)s
-               AND uri_base = ? AND value_i = ?
-            """ % {"pid_list": qmarks}
-        args = (list(package_ids) + [elt_u, elt_i]) * 7
-        c = self._conn.execute(q, args)
+                               AND target_p = prefix
+               WHERE target_i = ? AND r.package IN (%s)
+               AND uri_base = ?
+            """ % ",".join("?" for i in package_ids)
+        args = [elt_i,] + list(package_ids) + [elt_u,]
+        c = self._rconn.execute(q, args)
         r = ( (i[0], i[1], i[2]) for i in c )
         return _FlushableIterator(r, self)
 
+    def has_references(self, package_ids, element):
+        """
+        Return True iff any element or package in package_ids relies on the
+        identified element (where `element` is a uri-ref).
+
+        See `iter_references`.
+        """
+        assert _DF or not isinstance(package_ids, basestring)
+        elt_u, elt_i = _split_uri_ref(element)
+        q = """SELECT 1
+               FROM Refs r INDEXED BY RefsByTarget
+               JOIN UriBases u ON r.package = u.package
+                               AND target_p = prefix
+               WHERE target_i = ? AND r.package IN (%s)
+               AND uri_base = ?
+               LIMIT 1
+            """ % ",".join("?" for i in package_ids)
+        args = [elt_i,] + list(package_ids) + [elt_u,]
+        return self._rcurs.execute(q, args).fetchone() is not None
+
     def iter_references_with_import(self, package_id, id):
         """Iter over all the elements relying on the identified import.
 
@@ -904,7 +1067,7 @@ class _SqliteBackend(object):
                  WHERE package = ? AND value_p = ?
             """
         args = [package_id, id, ] * 7
-        c = self._conn.execute(q, args)
+        c = self._rconn.execute(q, args)
         return _FlushableIterator(c, self)
 
     def iter_medias(self, package_ids,
@@ -926,7 +1089,7 @@ class _SqliteBackend(object):
         if url: q.add_column_filter("e.url", url)
         if foref: q.add_column_filter("e.foref", foref)
 
-        r = self._conn.execute(*q.exe())
+        r = self._rconn.execute(*q.exe())
         return _FlushableIterator(r, self)
 
     def iter_annotations(self, package_ids,
@@ -934,6 +1097,9 @@ class _SqliteBackend(object):
                          media=None,
                          begin=None, begin_min=None, begin_max=None,
                          end=None,   end_min=None,   end_max=None,
+                         with_content=False,
+                         meta=None, data_contains=None,
+                         data_matches=None,
                         ):
         """
         Yield tuples of the form
@@ -941,6 +1107,24 @@ class _SqliteBackend(object):
         ordered by begin, end and media id-ref.
 
         ``media`` is the uri-ref of a media or an iterable of uri-refs.
+        ``meta`` has the same meaning as in `iter_tags`.
+
+        If ``data_contains`` is given, only the annotations whose content
+        data contains that string are yielded, as well as the annotations
+        with an external content (since their data is not in the backend).
+
+        ``data_matches`` is a triple (all_of, any_of, none_of) of sequences of
+        strings, used to pre-select the annotations whose content data may
+        contain all the strings in all_of, at least one of those in any_of,
+        and none of those in none_of. It relies on the full-text index (see
+        `sqlite_init.fulltext_index`), so the result is only a superset of the
+        actual matches: the index is case-insensitive, strings shorter than 3
+        characters are ignored, annotations with an external content are
+        always yielded, and the filter is ignored altogether if the index is
+        not available. The caller must check the actual content data.
+
+        If ``with_content`` is true, the content data is appended to each
+        tuple, sparing a `get_content_data` call per annotation.
         """
         assert _DF or not isinstance(package_ids, basestring)
         q = _Query(
@@ -950,6 +1134,7 @@ class _SqliteBackend(object):
             args = [ANNOTATION,]
         )
         q.add_content_columns()
+        if with_content: q.add_content_data_column()
         q.add_packages_filter(package_ids)
         if id: q.add_id_filter(id)
         if media: q.add_media_filter(media)
@@ -959,8 +1144,49 @@ class _SqliteBackend(object):
         if end: q.append(" AND e.fend = ?", end)
         if end_min: q.append(" AND e.fend >= ?", end_min)
         if end_max: q.append(" AND e.fend <= ?", end_max)
-        q.append(" ORDER BY fbegin, fend, media_p, media_i")
-        r = self._conn.execute(*q.exe())
+        if meta: q.add_meta_filter(meta)
+        if data_contains: q.add_data_contains_filter(data_contains)
+        if data_matches and self._fulltext_index:
+            expr = _fulltext_expression(*data_matches)
+            if expr: q.add_fulltext_filter(expr)
+        if end_min and self._temporal_index:
+            q.add_extent_filter(begin_max, end_min)
+        q.append(" ORDER BY e.fbegin, e.fend, e.media_p, e.media_i")
+        r = self._rconn.execute(*q.exe())
+        return _FlushableIterator(r, self)
+
+    def iter_annotation_extents(self, package_ids, media=None, key=None,
+                                meta=None):
+        """
+        Yield tuples of the form (package_id, id, begin, end, value, value_is_id),
+        ordered by begin and end.
+
+        This is a lightweight version of `iter_annotations`, for analyses
+        which need the temporal extent of many annotations and nothing else
+        but, optionally, one of their metadata. ``value`` is the value of
+        the ``key`` metadata, as an id-ref if ``value_is_id`` is true, or
+        None if ``key`` is None or the annotation has no such metadata.
+
+        ``media`` is the uri-ref of a media or an iterable of uri-refs.
+        ``meta`` has the same meaning as in `iter_tags`.
+        """
+        assert _DF or not isinstance(package_ids, basestring)
+        q = _Query(
+            "SELECT e.package, e.id, e.fbegin, e.fend,"
+                  " CASE WHEN k.value_i != ''"
+                       " THEN join_id_ref(k.value_p, k.value_i)"
+                       " ELSE k.value END,"
+                  " k.value_i != ''",
+            "FROM Annotations e"
+            " LEFT JOIN Meta k ON k.package = e.package"
+                             " AND k.element = e.id AND k.key = ?",
+            args = [key or "",]
+        )
+        q.add_packages_filter(package_ids)
+        if media: q.add_media_filter(media)
+        if meta: q.add_meta_filter(meta)
+        q.append(" ORDER BY e.fbegin, e.fend")
+        r = self._rconn.execute(*q.exe())
         return _FlushableIterator(r, self)
 
     def iter_relations(self, package_ids, id=None, member=None, pos=None):
@@ -980,7 +1206,7 @@ class _SqliteBackend(object):
         q.add_packages_filter(package_ids)
         if id: q.add_id_filter(id)
         if member: q.add_member_filter(member, pos)
-        r = self._conn.execute(*q.exe())
+        r = self._rconn.execute(*q.exe())
         return _FlushableIterator(r, self)
 
     def iter_views(self, package_ids, id=None):
@@ -997,7 +1223,7 @@ class _SqliteBackend(object):
         q.add_content_columns()
         q.add_packages_filter(package_ids)
         if id: q.add_id_filter(id)
-        r = self._conn.execute(*q.exe())
+        r = self._rconn.execute(*q.exe())
         return _FlushableIterator(r, self)
 
     def iter_resources(self, package_ids, id=None):
@@ -1015,7 +1241,7 @@ class _SqliteBackend(object):
         q.add_content_columns()
         q.add_packages_filter(package_ids)
         if id: q.add_id_filter(id)
-        r = self._conn.execute(*q.exe())
+        r = self._rconn.execute(*q.exe())
         return _FlushableIterator(r, self)
 
     def iter_tags(self, package_ids, id=None, meta=None):
@@ -1032,7 +1258,7 @@ class _SqliteBackend(object):
         q.add_packages_filter(package_ids)
         if id: q.add_id_filter(id)
         if meta: q.add_meta_filter(meta)
-        r = self._conn.execute(*q.exe())
+        r = self._rconn.execute(*q.exe())
         return _FlushableIterator(r, self)
 
     def iter_lists(self, package_ids, id=None, item=None, pos=None, meta=None):
@@ -1051,7 +1277,7 @@ class _SqliteBackend(object):
         if id: q.add_id_filter(id)
         if item: q.add_item_filter(item, pos)
         if meta: q.add_meta_filter(meta)
-        r = self._conn.execute(*q.exe())
+        r = self._rconn.execute(*q.exe())
         return _FlushableIterator(r, self)
 
     def iter_queries(self, package_ids, id=None):
@@ -1069,7 +1295,7 @@ class _SqliteBackend(object):
         q.add_content_columns()
         q.add_packages_filter(package_ids)
         if id: q.add_id_filter(id)
-        r = self._conn.execute(*q.exe())
+        r = self._rconn.execute(*q.exe())
         return _FlushableIterator(r, self)
 
     def iter_imports(self, package_ids,
@@ -1090,7 +1316,7 @@ class _SqliteBackend(object):
         if id: q.add_id_filter(id)
         if url: q.add_column_filter("e.url", url)
         if uri: q.add_column_filter("e.uri", uri)
-        r = self._conn.execute(*q.exe())
+        r = self._rconn.execute(*q.exe())
         return _FlushableIterator(r, self)
 
     # element counting
@@ -1114,7 +1340,7 @@ class _SqliteBackend(object):
         if foref: q.add_column_filter("e.foref", foref)
         q.wrap_in_count()
 
-        r = self._conn.execute(*q.exe())
+        r = self._rconn.execute(*q.exe())
         return r.next()[0]
 
     def count_annotations(self, package_ids,
@@ -1122,17 +1348,21 @@ class _SqliteBackend(object):
                          media=None,
                          begin=None, begin_min=None, begin_max=None,
                          end=None,   end_min=None,   end_max=None,
+                         meta=None, data_contains=None,
                         ):
         """
         Return the number of annotations matching the criteria.
 
         ``media`` is the uri-ref of a media or an iterable of uri-refs.
+        ``meta`` and ``data_contains`` have the same meaning as in
+        `iter_annotations`.
         """
         assert _DF or not isinstance(package_ids, basestring)
         q = _Query(
             "SELECT e.package, e.id",
             "FROM Annotations e",
         )
+        if data_contains: q.add_content_columns()
         q.add_packages_filter(package_ids)
         if id: q.add_id_filter(id)
         if media: q.add_media_filter(media)
@@ -1142,8 +1372,12 @@ class _SqliteBackend(object):
         if end: q.append(" AND e.fend = ?", end)
         if end_min: q.append(" AND e.fend >= ?", end_min)
         if end_max: q.append(" AND e.fend <= ?", end_max)
+        if meta: q.add_meta_filter(meta)
+        if data_contains: q.add_data_contains_filter(data_contains)
+        if end_min and self._temporal_index:
+            q.add_extent_filter(begin_max, end_min)
         q.wrap_in_count()
-        r = self._conn.execute(*q.exe())
+        r = self._rconn.execute(*q.exe())
         return r.next()[0]
 
     def count_relations(self, package_ids, id=None, member=None, pos=None):
@@ -1192,7 +1426,7 @@ class _SqliteBackend(object):
         q.add_packages_filter(package_ids)
         if id: q.add_id_filter(id)
         q.wrap_in_count()
-        r = self._conn.execute(*q.exe())
+        r = self._rconn.execute(*q.exe())
         return r.next()[0]
 
     def count_views(self, package_ids, id=None):
@@ -1209,7 +1443,7 @@ class _SqliteBackend(object):
         q.add_packages_filter(package_ids)
         if id: q.add_id_filter(id)
         q.wrap_in_count()
-        r = self._conn.execute(*q.exe())
+        r = self._rconn.execute(*q.exe())
         return r.next()[0]
 
     def count_resources(self, package_ids, id=None):
@@ -1226,7 +1460,7 @@ class _SqliteBackend(object):
         q.add_packages_filter(package_ids)
         if id: q.add_id_filter(id)
         q.wrap_in_count()
-        r = self._conn.execute(*q.exe())
+        r = self._rconn.execute(*q.exe())
         return r.next()[0]
 
     def count_tags(self, package_ids, id=None, meta=None):
@@ -1244,7 +1478,7 @@ class _SqliteBackend(object):
         if id: q.add_id_filter(id)
         if meta: q.add_meta_filter(meta)
         q.wrap_in_count()
-        r = self._conn.execute(*q.exe())
+        r = self._rconn.execute(*q.exe())
         return r.next()[0]
 
     def count_lists(self, package_ids, id=None, item=None, pos=None, meta=None):
@@ -1276,7 +1510,7 @@ class _SqliteBackend(object):
         if id: q.add_id_filter(id)
         if meta: q.add_meta_filter(meta)
         q.wrap_in_count()
-        r = self._conn.execute(*q.exe())
+        r = self._rconn.execute(*q.exe())
         return r.next()[0]
 
     def count_queries(self, package_ids, id=None):
@@ -1292,7 +1526,7 @@ class _SqliteBackend(object):
         q.add_packages_filter(package_ids)
         if id: q.add_id_filter(id)
         q.wrap_in_count()
-        r = self._conn.execute(*q.exe())
+        r = self._rconn.execute(*q.exe())
         return r.next()[0]
 
     def count_imports(self, package_ids,
@@ -1312,7 +1546,7 @@ class _SqliteBackend(object):
         if url: q.add_column_filter("e.url", url)
         if uri: q.add_column_filter("e.uri", uri)
         q.wrap_in_count()
-        r = self._conn.execute(*q.exe())
+        r = self._rconn.execute(*q.exe())
         return r.next()[0]
 
     # element updating
@@ -1437,12 +1671,12 @@ class _SqliteBackend(object):
                          "WHERE package = ? AND value_p = ?",
                         args)
         except sqlite.Error, e:
-            execute("ROLLBACK")
+            self._rollback()
             raise InternalError("could not update", e)
         except:
-            execute("ROLLBACK")
+            self._rollback()
             raise
-        execute("COMMIT")
+        self._commit()
 
     def rename_references(self, package_ids, old_uriref, new_id):
         """Reflect the renaming of an element in several packages.
@@ -1452,102 +1686,42 @@ class _SqliteBackend(object):
         """
         assert _DF or not isinstance(package_ids, basestring)
         element_u, element_i = _split_uri_ref(old_uriref)
-        args = [new_id,] + list(package_ids) + [element_i, element_u,]
-        qmarks = "(" + ",".join( "?" for i in package_ids ) + ")"
         execute = self._curs.execute
+        executemany = self._curs.executemany
         self._begin_transaction("IMMEDIATE")
         try:
-            # media references
-            q2 = """UPDATE Annotations SET media_i = ?
-                    WHERE package IN %s
-                    AND media_i = ?
-                    AND EXISTS (
-                      SELECT * FROM UriBases
-                      WHERE UriBases.package = Annotations.package
-                      AND prefix = media_p
-                      AND uri_base = ?
-                    )
-                  """ % qmarks
-            execute(q2, args)
-            # model references
-            q2 = """UPDATE Contents SET model_i = ?
-                    WHERE package IN %s
-                    AND model_i = ?
-                    AND EXISTS (
-                      SELECT * FROM UriBases
-                      WHERE UriBases.package = Contents.package
-                      AND prefix = model_p
-                      AND uri_base = ?
-                    )
-                 """ % qmarks
-            execute(q2, args)
-            # member references
-            q2 = """UPDATE RelationMembers SET member_i = ?
-                    WHERE package IN %s
-                    AND member_i = ?
-                    AND EXISTS (
-                      SELECT * FROM UriBases
-                      WHERE UriBases.package = RelationMembers.package
-                      AND prefix = member_p
-                      AND uri_base = ?
-                    )
-                 """ % qmarks
-            execute(q2, args)
-            # item references
-            q2 = """UPDATE ListItems SET item_i = ?
-                    WHERE package IN %s
-                    AND item_i = ?
-                    AND EXISTS (
-                      SELECT * FROM UriBases
-                      WHERE UriBases.package = ListItems.package
-                      AND prefix = item_p
-                      AND uri_base = ?
-                    )
-                 """ % qmarks
-            execute(q2, args)
-            # tags references
-            q2 = """UPDATE Tagged SET tag_i = ?
-                    WHERE package IN %s
-                    AND tag_i = ?
-                    AND EXISTS (
-                      SELECT * FROM UriBases
-                      WHERE UriBases.package = Tagged.package
-                      AND prefix = tag_p
-                      AND uri_base = ?
-                    )
-                 """ % qmarks
-            execute(q2, args)
-            # tagged element references
-            q2 = """UPDATE Tagged SET element_i = ?
-                    WHERE package IN %s
-                    AND element_i = ?
-                    AND EXISTS (
-                      SELECT * FROM UriBases
-                      WHERE UriBases.package = Tagged.package
-                      AND prefix = element_p
-                      AND uri_base = ?
-                    )
-                 """ % qmarks
-            execute(q2, args)
-            # metadata references
-            q2 = """UPDATE Meta SET value_i = ?
-                    WHERE package IN %s
-                    AND value_i = ?
-                    AND EXISTS (
-                      SELECT * FROM UriBases
-                      WHERE UriBases.package = Meta.package
-                      AND prefix = value_p
-                      AND uri_base = ?
-                    )
-                 """ % qmarks
-            execute(q2, args)
-        except InternalError, e:#sqlite.Error, e:
-            execute("ROLLBACK")
+            # the prefixes under which the element is known in each package
+            q = """SELECT package, prefix FROM UriBases
+                   WHERE package IN (%s) AND uri_base = ?
+                """ % ",".join( "?" for i in package_ids )
+            args = [ (new_id, element_i, prefix, package)
+                     for package, prefix
+                     in execute(q, list(package_ids) + [element_u,]) ]
+            # NB: each of the following is supported by an index
+            for q in (
+                "UPDATE Annotations SET media_i = ? WHERE media_i = ? "
+                  "AND media_p = ? AND package = ?",
+                "UPDATE Contents SET model_i = ? WHERE model_i = ? "
+                  "AND model_p = ? AND package = ?",
+                "UPDATE RelationMembers SET member_i = ? WHERE member_i = ? "
+                  "AND member_p = ? AND package = ?",
+                "UPDATE ListItems SET item_i = ? WHERE item_i = ? "
+                  "AND item_p = ? AND package = ?",
+                "UPDATE Tagged SET tag_i = ? WHERE tag_i = ? "
+                  "AND tag_p = ? AND package = ?",
+                "UPDATE Tagged SET element_i = ? WHERE element_i = ? "
+                  "AND element_p = ? AND package = ?",
+                "UPDATE Meta SET value_i = ? WHERE value_i = ? "
+                  "AND value_p = ? AND package = ?",
+                ):
+                executemany(q, args)
+        except sqlite.Error, e:
+            self._rollback()
             raise InternalError("could not update", e)
         except:
-            execute("ROLLBACK")
+            self._rollback()
             raise
-        execute("COMMIT")
+        self._commit()
 
     # element deletion
 
@@ -1589,12 +1763,12 @@ class _SqliteBackend(object):
                 execute("DELETE FROM ListItems WHERE package = ? AND list = ?",
                         args)
         except sqlite.Error, e:
-            execute("ROLLBACK")
+            self._rollback()
             raise InternalError("could not delete", e)
         except:
-            execute("ROLLBACK")
+            self._rollback()
             raise
-        execute("COMMIT")
+        self._commit()
 
     # content management
 
@@ -1612,7 +1786,7 @@ class _SqliteBackend(object):
         q = "SELECT mimetype, join_id_ref(model_p,model_i) as model, url " \
             "FROM Contents " \
             "WHERE package = ? AND element = ?"
-        return self._curs.execute(q, (package_id, id,)).fetchone() or None
+        return self._rcurs.execute(q, (package_id, id,)).fetchone() or None
 
     def update_content_info(self, package_id, id, element_type,
                             mimetype, model, url):
@@ -1658,7 +1832,7 @@ class _SqliteBackend(object):
         assert _DF or self.has_element(package_id, id, element_type)
         assert _DF or element_type in (ANNOTATION,RELATION,VIEW,QUERY,RESOURCE)
         q = "SELECT data FROM Contents WHERE package = ? AND element = ?"
-        return self._curs.execute(q, (package_id, id,)).fetchone()[0]
+        return self._rcurs.execute(q, (package_id, id,)).fetchone()[0]
 
     def update_content_data(self, package_id, id, element_type, data):
         """Update the content data of the identified element.
@@ -1701,7 +1875,7 @@ class _SqliteBackend(object):
             "  (model_p = ''   AND  ? IN (p.uri, p.url)) OR " \
             "  (model_p = i.id AND  ? IN (i.uri, i.url)))"
         args =  list(package_ids) + [model_i, model_u, model_u,]
-        r = self._conn.execute(q, args)
+        r = self._rconn.execute(q, args)
         return _FlushableIterator(r, self)
 
     # meta-data management
@@ -1721,7 +1895,7 @@ class _SqliteBackend(object):
         r = ( (d[0],
                d[2] and "%s:%s" % (d[2], d[3]) or d[3] or d[1],
                d[3] != "",
-              ) for d in self._conn.execute(q, (package_id, id)) )
+              ) for d in self._rconn.execute(q, (package_id, id)) )
         return _FlushableIterator(r, self)
 
     def get_meta(self, package_id, id, element_type, key):
@@ -1737,7 +1911,7 @@ class _SqliteBackend(object):
         assert _DF or id == "" or self.has_element(package_id, id, element_type)
         q = """SELECT value, value_p, value_i FROM Meta
                WHERE package = ? AND element = ? AND KEY = ?"""
-        d = self._curs.execute(q, (package_id, id, key,)).fetchone()
+        d = self._rcurs.execute(q, (package_id, id, key,)).fetchone()
         if d is None:
             return None
         elif d[2]:
@@ -1823,7 +1997,7 @@ class _SqliteBackend(object):
                "AND package || ' ' || value_p IN (%s)" % q1
         args = list(package_ids) \
              + [element_i, element_u, element_u,]
-        r = self._conn.execute(q2, args)
+        r = self._rconn.execute(q2, args)
         return _FlushableIterator(r, self)
 
     # relation members management
@@ -1863,12 +2037,12 @@ class _SqliteBackend(object):
             execute("INSERT INTO RelationMembers VALUES (?,?,?,?,?)",
                     (package_id, id, pos, p, s))
         except sqlite.Error, e:
-            execute("ROLLBACK")
+            self._rollback()
             raise InternalError("could not update or insert", e)
         except:
-            execute("ROLLBACK")
+            self._rollback()
             raise
-        execute("COMMIT")
+        self._commit()
 
     def update_member(self, package_id, id, member, pos):
         """
@@ -1898,7 +2072,7 @@ class _SqliteBackend(object):
         """
         q = "SELECT count(ord) FROM RelationMembers "\
             "WHERE package = ? AND relation = ?"
-        return self._curs.execute(q, (package_id, id)).fetchone()[0]
+        return self._rcurs.execute(q, (package_id, id)).fetchone()[0]
 
     def get_member(self, package_id, id, pos, n=-1):
         """
@@ -1921,7 +2095,7 @@ class _SqliteBackend(object):
         q = "SELECT join_id_ref(member_p,member_i) AS member " \
             "FROM RelationMembers "\
             "WHERE package = ? AND relation = ? AND ord = ?"
-        return self._curs.execute(q, (package_id, id, pos)).fetchone()[0]
+        return self._rcurs.execute(q, (package_id, id, pos)).fetchone()[0]
 
     def iter_members(self, package_id, id):
         """
@@ -1931,7 +2105,7 @@ class _SqliteBackend(object):
         q = "SELECT join_id_ref(member_p,member_i) AS member " \
             "FROM RelationMembers " \
             "WHERE package = ? AND relation = ? ORDER BY ord"
-        r = ( i[0] for i in self._conn.execute(q, (package_id, id)) )
+        r = ( i[0] for i in self._rconn.execute(q, (package_id, id)) )
         return _FlushableIterator(r, self)
 
     def remove_member(self, package_id, id, pos):
@@ -1964,12 +2138,12 @@ class _SqliteBackend(object):
                     "WHERE package = ? AND relation = ? AND ord < 0",
                     (package_id, id))
         except sqlite.Error, e:
-            execute("ROLLBACK")
+            self._rollback()
             raise InternalError("could not delete or update", e)
         except:
-            execute("ROLLBACK")
+            self._rollback()
             raise
-        execute("COMMIT")
+        self._commit()
 
     # list items management
 
@@ -2008,12 +2182,12 @@ class _SqliteBackend(object):
             execute("INSERT INTO ListItems VALUES (?,?,?,?,?)",
                     (package_id, id, pos, p, s))
         except sqlite.Error, e:
-            execute("ROLLBACK")
+            self._rollback()
             raise InternalError("could not update or insert", e)
         except:
-            execute("ROLLBACK")
+            self._rollback()
             raise
-        execute("COMMIT")
+        self._commit()
 
     def update_item(self, package_id, id, item, pos):
         """
@@ -2043,7 +2217,7 @@ class _SqliteBackend(object):
         """
         q = "SELECT count(ord) FROM ListItems "\
             "WHERE package = ? AND list = ?"
-        return self._curs.execute(q, (package_id, id)).fetchone()[0]
+        return self._rcurs.execute(q, (package_id, id)).fetchone()[0]
 
     def get_item(self, package_id, id, pos, n=-1):
         """
@@ -2066,7 +2240,7 @@ class _SqliteBackend(object):
         q = "SELECT join_id_ref(item_p,item_i) AS item " \
             "FROM ListItems "\
             "WHERE package = ? AND list = ? AND ord = ?"
-        return self._curs.execute(q, (package_id, id, pos)).fetchone()[0]
+        return self._rcurs.execute(q, (package_id, id, pos)).fetchone()[0]
 
     def iter_items(self, package_id, id):
         """
@@ -2076,7 +2250,7 @@ class _SqliteBackend(object):
         q = "SELECT join_id_ref(item_p,item_i) AS item " \
             "FROM ListItems " \
             "WHERE package = ? AND list = ? ORDER BY ord"
-        r = ( i[0] for i in self._conn.execute(q, (package_id, id)) )
+        r = ( i[0] for i in self._rconn.execute(q, (package_id, id)) )
         return _FlushableIterator(r, self)
 
     def remove_item(self, package_id, id, pos):
@@ -2109,14 +2283,12 @@ class _SqliteBackend(object):
                      "WHERE package = ? AND list = ? AND ord < 0",
                     (package_id, id))
         except sqlite.Error, e:
-            execute("ROLLBACK")
-            self._conn.rollback()
+            self._rollback()
             raise InternalError("could not delete or update", e)
         except:
-            execute("ROLLBACK")
-            self._conn.rollback()
+            self._rollback()
             raise
-        execute("COMMIT")
+        self._commit()
 
     # tagged elements management
 
@@ -2181,7 +2353,7 @@ class _SqliteBackend(object):
             "  (element_p = i.id AND  ? IN (i.uri, i.url)))"
         args = list(package_ids) + [element_i, element_u, element_u]
 
-        r = self._conn.execute(q, args)
+        r = self._rconn.execute(q, args)
         return _FlushableIterator(r, self)
 
     def iter_elements_with_tag(self, package_ids, tag):
@@ -2203,7 +2375,7 @@ class _SqliteBackend(object):
             "  (tag_p = i.id AND  ? IN (i.uri, i.url)))"
         args = list(package_ids) + [tag_i, tag_u, tag_u]
 
-        r = self._conn.execute(q, args)
+        r = self._rconn.execute(q, args)
         return _FlushableIterator(r, self)
 
     def iter_taggers(self, package_ids, element, tag):
@@ -2232,7 +2404,7 @@ class _SqliteBackend(object):
         args = list(package_ids) \
              + [element_i, element_u, element_u, tag_i, tag_u, tag_u,]
 
-        r = ( i[0] for i in self._conn.execute(q, args) )
+        r = ( i[0] for i in self._rconn.execute(q, args) )
         return _FlushableIterator(r, self)
 
     def iter_external_tagging(self, package_id):
@@ -2244,9 +2416,138 @@ class _SqliteBackend(object):
                    "join_id_ref(tag_p, tag_i) " \
             "FROM Tagged t " \
             "WHERE t.package = ? AND element_p > '' AND tag_p > ''"
-        r = self._conn.execute(q, (package_id,))
+        r = self._rconn.execute(q, (package_id,))
         return _FlushableIterator(r, self)
 
+    # element fingerprints
+
+    def update_fingerprints(self, package_id):
+        """Compute the missing fingerprints of the elements of a package.
+
+        The fingerprint of an element is a digest of all its data: its
+        type-specific attributes, content, metadata, tags, members or items
+        (id-refs being considered as strings). Two elements with the same
+        fingerprint are therefore identical, as far as
+        `libadvene.model.core.diff` is concerned.
+
+        Fingerprints are stored in the backend, and invalidated whenever
+        the data of the element changes, so this method only costs time
+        proportional to the number of elements modified since its last call.
+
+        The fingerprint of an element with a packaged content is empty,
+        since its data is not in the backend.
+        """
+        missing = "NOT EXISTS (SELECT f.id FROM Fingerprints f " \
+                                "WHERE f.package = m.package AND f.id = m.%s)"
+        parts = {}
+        for q, column in _FINGERPRINT_QUERIES:
+            q = q % {"missing": missing % column}
+            for r in self._curs.execute(q, (package_id,)):
+                parts.setdefault(r[0], []).append(
+                    "\x00".join( _fingerprint_field(i) for i in r[1:] ))
+        if not parts:
+            return
+
+        self._begin_transaction("IMMEDIATE")
+        execute = self._curs.execute
+        try:
+            for id, l in parts.iteritems():
+                if l[0] == "unknown":
+                    fp = ""
+                else:
+                    fp = sha1("\x01".join(l)).hexdigest()
+                execute("INSERT OR REPLACE INTO Fingerprints VALUES (?,?,?)",
+                        (package_id, id, fp))
+        except sqlite.Error, e:
+            self._rollback()
+            raise InternalError("could not update fingerprints", e)
+        except:
+            self._rollback()
+            raise
+        self._commit()
+
+    def iter_fingerprints(self, package_id, element_type):
+        """Yield tuples of the form (id, fingerprint), ordered by id.
+
+        The fingerprint is None if it has not been computed since the element
+        was last modified (see `update_fingerprints`), or empty if the data of
+        the element is not entirely in the backend.
+        """
+        q = "SELECT e.id, f.fingerprint FROM Elements e " \
+            "LEFT JOIN Fingerprints f ON f.package = e.package " \
+                                     "AND f.id = e.id " \
+            "WHERE e.package = ? AND e.typ = ? ORDER BY e.id"
+        r = self._rconn.execute(q, (package_id, element_type))
+        return _FlushableIterator(r, self)
+
+    # package copies
+
+    def save_package_copy(self, package_id, path):
+        """Save a copy of the given package in a new database file.
+
+        The copy is the default package of the database at `path`, which
+        must not exist yet. It can be loaded back into another package with
+        `load_package_copy`, which is much faster than parsing a serialized
+        package again.
+        """
+        if exists(path):
+            raise InternalError("could not save package copy",
+                                "file already exists: %s" % path)
+        try:
+            cx = sqlite.connect(path, isolation_level=None)
+        except sqlite.Error, e:
+            raise InternalError("could not save package copy", e)
+        try:
+            try:
+                execute = cx.execute
+                execute("BEGIN EXCLUSIVE")
+                for sql in sqlite_init.statements:
+                    execute(sql)
+                execute("INSERT INTO Version VALUES (?)", (BACKEND_VERSION,))
+                execute("INSERT INTO Packages VALUES (?,?,?)",
+                        (_DEFAULT_PKGID, self.get_uri(package_id), "",))
+                for table in _COPIED_TABLES:
+                    _copy_rows(self._conn, package_id, cx, _DEFAULT_PKGID,
+                               table)
+                execute("COMMIT")
+            finally:
+                cx.close()
+        except sqlite.Error, e:
+            unlink(path)
+            raise InternalError("could not save package copy", e)
+        except:
+            unlink(path)
+            raise
+
+    def load_package_copy(self, package_id, path):
+        """Fill the given package with a copy saved by `save_package_copy`.
+
+        The package is expected to be empty.
+        """
+        cx = _get_connection(path, upgrade=True)
+        if cx is None:
+            raise InternalError("could not load package copy",
+                                WrongFormat(path))
+        try:
+            self._begin_transaction("IMMEDIATE")
+            try:
+                uri = cx.execute("SELECT uri FROM Packages WHERE id = ?",
+                                 (_DEFAULT_PKGID,)).fetchone()[0]
+                self._curs.execute("UPDATE Packages SET uri = ? WHERE id = ?",
+                                   (uri, package_id,))
+                for table in _COPIED_TABLES:
+                    _copy_rows(cx, _DEFAULT_PKGID, self._conn, package_id,
+                               table)
+            except sqlite.Error, e:
+                self._rollback()
+                raise InternalError("could not load package copy", e)
+            except:
+                self._rollback()
+                raise
+            self._commit()
+        finally:
+            cx.close()
+
 
     # end of the backend interface
 
@@ -2263,13 +2564,12 @@ class _SqliteBackend(object):
         self._curs = conn.cursor()
         # NB: self._curs is to be used for any *internal* operations
         # Iterators intended for *external* use must be based on a new cursor.
-        conn.create_function("join_id_ref", 2,
-                              lambda p,s: p and "%s:%s" % (p,s) or s)
-        conn.create_function("regexp", 2,
-                              lambda r,l: re.search(r,l) is not None )
-        # NB: for a reason I don't know, the defined function regexp
-        # receives the righthand operand first, then the lefthand operand...
-        # hence the lambda function above
+        self._rconn = conn
+        self._rcurs = self._curs
+        # NB: _rconn and _rcurs are used instead of _conn and _curs by the
+        # read-only methods (see enable_concurrent_reads)
+        self._readers = None
+        _init_functions(conn)
         self._bound = WeakValueDictWithCallback(self._check_unused)
         # NB: the callback ensures that even if packages "forget" to close
         # themselves, once they are garbage collected, we check if the
@@ -2278,6 +2578,18 @@ class _SqliteBackend(object):
         # _iterators is used to store all the iterators returned by iter_*
         # methods, and force them to flush their underlying cursor anytime
         # an modification of the database is about to happen
+        self._bulk = 0
+        self._bulk_changes = 0
+        self._bulk_failed = None
+        # _bulk is the nesting level of bulk sections (see begin_bulk);
+        # _bulk_changes is the number of changes of the connection when the
+        # current modification inside it began (see _begin_transaction);
+        # _bulk_failed is the first modification which failed after writing
+        # something, if any, which makes the whole section fail
+        self._temporal_index = self._init_optional_index(
+            "AnnotationKeys", sqlite_init.temporal_index)
+        self._fulltext_index = self._init_optional_index(
+            "ContentsKeys", sqlite_init.fulltext_index)
 
     def _bind(self, package_id, package):
         d = self._bound
@@ -2300,6 +2612,10 @@ class _SqliteBackend(object):
                 self._curs.execute("UPDATE Packages SET url = ?", ("",))
             finally:
                 conn.close()
+                if self._readers is not None:
+                    for reader in self._readers:
+                        reader.close()
+                    self._readers = None
             self._conn = None
             self._curs = None
             # the following is necessary to break a cyclic reference:
@@ -2309,21 +2625,121 @@ class _SqliteBackend(object):
             # the following is not stricly necessary, but does no harm ;)
             if self._path in _cache: del _cache[self._path]
 
+    def enable_concurrent_reads(self):
+        """Allow other threads to read the database while this one writes.
+
+        Is not part of the interface; this is intended for servers, where
+        each request is handled in its own thread.
+
+        The database is switched to write-ahead logging, so that readers
+        and a writer do not block each other. Methods modifying the
+        database are serialized by a lock and use the main connection; a
+        bulk section holds the lock until its end. Read-only methods use
+        the main connection only when called inside such a method or bulk
+        section (by the thread holding the lock); otherwise, each thread
+        (including the one calling this method) reads through a connection
+        of its own, opened on demand, so the main connection is never used
+        by two threads at the same time.
+
+        Return False (and change nothing) if write-ahead logging is not
+        possible, e.g. for in-memory databases.
+        """
+        if self._readers is not None:
+            return True
+        if self._path == ":memory:":
+            return False
+        try:
+            mode = self._curs.execute("PRAGMA journal_mode=WAL").fetchone()
+        except sqlite.Error:
+            return False
+        if mode is None or mode[0].lower() != "wal":
+            return False
+        self._readers = []
+        self._write_lock = RLock()
+        self._local = _ReaderLocal()
+        del self._rconn, self._rcurs
+        self._main_iterators = self._iterators
+        del self._iterators
+        self.__class__ = _ConcurrentSqliteBackend
+        return True
+
+    def _init_optional_index(self, name, statements):
+        """Ensure that the optional index stored in table `name` exists.
+
+        If not, it is created with the given statements. Return True if it can
+        be used, False otherwise (e.g. if sqlite lacks the required module, or
+        if the database is read-only).
+        See `sqlite_init.temporal_index` and `sqlite_init.fulltext_index`.
+        """
+        execute = self._curs.execute
+        c = execute("SELECT name FROM sqlite_master WHERE name = ?", (name,))
+        if c.fetchone() is not None:
+            return True
+        execute("SAVEPOINT optional_index")
+        try:
+            for sql in statements:
+                execute(sql)
+        except sqlite.Error:
+            execute("ROLLBACK TO optional_index")
+            execute("RELEASE optional_index")
+            return False
+        execute("RELEASE optional_index")
+        return True
+
     def _begin_transaction(self, mode=""):
         """Begin a transaction.
 
         This method must *always* be used to begin a transaction (do *not* use
         `self._curs.execute("BEGIN")` directly. See `_FlushableIterator` .
+
+        Inside a bulk section, which is already a transaction, this only
+        records the number of changes, so that `_rollback` can tell whether
+        the modification wrote anything. For the same reason, transactions
+        must be terminated with `_commit` or `_rollback`.
         """
+        if self._bulk:
+            self._bulk_changes = self._conn.total_changes
+            return
         for i in self._iterators.iterkeys():
             i.flush()
         self._curs.execute("BEGIN %s" % mode)
 
+    def _commit(self):
+        """Commit the current transaction.
+
+        Inside a bulk section, nothing is done: the section is committed as
+        a whole by `end_bulk`.
+        """
+        if not self._bulk:
+            self._curs.execute("COMMIT")
+
+    def _rollback(self):
+        """Rollback the current transaction.
+
+        Inside a bulk section, there is nothing to cancel if the current
+        modification did not write anything. Else, the whole section will be
+        rolled back by `end_bulk`.
+        """
+        if not self._bulk:
+            self._curs.execute("ROLLBACK")
+        elif self._bulk_failed is None \
+        and self._conn.total_changes != self._bulk_changes:
+            self._bulk_failed = exc_info()[1]
+
     def _create_element(self, execute, package_id, id, element_type):
         """Perform controls and insertions common to all elements.
 
         NB: This starts a transaction that must be commited by caller.
         """
+        if self._bulk:
+            self._begin_transaction()
+            # rely on the primary key to check that the id is not in use
+            try:
+                execute("INSERT INTO Elements VALUES (?,?,?)",
+                        (package_id, id, element_type))
+            except sqlite.IntegrityError:
+                raise ModelError("id in use: %s" % id)
+            return
         # check that the id is not in use
         self._begin_transaction("IMMEDIATE")
         c = execute("SELECT id FROM Elements WHERE package = ? AND id = ?",
@@ -2334,6 +2750,26 @@ class _SqliteBackend(object):
                 (package_id, id, element_type))
 
 
+class _BulkSection(object):
+    """The context manager returned by `_SqliteBackend.bulk`."""
+    def __init__(self, backend):
+        self._backend = backend
+
+    def __enter__(self):
+        self._backend.begin_bulk()
+        return self._backend
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._backend.end_bulk()
+        else:
+            try:
+                self._backend.end_bulk()
+            except InternalError:
+                pass # the original exception is more informative
+        return False
+
+
 class _FlushableIterator(object):
     """Cursor based iterator that may flush the cursor whenever needed.
 
@@ -2370,6 +2806,172 @@ class _FlushableIterator(object):
     def next(self):
         return self._cursor.next()
 
+class _ReaderLocal(local):
+    """Per-thread state of a `_ConcurrentSqliteBackend`."""
+    conn = None
+    curs = None
+    writing = 0
+    iterators = None
+
+class _ConcurrentSqliteBackend(_SqliteBackend):
+    """A `_SqliteBackend` on which `enable_concurrent_reads` was called.
+
+    Instances are never created directly; `enable_concurrent_reads` changes
+    the class of an existing backend, so that backends used by a single
+    thread do not pay for the per-thread dispatch below.
+    """
+
+    def _use_main(self):
+        return self._local.writing
+
+    def _enter_write(self):
+        self._write_lock.acquire()
+        loc = self._local
+        if not loc.writing and loc.iterators:
+            # a pending statement would keep the reader connection of this
+            # thread in its current read transaction, hiding the
+            # modification once committed
+            for i in loc.iterators.keys():
+                i.flush()
+            loc.iterators.clear()
+        loc.writing += 1
+
+    def _exit_write(self):
+        loc = self._local
+        try:
+            loc.writing -= 1
+            if not loc.writing:
+                # iterators on the main connection must not be used once
+                # the lock is released, since another thread may use it
+                for i in self._main_iterators.keys():
+                    i.flush()
+                self._main_iterators.clear()
+        finally:
+            self._write_lock.release()
+
+    def _reader(self):
+        loc = self._local
+        conn = loc.conn
+        if conn is None:
+            conn = sqlite.connect(self._path, isolation_level=None,
+                                  check_same_thread=False)
+            conn.execute("PRAGMA query_only=ON")
+            _init_functions(conn)
+            loc.conn = conn
+            loc.curs = conn.cursor()
+            self._readers.append(conn) # atomic, no need for a lock
+        return loc
+
+    @property
+    def _rconn(self):
+        if self._use_main():
+            return self._conn
+        return self._reader().conn
+
+    @property
+    def _rcurs(self):
+        if self._use_main():
+            return self._curs
+        return self._reader().curs
+
+    @property
+    def _iterators(self):
+        # iterators based on a reader connection never prevent the main
+        # connection to commit, so they need not be flushed by transactions
+        if self._use_main():
+            return self._main_iterators
+        loc = self._local
+        if loc.iterators is None:
+            loc.iterators = WeakKeyDictionary()
+        return loc.iterators
+
+    def begin_bulk(self):
+        self._enter_write()
+        try:
+            super(_ConcurrentSqliteBackend, self).begin_bulk()
+        except:
+            self._exit_write()
+            raise
+
+    def end_bulk(self):
+        try:
+            super(_ConcurrentSqliteBackend, self).end_bulk()
+        finally:
+            self._exit_write()
+
+def _make_serialized(name):
+    method = getattr(_SqliteBackend, name)
+    def serialized(self, *args, **kw):
+        self._enter_write()
+        try:
+            return method(self, *args, **kw)
+        finally:
+            self._exit_write()
+    serialized.__name__ = name
+    serialized.__doc__ = method.__doc__
+    return serialized
+
+for _name in dir(_SqliteBackend):
+    if _name.startswith(("update_", "create_", "rename_", "insert_",
+                         "remove_", "associate_", "dissociate_")) \
+    or _name in ("close", "delete", "delete_element", "set_meta",
+                 "save_package_copy", "load_package_copy"):
+        setattr(_ConcurrentSqliteBackend, _name, _make_serialized(_name))
+del _name
+
+# the queries used by update_fingerprints, with the column holding the id of
+# the element in table m; each of them yields the id of an element followed by
+# some of its data, and %(missing)s is a condition selecting the elements
+# without a fingerprint; the first query yields one row per element, with
+# "unknown" for elements which can not be fingerprinted
+_FINGERPRINT_QUERIES = [
+    ("SELECT m.id, CASE WHEN c.url LIKE 'packaged:%%' THEN 'unknown' "
+                     "ELSE m.typ END "
+     "FROM Elements m LEFT JOIN Contents c "
+       "ON c.package = m.package AND c.element = m.id "
+     "WHERE m.package = ? AND %(missing)s", "id"),
+    ("SELECT id, url, foref FROM Medias m "
+     "WHERE package = ? AND %(missing)s", "id"),
+    ("SELECT id, join_id_ref(media_p, media_i), fbegin, fend "
+     "FROM Annotations m WHERE package = ? AND %(missing)s", "id"),
+    ("SELECT id, url, uri FROM Imports m WHERE package = ? AND %(missing)s",
+     "id"),
+    ("SELECT element, mimetype, join_id_ref(model_p, model_i), url, "
+            "CASE url WHEN '' THEN data ELSE '' END "
+     "FROM Contents m WHERE package = ? AND %(missing)s", "element"),
+    ("SELECT element, key, value, join_id_ref(value_p, value_i) "
+     "FROM Meta m WHERE package = ? AND element != '' AND %(missing)s "
+     "ORDER BY element, key", "element"),
+    ("SELECT relation, ord, join_id_ref(member_p, member_i) "
+     "FROM RelationMembers m WHERE package = ? AND %(missing)s "
+     "ORDER BY relation, ord", "relation"),
+    ("SELECT list, ord, join_id_ref(item_p, item_i) "
+     "FROM ListItems m WHERE package = ? AND %(missing)s "
+     "ORDER BY list, ord", "list"),
+    ("SELECT element_i, 'tag', join_id_ref(tag_p, tag_i) "
+     "FROM Tagged m WHERE package = ? AND element_p = '' AND %(missing)s "
+     "ORDER BY element_i, tag_p, tag_i", "element_i"),
+    ("SELECT tag_i, 'tagged', join_id_ref(element_p, element_i) "
+     "FROM Tagged m WHERE package = ? AND tag_p = '' AND element_p != '' "
+                    "AND %(missing)s "
+     "ORDER BY tag_i, element_p, element_i", "tag_i"),
+]
+
+def _fingerprint_field(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+def _init_functions(conn):
+    """Define the SQL functions used by the backend on `conn`."""
+    conn.create_function("join_id_ref", 2,
+                          lambda p,s: p and "%s:%s" % (p,s) or s)
+    conn.create_function("regexp", 2,
+                          lambda r,l: re.search(r,l) is not None )
+    # NB: for a reason I don't know, the defined function regexp
+    # receives the righthand operand first, then the lefthand operand...
+    # hence the lambda function above
+
 # NB: the wrapping of cursors into _FlushableIterators could be implemented
 # as a decorator on all iter_* functions. However
 #  - "classical" (i.e. wrapping) decorators have a high overhead
@@ -2426,6 +3028,32 @@ class _Query(object):
                   " ON %(pid)s = c.package AND %(eid)s = c.element"\
                   % self.__dict__
 
+    def add_content_data_column(self):
+        # must be called after add_content_columns
+        self.s += ", c.data"
+
+    def add_data_contains_filter(self, data):
+        # must be called after add_content_columns;
+        # external contents can not be checked, so they are kept
+        self.w += " AND (c.url != '' OR instr(c.data, ?) > 0)"
+        self.a.append(data)
+
+    def add_fulltext_filter(self, expr):
+        """
+        Pre-select elements through the full-text index (see
+        `_fulltext_expression`), keeping those with an external content.
+
+        The subqueries do not depend on the current row, so sqlite evaluates
+        them once; the latter uses the partial index ContentsExternal.
+        """
+        self.w += " AND %(eid)s IN (" \
+                  "SELECT k.element FROM ContentsText t" \
+                  " JOIN ContentsKeys k ON k.key = t.rowid" \
+                  " WHERE ContentsText MATCH ?" \
+                  " UNION SELECT element FROM Contents WHERE url != '')" \
+                  % self.__dict__
+        self.a.append(expr)
+
     def add_media_filter(self, media):
         if isinstance(media, basestring):
             media = (media,)
@@ -2438,8 +3066,40 @@ class _Query(object):
                   % " OR ".join(n*["mu.uri_base = ? AND media_i = ?"])
         self.a.extend(sum(media, ()))
 
+    def add_extent_filter(self, begin_max, end_min):
+        """
+        Pre-select annotations through the temporal index (R*Tree).
+
+        This is redundant with the equivalent conditions on the Annotations
+        table (which must also be added), but lets sqlite answer stabbing and
+        overlap queries without scanning all the annotations starting before
+        the given time.
+
+        NB: only upper bounds on begin and lower bounds on end are used, since
+        the R*Tree stores the ordered bounds of each annotation (see
+        `sqlite_init.temporal_index`).
+        """
+        # CROSS JOIN forces sqlite to use the R*Tree as the outer loop
+        assert self.f.startswith("FROM Annotations e")
+        self.f = "FROM AnnotationExtents x CROSS JOIN AnnotationKeys xk " \
+                 "CROSS JOIN %s" % self.f[5:]
+        self.w += " AND xk.key = x.key AND e.package = xk.package " \
+                  "AND e.id = xk.id AND x.fend >= ?"
+        self.a.append(end_min)
+        if begin_max:
+            self.w += " AND x.fbegin <= ?"
+            self.a.append(begin_max)
+
     def add_member_filter(self, member, ord=None):
             m_u, m_i = _split_uri_ref(member)
+            # the uncorrelated IN clause is redundant with the EXISTS clause,
+            # but it lets sqlite use the indexes to select the candidates
+            # rather than evaluating the EXISTS clause on every relation
+            self.w += " AND %(eid)s IN ("\
+                          "SELECT relation FROM RelationMembers "\
+                          "WHERE member_i = ?"\
+                      ")" % self.__dict__
+            self.a.append(m_i)
             self.w += " AND EXISTS ("\
                           "SELECT m.relation FROM RelationMembers m "\
                           "JOIN UriBases u ON m.package = u.package "\
@@ -2455,6 +3115,11 @@ class _Query(object):
 
     def add_item_filter(self, item, ord=None):
             i_u, i_i = _split_uri_ref(item)
+            # see add_member_filter about this redundant IN clause
+            self.w += " AND %(eid)s IN ("\
+                          "SELECT list FROM ListItems WHERE item_i = ?"\
+                      ")" % self.__dict__
+            self.a.append(i_i)
             self.w += " AND EXISTS ("\
                           "SELECT i.list FROM ListItems i "\
                           "JOIN UriBases u ON i.package = u.package "\
@@ -159,3 +159,377 @@ UNION
          CASE uri WHEN "" THEN url ELSE uri END AS uri_base
   FROM Imports
 ;--cut""".split(";--cut")[:-1]
+
+# secondary indexes, supporting the most frequent (non primary-key) lookups
+# of the backend; they are created with the tables in new databases, and added
+# to older databases by the upgrade path below
+indexes = """
+CREATE INDEX IF NOT EXISTS AnnotationsByMedia
+  ON Annotations (media_i, media_p, package, fbegin, fend)
+;--cut
+
+CREATE INDEX IF NOT EXISTS AnnotationsByTime
+  ON Annotations (package, fbegin, fend)
+;--cut
+
+CREATE INDEX IF NOT EXISTS RelationMembersByMember
+  ON RelationMembers (member_i, member_p, package)
+;--cut
+
+CREATE INDEX IF NOT EXISTS ListItemsByItem
+  ON ListItems (item_i, item_p, package)
+;--cut
+
+CREATE INDEX IF NOT EXISTS TaggedByTag
+  ON Tagged (tag_i, tag_p, package)
+;--cut
+
+CREATE INDEX IF NOT EXISTS MetaByValue
+  ON Meta (value_i, value_p, package)
+;--cut
+
+CREATE INDEX IF NOT EXISTS ContentsByModel
+  ON Contents (model_i, model_p, package)
+;--cut""".split(";--cut")[:-1]
+
+statements += indexes
+
+# materialized references: Refs has one line for each reference from an
+# element (or a package, if referrer is empty) to an element, with the same
+# relation strings as _SqliteBackend.iter_references; it is maintained by the
+# triggers below, so that references to an element can be found with an
+# indexed lookup rather than by scanning every table holding id-refs
+references = ["""
+CREATE TABLE IF NOT EXISTS Refs (
+  package  TEXT NOT NULL,
+  referrer TEXT NOT NULL,
+  relation TEXT NOT NULL,
+  target_p TEXT NOT NULL,
+  target_i TEXT NOT NULL,
+  FOREIGN KEY (package) references Packages (id)
+)""", """
+CREATE INDEX IF NOT EXISTS RefsByTarget
+  ON Refs (target_i, target_p, package)
+""", """
+CREATE INDEX IF NOT EXISTS RefsByReferrer
+  ON Refs (package, referrer, relation, target_p, target_i)
+""", """
+DELETE FROM Refs
+""",]
+
+def _reference_triggers(name, table, columns, referrer, relation,
+                        target_p, target_i, when="1"):
+    """Return the statements populating Refs from a table, and maintaining it.
+
+    `referrer`, `relation`, `target_p`, `target_i` and `when` are SQL
+    expressions in which %(r)s stands for the row (new or old).
+    """
+    d = {"name": name, "table": table, "columns": columns}
+    for r in ("new", "old"):
+        d[r] = "%s.package, %s, %s, %s, %s" % (r, referrer, relation,
+                                               target_p, target_i) \
+               % {"r": r}
+        d[r+"_when"] = when % {"r": r}
+    d["delete"] = "DELETE FROM Refs WHERE package = old.package " \
+                  "AND referrer = %s AND relation = %s " \
+                  "AND target_p = %s AND target_i = %s" \
+                  % (referrer, relation, target_p, target_i) % {"r": "old"}
+    d["all"] = d["new"].replace("new.", "")
+    d["all_when"] = when % {"r": table}
+    return ["""
+INSERT INTO Refs SELECT %(all)s FROM %(table)s WHERE %(all_when)s
+""" % d, """
+CREATE TRIGGER IF NOT EXISTS %(name)sRefsInsert AFTER INSERT ON %(table)s
+WHEN %(new_when)s
+BEGIN
+  INSERT INTO Refs VALUES (%(new)s);
+END
+""" % d, """
+CREATE TRIGGER IF NOT EXISTS %(name)sRefsUpdate
+AFTER UPDATE OF %(columns)s ON %(table)s
+BEGIN
+  %(delete)s;
+  INSERT INTO Refs SELECT %(new)s WHERE %(new_when)s;
+END
+""" % d, """
+CREATE TRIGGER IF NOT EXISTS %(name)sRefsDelete AFTER DELETE ON %(table)s
+WHEN %(old_when)s
+BEGIN
+  %(delete)s;
+END
+""" % d,]
+
+_idref = "CASE %%(r)s.%s_p WHEN '' THEN %%(r)s.%s_i " \
+         "ELSE %%(r)s.%s_p||':'||%%(r)s.%s_i END"
+references += _reference_triggers(
+    "Annotations", "Annotations", "id, media_p, media_i",
+    "%(r)s.id", "'media'", "%(r)s.media_p", "%(r)s.media_i")
+references += _reference_triggers(
+    "Contents", "Contents", "element, model_p, model_i",
+    "%(r)s.element", "'content_model'", "%(r)s.model_p", "%(r)s.model_i",
+    "%(r)s.model_i != ''")
+references += _reference_triggers(
+    "RelationMembers", "RelationMembers", "relation, ord, member_p, member_i",
+    "%(r)s.relation", "':member '||%(r)s.ord",
+    "%(r)s.member_p", "%(r)s.member_i")
+references += _reference_triggers(
+    "ListItems", "ListItems", "list, ord, item_p, item_i",
+    "%(r)s.list", "':item '||%(r)s.ord", "%(r)s.item_p", "%(r)s.item_i")
+references += _reference_triggers(
+    "Tags", "Tagged", "element_p, element_i, tag_p, tag_i",
+    "''", "':tag '||" + _idref % (("element",)*4),
+    "%(r)s.tag_p", "%(r)s.tag_i")
+references += _reference_triggers(
+    "TaggedElements", "Tagged", "element_p, element_i, tag_p, tag_i",
+    "''", "':tagged '||" + _idref % (("tag",)*4),
+    "%(r)s.element_p", "%(r)s.element_i")
+references += _reference_triggers(
+    "Meta", "Meta", "element, key, value_p, value_i",
+    "%(r)s.element", "':meta '||%(r)s.key",
+    "%(r)s.value_p", "%(r)s.value_i", "%(r)s.value_i != ''")
+del _idref
+
+statements += references
+
+# element fingerprints: Fingerprints caches a digest of everything that
+# libadvene.model.core.diff compares for each element (see
+# _SqliteBackend.update_fingerprints); the triggers below delete the
+# fingerprint of an element whenever any of its data changes, so that a
+# cached fingerprint is always up to date
+fingerprints = ["""
+CREATE TABLE IF NOT EXISTS Fingerprints (
+  package     TEXT NOT NULL,
+  id          TEXT NOT NULL,
+  fingerprint TEXT NOT NULL,
+  PRIMARY KEY (package, id),
+  FOREIGN KEY (package, id) references Elements (package, id)
+  -- fingerprint is empty for elements whose data is not (entirely) in the
+  -- backend, which must always be compared
+)""",]
+
+def _fingerprint_triggers(name, table, element, when="1"):
+    """Return the statements invalidating Fingerprints on changes of a table.
+
+    `element` and `when` are SQL expressions in which %(r)s stands for the
+    row (new or old).
+    """
+    d = {"name": name, "table": table}
+    for r in ("new", "old"):
+        d[r] = "DELETE FROM Fingerprints WHERE package = %s.package " \
+               "AND id = %s AND %s" % (r, element, when) % {"r": r}
+    return ["""
+CREATE TRIGGER IF NOT EXISTS %(name)sFingerprintsInsert
+AFTER INSERT ON %(table)s
+BEGIN
+  %(new)s;
+END
+""" % d, """
+CREATE TRIGGER IF NOT EXISTS %(name)sFingerprintsUpdate
+AFTER UPDATE ON %(table)s
+BEGIN
+  %(old)s;
+  %(new)s;
+END
+""" % d, """
+CREATE TRIGGER IF NOT EXISTS %(name)sFingerprintsDelete
+AFTER DELETE ON %(table)s
+BEGIN
+  %(old)s;
+END
+""" % d,]
+
+fingerprints += _fingerprint_triggers("Elements", "Elements", "%(r)s.id")
+fingerprints += _fingerprint_triggers("Medias", "Medias", "%(r)s.id")
+fingerprints += _fingerprint_triggers("Annotations", "Annotations",
+                                      "%(r)s.id")
+fingerprints += _fingerprint_triggers("Imports", "Imports", "%(r)s.id")
+fingerprints += _fingerprint_triggers("Contents", "Contents",
+                                      "%(r)s.element")
+fingerprints += _fingerprint_triggers("Meta", "Meta", "%(r)s.element",
+                                      "%(r)s.element != ''")
+fingerprints += _fingerprint_triggers("RelationMembers", "RelationMembers",
+                                      "%(r)s.relation")
+fingerprints += _fingerprint_triggers("ListItems", "ListItems",
+                                      "%(r)s.list")
+fingerprints += _fingerprint_triggers("TaggedElements", "Tagged",
+                                      "%(r)s.element_i",
+                                      "%(r)s.element_p = ''")
+fingerprints += _fingerprint_triggers("Tags", "Tagged", "%(r)s.tag_i",
+                                      "%(r)s.tag_p = ''")
+
+statements += fingerprints
+
+# optional temporal index (requires the R*Tree module of sqlite); it is not
+# part of the versioned schema, but created by the backend whenever possible.
+# The R*Tree can only be keyed on integers, but the implicit rowid of
+# Annotations may be changed by a VACUUM: so annotations are given a stable
+# integer key in AnnotationKeys (an INTEGER PRIMARY KEY is never renumbered).
+# Since the R*Tree requires its lower bound to be less or equal to its upper
+# bound, while annotations may temporarily end before they begin (e.g. while
+# being moved), it stores the ordered bounds of each annotation; those are
+# stored exactly, as 32-bit integers.
+# The first statements remove the index of older versions, which was keyed on
+# the rowid of Annotations.
+temporal_index = """
+DROP TRIGGER IF EXISTS AnnotationExtentsInsert
+;--cut
+
+DROP TRIGGER IF EXISTS AnnotationExtentsUpdate
+;--cut
+
+DROP TRIGGER IF EXISTS AnnotationExtentsDelete
+;--cut
+
+DROP TABLE IF EXISTS AnnotationExtents
+;--cut
+
+CREATE TABLE AnnotationKeys (
+  key     INTEGER PRIMARY KEY,
+  package TEXT NOT NULL,
+  id      TEXT NOT NULL,
+  UNIQUE (package, id)
+)
+;--cut
+
+CREATE VIRTUAL TABLE AnnotationExtents USING rtree_i32 (key, fbegin, fend)
+;--cut
+
+INSERT INTO AnnotationKeys (package, id) SELECT package, id FROM Annotations
+;--cut
+
+INSERT INTO AnnotationExtents
+  SELECT k.key, min(a.fbegin, a.fend), max(a.fbegin, a.fend)
+  FROM AnnotationKeys k
+  JOIN Annotations a ON a.package = k.package AND a.id = k.id
+;--cut
+
+CREATE TRIGGER AnnotationExtentsInsert AFTER INSERT ON Annotations
+BEGIN
+  INSERT INTO AnnotationKeys (package, id) VALUES (new.package, new.id);
+  INSERT INTO AnnotationExtents
+  VALUES (last_insert_rowid(),
+          min(new.fbegin, new.fend), max(new.fbegin, new.fend));
+END
+;--cut
+
+CREATE TRIGGER AnnotationExtentsRename
+AFTER UPDATE OF package, id ON Annotations
+BEGIN
+  UPDATE AnnotationKeys SET package = new.package, id = new.id
+  WHERE package = old.package AND id = old.id;
+END
+;--cut
+
+CREATE TRIGGER AnnotationExtentsUpdate
+AFTER UPDATE OF fbegin, fend ON Annotations
+BEGIN
+  UPDATE AnnotationExtents
+  SET fbegin = min(new.fbegin, new.fend), fend = max(new.fbegin, new.fend)
+  WHERE key = (SELECT key FROM AnnotationKeys
+               WHERE package = new.package AND id = new.id);
+END
+;--cut
+
+CREATE TRIGGER AnnotationExtentsDelete AFTER DELETE ON Annotations
+BEGIN
+  DELETE FROM AnnotationExtents
+  WHERE key = (SELECT key FROM AnnotationKeys
+               WHERE package = old.package AND id = old.id);
+  DELETE FROM AnnotationKeys WHERE package = old.package AND id = old.id;
+END
+;--cut""".split(";--cut")[:-1]
+
+# optional full-text index (requires the FTS5 module of sqlite, with the
+# trigram tokenizer); like the temporal index, it is not part of the versioned
+# schema. It indexes the data of Contents so that substrings of at least 3
+# characters can be searched case-insensitively; it must only be used to
+# pre-select candidates, exact tests being done on data.
+# As for the temporal index, contents are given a stable integer key in
+# ContentsKeys, since the implicit rowid of Contents may be changed by a
+# VACUUM; the index reads the data through the ContentsTextData view.
+# External and packaged contents (non-empty url) have no data in the
+# database; they are listed by the partial index ContentsExternal.
+# The first statements remove the index of older versions, which was keyed on
+# the rowid of Contents.
+fulltext_index = """
+DROP TRIGGER IF EXISTS ContentsTextInsert
+;--cut
+
+DROP TRIGGER IF EXISTS ContentsTextUpdate
+;--cut
+
+DROP TRIGGER IF EXISTS ContentsTextDelete
+;--cut
+
+DROP TABLE IF EXISTS ContentsText
+;--cut
+
+CREATE TABLE ContentsKeys (
+  key     INTEGER PRIMARY KEY,
+  package TEXT NOT NULL,
+  element TEXT NOT NULL,
+  UNIQUE (package, element)
+)
+;--cut
+
+CREATE VIEW ContentsTextData AS
+  SELECT k.key AS key, c.data AS data
+  FROM ContentsKeys k
+  JOIN Contents c ON c.package = k.package AND c.element = k.element
+;--cut
+
+CREATE VIRTUAL TABLE ContentsText USING fts5 (
+  data, content='ContentsTextData', content_rowid='key', tokenize='trigram'
+)
+;--cut
+
+CREATE INDEX ContentsExternal ON Contents (package, element) WHERE url != ''
+;--cut
+
+INSERT INTO ContentsKeys (package, element)
+  SELECT package, element FROM Contents
+;--cut
+
+INSERT INTO ContentsText (ContentsText) VALUES ('rebuild')
+;--cut
+
+CREATE TRIGGER ContentsTextInsert AFTER INSERT ON Contents
+BEGIN
+  INSERT INTO ContentsKeys (package, element)
+  VALUES (new.package, new.element);
+  INSERT INTO ContentsText (rowid, data) VALUES (last_insert_rowid(), new.data);
+END
+;--cut
+
+CREATE TRIGGER ContentsTextUpdate
+AFTER UPDATE OF package, element, data ON Contents
+BEGIN
+  UPDATE ContentsKeys SET package = new.package, element = new.element
+  WHERE package = old.package AND element = old.element;
+  INSERT INTO ContentsText (ContentsText, rowid, data)
+  SELECT 'delete', key, old.data FROM ContentsKeys
+  WHERE package = new.package AND element = new.element;
+  INSERT INTO ContentsText (rowid, data)
+  SELECT key, new.data FROM ContentsKeys
+  WHERE package = new.package AND element = new.element;
+END
+;--cut
+
+CREATE TRIGGER ContentsTextDelete AFTER DELETE ON Contents
+BEGIN
+  INSERT INTO ContentsText (ContentsText, rowid, data)
+  SELECT 'delete', key, old.data FROM ContentsKeys
+  WHERE package = old.package AND element = old.element;
+  DELETE FROM ContentsKeys
+  WHERE package = old.package AND element = old.element;
+END
+;--cut""".split(";--cut")[:-1]
+
+# upgrade path: maps a backend version to a pair (next_version, statements),
+# where statements transform a database of the former version into one of the
+# latter
+upgrades = {
+  "1.2": ("1.3", indexes),
+  "1.3": ("1.4", references),
+  "1.4": ("1.5", fingerprints),
+}
@@ -1,4 +1,4 @@
-from libadvene.model.cam.consts import CAMSYS_TYPE
+from libadvene.model.cam.consts import CAM_TYPE, CAMSYS_TYPE
 from libadvene.model.core.element import LIST, TAG, ElementCollection
 from libadvene.model.core.group import GroupMixin
 
@@ -21,6 +21,36 @@ class CamGroupMixin(GroupMixin):
             self.iter_imports(),
         ))
 
+    def get_annotation_table(self, media=None, type=None):
+        """
+        Return an `AnnotationTable` of the annotations of this group, whose
+        labels are their annotation types.
+
+        If ``type`` is given, only the annotations of that type are included.
+        """
+        meta = None
+        if type is not None:
+            meta = [(CAM_TYPE, type)]
+        return super(CamGroupMixin, self) \
+            .get_annotation_table(media, CAM_TYPE, meta)
+
+    def join(self, types_a, types_b, relation="during", media=None):
+        """
+        Iter over the pairs (a, b) of annotations of this group where a is an
+        annotation of ``types_a``, b an annotation of ``types_b``, and a is
+        in the given temporal relation with b.
+
+        ``types_a`` and ``types_b`` are annotation types or iterables of
+        annotation types. See `annotation_table.temporal_join` for the
+        available relations.
+        """
+        table = self.get_annotation_table(media)
+        left = table.select(*_as_types(types_a))
+        right = table.select(*_as_types(types_b))
+        pairs = left.join(right, relation)
+        return ( (left.get_annotation(i), right.get_annotation(j))
+                 for i, j in pairs )
+
     def iter_user_tags(self):
         for t in self.iter_tags():
             if t.get_meta(CAMSYS_TYPE, None) is None:
@@ -117,3 +147,8 @@ class CamGroupMixin(GroupMixin):
                        and e.get_meta(CAMSYS_TYPE, None) == "schema" \
                        and e in group
         return GroupSchemas(group.owner)
+
+def _as_types(types):
+    if getattr(types, "ADVENE_TYPE", None) is not None:
+        return (types,)
+    return tuple(types)
@@ -287,6 +287,10 @@ class Package(CorePackage):
     tag_factory = Tag
     view_factory = View
 
+    # see bookkeeping.begin_deferred
+    _bk_deferred = None
+    _bk_deferred_level = 0
+
     def __init__(self, url, create=False, readonly=False, force=False,
                  parser=None):
         CorePackage.__init__(self, url, create, readonly, force, parser)
@@ -301,6 +305,24 @@ class Package(CorePackage):
         self.connect("tag::added", bk.update)
         self.connect("tag::removed", bk.update)
 
+    def begin_batch(self):
+        """Enter a batch section.
+
+        In addition to the behaviour of core packages, the bookkeeping
+        metadata are written only once for each modified element, at the end
+        of the section (see `bookkeeping.begin_deferred`).
+        """
+        super(Package, self).begin_batch()
+        bk.begin_deferred(self)
+
+    def end_batch(self):
+        """Exit a batch section (see `begin_batch`).
+        """
+        try:
+            bk.end_deferred(self)
+        finally:
+            super(Package, self).end_batch()
+
     def create_tag(self, id):
         """
         This method is inherited from core.Package but is unsafe on
@@ -4,9 +4,13 @@ from libadvene.model.cam.consts import CAMSYS_TYPE, CAM_NS_PREFIX
 from libadvene.model.cam.element import CamElementMixin
 from libadvene.model.cam.exceptions import LikelyMistake
 from libadvene.model.cam.group import CamGroupMixin
-from libadvene.model.core.element import LIST, RESOURCE, VIEW, ElementCollection
+from libadvene.model.core.annotation_table import ALLEN_RELATIONS
+from libadvene.model.core.element import LIST, RESOURCE, VIEW, \
+                                         ElementCollection, \
+                                         ElementCollectionWrapper
 from libadvene.model.core.tag import Tag as CoreTag
-from libadvene.model.tales import tales_property, tales_use_as_context
+from libadvene.model.tales import tales_property, tales_use_as_context, \
+                                  tales_path1_function
 from libadvene.model.view.type_constraint import apply_to
 from libadvene.util.alias import alias
 from libadvene.util.autoproperty import autoproperty
@@ -192,13 +196,60 @@ class CamTypeMixin(object):
         pass
 
 
+def _make_tales_relation(relation):
+    """
+    Make a TALES property for annotation types, returning the annotations of
+    the type in the given temporal relation with at least one annotation of
+    another type, given by its id in ``package``.
+
+    E.g. ``here/during/shot`` lists the annotations of ``here`` during a
+    ``shot`` annotation.
+    """
+    @tales_property
+    @tales_use_as_context("package")
+    def _tales_relation(type_, package):
+        @tales_path1_function
+        def related_to(id):
+            other = package.get(id)
+            if other is None:
+                return ElementCollectionWrapper([], package)
+            table = package.all.get_annotation_table()
+            left = table.select(type_)
+            right = table.select(other)
+            found = set( i for i, j in left.join(right, relation) )
+            left = left.take(sorted(found))
+            return ElementCollectionWrapper(list(left.iter_annotations()),
+                                            package)
+        return related_to
+    return _tales_relation
+
 class AnnotationType(CamTypeMixin, Tag):
     """
     The class of annotation types.
     """
     # This class is automatically transtyped from Tag (and back) when
     # CAMSYS_TYPE is modified. See Tag.set_meta
-    pass
+
+    def join(self, types, relation="during", package=None, media=None):
+        """
+        Iter over the pairs (a, b) of annotations where a is an annotation of
+        this type, b an annotation of ``types`` (an annotation type or an
+        iterable of annotation types), and a is in the given temporal
+        relation with b.
+
+        The annotations are searched in ``package`` (session.package if
+        None). See `CamGroupMixin.join`.
+        """
+        if package is None:
+            package = session.package
+        if package is None:
+            raise TypeError("no package set in session, must be specified")
+        return package.all.join(self, types, relation, media)
+
+for _relation in ALLEN_RELATIONS:
+    setattr(AnnotationType, "_tales_%s" % _relation,
+            _make_tales_relation(_relation))
+del _relation
 
 class RelationType(CamTypeMixin, Tag):
     """
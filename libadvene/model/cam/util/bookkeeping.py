@@ -20,10 +20,7 @@ def init(package, obj):
         obj.set_meta(MODIFIED, d)
     obj.exit_no_event_section()
     if obj is not package:
-        package.enter_no_event_section(); \
-            package.set_meta(CONTRIBUTOR, u); \
-            package.set_meta(MODIFIED, d)
-        package.exit_no_event_section()
+        _update_package(package, d, u)
 
 def update(obj, *args):
     d,u = _make_bookkeeping_data()
@@ -34,19 +31,21 @@ def update(obj, *args):
             u = args[1]
         elif args[0] == MODIFIED:
             d = args[1]
-    obj.enter_no_event_section(); \
-        obj.set_meta(CONTRIBUTOR, u); \
-        obj.set_meta(MODIFIED, d)
-    obj.exit_no_event_section()
+    deferred = getattr(obj, "_owner", obj)._bk_deferred
+    if deferred is not None:
+        deferred[obj] = (d, u)
+        return
+    _write(obj, d, u)
 
 def update_owner(obj, *args):
     d,u = _make_bookkeeping_data()
     #d = "%s %s" % (d, args) # debug
     package = obj._owner
-    package.enter_no_event_section(); \
-        package.set_meta(CONTRIBUTOR, u); \
-        package.set_meta(MODIFIED, d)
-    package.exit_no_event_section()
+    deferred = package._bk_deferred
+    if deferred is not None:
+        # obj is deleted, its bookkeeping data must not be written
+        deferred.pop(obj, None)
+    _update_package(package, d, u)
 
 def update_element(obj, *args):
     #import pdb; pdb.set_trace()
@@ -55,16 +54,59 @@ def update_element(obj, *args):
     # and since it is going to be called *many* times...
     d,u = _make_bookkeeping_data()
     package = obj._owner
-    package.enter_no_event_section(); \
-        package.set_meta(CONTRIBUTOR, u); \
-        package.set_meta(MODIFIED, d)
-    package.exit_no_event_section()
+    deferred = package._bk_deferred
+    if deferred is None:
+        _write(package, d, u)
+    else:
+        deferred[package] = (d, u)
     if len(args) == 2:
         # setting CONTRIBUTOR or MODIFIED should work anyway
         if args[0] == CONTRIBUTOR:
             u = args[1]
         elif args[0] == MODIFIED:
             d = args[1]
+    if deferred is None:
+        _write(obj, d, u)
+    else:
+        deferred[obj] = (d, u)
+
+def begin_deferred(package):
+    """Defer the bookkeeping updates of package and its elements.
+
+    Until the matching call to `end_deferred`, the CONTRIBUTOR and MODIFIED
+    metadata are not written on each modification; instead, the last values
+    for each element (and for the package) are recorded, and written only
+    once by `end_deferred`. Calls can be nested.
+
+    Note that those metadata are therefore not up to date in the meantime.
+    """
+    if package._bk_deferred_level == 0:
+        package._bk_deferred = {}
+    package._bk_deferred_level += 1
+
+def end_deferred(package):
+    """Write the bookkeeping updates deferred since `begin_deferred`."""
+    assert package._bk_deferred_level > 0
+    package._bk_deferred_level -= 1
+    if package._bk_deferred_level > 0:
+        return
+    deferred = package._bk_deferred
+    package._bk_deferred = None
+    # the package is written last, so that its MODIFIED date is the latest
+    p = deferred.pop(package, None)
+    for obj, (d, u) in deferred.iteritems():
+        _write(obj, d, u)
+    if p is not None:
+        _write(package, *p)
+
+def _update_package(package, d, u):
+    deferred = package._bk_deferred
+    if deferred is None:
+        _write(package, d, u)
+    else:
+        deferred[package] = (d, u)
+
+def _write(obj, d, u):
     obj.enter_no_event_section(); \
         obj.set_meta(CONTRIBUTOR, u); \
         obj.set_meta(MODIFIED, d)
@@ -1,6 +1,7 @@
 """I define class AllGroup.
 """
 
+from libadvene.model.core.annotation_table import AnnotationTable
 from libadvene.model.core.group import GroupMixin
 from libadvene.model.core.own_group import _prepare_meta
 from libadvene.util.autoproperty import autoproperty
@@ -50,8 +51,25 @@ class AllGroup(GroupMixin, object):
     def iter_annotations(self, media=None,
                                begin=None, begin_min=None, begin_max=None,
                                end=None, end_min=None, end_max=None,
-                               at=None):
+                               at=None, with_content=False,
+                               meta=None, data_contains=None,
+                               data_matches=None):
         """FIXME: missing docstring.
+
+        If ``with_content`` is true, the content data of the annotations is
+        fetched along with them, rather than with one query per annotation.
+
+        ``meta`` filters the annotations as in `iter_tags`; if
+        ``data_contains`` is given, only the annotations whose content data
+        contains that string are yielded (and those with an external content,
+        which the backends can not check).
+
+        ``data_matches`` is a triple (all_of, any_of, none_of) of sequences of
+        strings, used by the backends to pre-select the annotations through
+        their full-text index, if any. The result is only a superset of the
+        annotations whose content data contain all the strings of all_of, one
+        of any_of and none of none_of, so their content data must still be
+        checked (see the `iter_annotations` method of backends).
         """
         o = self._owner
 
@@ -62,16 +80,39 @@ class AllGroup(GroupMixin, object):
             media = (m._get_uriref() for m in media)
         if at is not None:
             begin_max = end_min = at
+        if meta: meta = _prepare_meta(meta)
         def annotation_iterator(be, pdict):
             for i in be.iter_annotations(pdict, None, media,
                                                 begin, begin_min, begin_max,
-                                                end, end_min, end_max):
+                                                end, end_min, end_max,
+                                                with_content,
+                                                meta, data_contains,
+                                                data_matches):
                 yield pdict[i[1]].get_element(i)
         all_annotation_iterators = [ annotation_iterator(be, pdict)
                                      for be, pdict
                                      in o._backends_dict.items() ]
         return interclass(*all_annotation_iterators)
 
+    def get_annotation_table(self, media=None, key=None, meta=None):
+        """
+        Return an `AnnotationTable` of the annotations of this group.
+
+        The ``categories`` of the table are the values of the ``key``
+        metadata of the annotations; ``media`` and ``meta`` filter the
+        annotations as in `iter_annotations` and `iter_tags`.
+        """
+        if hasattr(media, '_get_uriref'):
+            media = media._get_uriref()
+        elif media is not None:
+            # It should be a sequence/iterator of medias
+            media = [ m._get_uriref() for m in media ]
+        if meta: meta = _prepare_meta(meta)
+        o = self._owner
+        return AnnotationTable.from_backends([
+            (pdict, be.iter_annotation_extents(pdict, media, key, meta))
+            for be, pdict in o._backends_dict.items() ])
+
     def iter_relations(self, member=None, position=None):
         """FIXME: missing docstring.
         """
@@ -132,7 +173,7 @@ class AllGroup(GroupMixin, object):
     def count_annotations(self, media=None,
                                begin=None, begin_min=None, begin_max=None,
                                end=None, end_min=None, end_max=None,
-                               at=None):
+                               at=None, meta=None, data_contains=None):
         o = self._owner
         if hasattr(media, '_get_uriref'):
             media = media._get_uriref()
@@ -141,9 +182,11 @@ class AllGroup(GroupMixin, object):
             media = (m._get_uriref() for m in media)
         if at is not None:
             begin_max = end_min = at
+        if meta: meta = _prepare_meta(meta)
         return sum( be.count_annotations(pdict, None, media,
                                                begin, begin_min, begin_max,
-                                               end, end_min, end_max)
+                                               end, end_min, end_max,
+                                               meta, data_contains)
                     for be, pdict in o._backends_dict.items() )
 
     def count_relations(self, member=None, position=None):
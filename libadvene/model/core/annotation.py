@@ -37,7 +37,7 @@ class Annotation(PackageElement, WithContentMixin):
         r._end = end
         r._media_id = media
         r._media = None
-        r._instantiate_content(mimetype, model, url)
+        r._instantiate_content(mimetype, model, url, *args[:1])
         return r
 
     @classmethod
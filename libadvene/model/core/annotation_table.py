@@ -0,0 +1,387 @@
+"""
+I define the class AnnotationTable.
+
+An annotation table is a compact, column-oriented snapshot of the temporal
+extents of a set of annotations, for analyses (durations, overlaps,
+coverage, histograms...) that would otherwise build one Annotation instance
+per row and access its attributes one at a time.
+
+Tables are built from a single backend query per backend (see
+`get_annotation_table` in `OwnGroup` and `AllGroup`). Their numerical columns
+are NumPy arrays if NumPy is available, else `array.array` instances; all the
+methods below work in both cases, NumPy only making them faster.
+
+Note that a table is a snapshot: it is not updated when the annotations are
+modified.
+
+Tables can also be joined on the Allen-like relations supported by rule
+conditions (see `temporal_join`).
+"""
+
+from array import array
+from bisect import bisect_left
+from itertools import chain
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class AnnotationTable(object):
+    """
+    A columnar snapshot of annotations, sorted by begin and end.
+
+    @ivar begins: the begin of each annotation
+    @ivar ends: the end of each annotation
+    @ivar categories: for each annotation, the index in `labels` of the
+      metadata requested when building the table, or -1 if it had none
+    @ivar labels: the distinct values of that metadata, as elements for
+      element-valued metadata (or id-refs if they can not be reached),
+      as strings otherwise
+    @ivar ids: the id of each annotation in its owner package
+    @ivar owners: for each annotation, the index in `packages` of its owner
+    @ivar packages: the owner packages of the annotations
+    """
+
+    def __init__(self, begins, ends, categories, labels, ids, owners,
+                 packages):
+        self.begins = _column("l", begins)
+        self.ends = _column("l", ends)
+        self.categories = _column("i", categories)
+        self.labels = labels
+        self.ids = ids
+        self.owners = _column("i", owners)
+        self.packages = packages
+
+    @classmethod
+    def from_backends(cls, sources):
+        """
+        Build a table from the output of the `iter_annotation_extents` method
+        of one or several backends.
+
+        ``sources`` is a list of pairs (pdict, rows), where pdict maps the
+        package ids of the backend to packages.
+        """
+        rows = []
+        for pdict, it in sources:
+            # package ids are only unique inside a backend
+            rows.extend( (pdict[r[0]],) + r[1:] for r in it )
+        if len(sources) > 1:
+            rows.sort(key=lambda r: (r[2], r[3]))
+
+        packages = []
+        package_index = {}
+        labels = []
+        label_index = {}
+        value_index = {}
+        begins = []; ends = []; categories = []; ids = []; owners = []
+        for p, id, begin, end, value, value_is_id in rows:
+            o = package_index.get(p)
+            if o is None:
+                o = package_index[p] = len(packages)
+                packages.append(p)
+            if value is None:
+                c = -1
+            else:
+                c = value_index.get((o, value))
+                if c is None:
+                    label = value
+                    if value_is_id:
+                        label = p.get(value, value)
+                    c = label_index.get(label)
+                    if c is None:
+                        c = label_index[label] = len(labels)
+                        labels.append(label)
+                    value_index[o, value] = c
+            begins.append(begin)
+            ends.append(end)
+            categories.append(c)
+            ids.append(id)
+            owners.append(o)
+        return cls(begins, ends, categories, labels, ids, owners, packages)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_annotation(self, i):
+        """Return the i-th annotation of this table."""
+        return self.packages[self.owners[i]].get(self.ids[i])
+
+    def iter_annotations(self):
+        """Iter over the annotations of this table, in the table order."""
+        packages = self.packages
+        owners = self.owners
+        for i, id in enumerate(self.ids):
+            yield packages[owners[i]].get(id)
+
+    def durations(self):
+        """Return the column of the durations of the annotations."""
+        if numpy is not None:
+            return self.ends - self.begins
+        return array("l", [ e-b for b, e in zip(self.begins, self.ends) ])
+
+    def take(self, indices):
+        """Return a new table with the given rows of this table.
+
+        The labels and packages are shared with this table.
+        """
+        if numpy is not None:
+            indices = numpy.asarray(indices, dtype=int)
+            ids = self.ids
+            return AnnotationTable(self.begins[indices],
+                                   self.ends[indices],
+                                   self.categories[indices],
+                                   self.labels,
+                                   [ ids[i] for i in indices ],
+                                   self.owners[indices],
+                                   self.packages)
+        return AnnotationTable([ self.begins[i] for i in indices ],
+                               [ self.ends[i] for i in indices ],
+                               [ self.categories[i] for i in indices ],
+                               self.labels,
+                               [ self.ids[i] for i in indices ],
+                               [ self.owners[i] for i in indices ],
+                               self.packages)
+
+    def select(self, *labels):
+        """Return a new table with only the annotations with one of the given
+        labels.
+        """
+        cs = [ self.labels.index(label) for label in labels
+               if label in self.labels ]
+        if not cs:
+            return self.take(())
+        if numpy is not None:
+            return self.take(numpy.flatnonzero(numpy.in1d(self.categories,
+                                                          cs)))
+        cs = set(cs)
+        return self.take([ i for i, k in enumerate(self.categories)
+                           if k in cs ])
+
+    def overlapping(self, begin, end):
+        """Return the indices of the annotations overlapping [begin, end[.
+        """
+        if numpy is not None:
+            n = numpy.searchsorted(self.begins, end, "left")
+            return numpy.flatnonzero(self.ends[:n] > begin)
+        n = bisect_left(self.begins, end)
+        ends = self.ends
+        return [ i for i in xrange(n) if ends[i] > begin ]
+
+    def overlap_pairs(self):
+        """Return the list of the pairs (i,j) of overlapping annotations.
+
+        In each pair, i < j, so annotation j begins during annotation i.
+        """
+        begins, ends = self.begins, self.ends
+        if numpy is not None:
+            # annotations i+1 to stops[i]-1 begin before i ends
+            stops = numpy.searchsorted(begins, ends, "left")
+            counts = numpy.maximum(stops - numpy.arange(1, len(begins)+1), 0)
+            firsts = numpy.repeat(numpy.arange(len(begins)), counts)
+            offsets = numpy.arange(counts.sum()) \
+                    - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+            return zip(firsts.tolist(), (firsts + offsets + 1).tolist())
+        r = []
+        n = len(begins)
+        for i in xrange(n):
+            e = ends[i]
+            j = i+1
+            while j < n and begins[j] < e:
+                r.append((i, j))
+                j += 1
+        return r
+
+    def coverage(self):
+        """Return the total time covered by at least one annotation."""
+        if len(self) == 0:
+            return 0
+        begins, ends = self.begins, self.ends
+        if numpy is not None:
+            reach = numpy.maximum.accumulate(ends)
+            starts = begins.copy()
+            starts[1:] = numpy.maximum(begins[1:], reach[:-1])
+            return int(numpy.maximum(ends - starts, 0).sum())
+        total = 0
+        reach = begins[0]
+        for b, e in zip(begins, ends):
+            if e > reach:
+                total += e - max(b, reach)
+                reach = e
+        return total
+
+    def gaps(self, begin=None, end=None):
+        """Return the list of the (begin, end) intervals covered by no
+        annotation.
+
+        Only the intervals between ``begin`` and ``end`` are considered; they
+        default to the begin of the first annotation and the maximum end.
+        """
+        begins, ends = self.begins, self.ends
+        if len(self) == 0:
+            if begin is None or end is None or begin >= end:
+                return []
+            return [(begin, end)]
+        if numpy is not None:
+            reach = numpy.maximum.accumulate(ends)
+            holes = numpy.flatnonzero(begins[1:] > reach[:-1])
+            r = zip(reach[holes].tolist(), begins[holes+1].tolist())
+            last = int(reach[-1])
+        else:
+            r = []
+            reach = ends[0]
+            for b, e in zip(begins[1:], ends[1:]):
+                if b > reach:
+                    r.append((reach, b))
+                if e > reach:
+                    reach = e
+            last = reach
+        if begin is not None:
+            r = [ (max(b, begin), e) for b, e in r if e > begin ]
+            if begin < begins[0]:
+                r.insert(0, (begin, begins[0]))
+        if end is not None:
+            r = [ (b, min(e, end)) for b, e in r if b < end ]
+            if begin is not None:
+                last = max(last, begin)
+            if end > last:
+                r.append((last, end))
+        return r
+
+    def histogram(self):
+        """Return a list of (label, count, total duration) triples.
+
+        The label is None for the annotations without the metadata requested
+        when building the table.
+        """
+        n = len(self.labels)
+        if numpy is not None:
+            keys = self.categories + 1
+            counts = numpy.bincount(keys, minlength=n+1)
+            totals = numpy.bincount(keys, self.durations(), minlength=n+1)
+            counts = counts.tolist()
+            totals = [ int(t) for t in totals ]
+        else:
+            counts = [0] * (n+1)
+            totals = [0] * (n+1)
+            for c, d in zip(self.categories, self.durations()):
+                counts[c+1] += 1
+                totals[c+1] += d
+        r = [ (label, counts[i+1], totals[i+1])
+              for i, label in enumerate(self.labels) ]
+        if counts[0]:
+            r.append((None, counts[0], totals[0]))
+        return r
+
+    def join(self, other, relation):
+        """Iter over the pairs (i,j) where annotation i of this table is in
+        the given relation with annotation j of table ``other``.
+
+        See `temporal_join`.
+        """
+        return temporal_join(self, other, relation)
+
+ALLEN_RELATIONS = ("before", "meets", "overlaps", "during", "starts",
+                   "finishes")
+
+def temporal_join(left, right, relation):
+    """
+    Iter over the pairs (i,j) where annotation i of table ``left`` is in the
+    given relation with annotation j of table ``right``.
+
+    The relations have the same meaning as the corresponding operators of
+    rule conditions, a being an annotation of ``left`` and b an annotation of
+    ``right``:
+
+      - before: a ends before (or when) b begins
+      - meets: a ends when b begins
+      - overlaps: a and b have at least one instant in common
+      - during: a begins and ends within b
+      - starts: a and b begin at the same time
+      - finishes: a and b end at the same time
+
+    The pairs are generated lazily, by sweeping over the begins and ends of
+    both tables (or through a hash join for the equalities), so that the
+    cost is proportional to the size of the tables and of the result rather
+    than to the product of the table sizes. They are not generated in any
+    particular order.
+    """
+    if relation not in ALLEN_RELATIONS:
+        raise ValueError("unknown temporal relation %r" % (relation,))
+    lb, le = left.begins.tolist(), left.ends.tolist()
+    rb, re = right.begins.tolist(), right.ends.tolist()
+    if relation == "meets":
+        return _equi_join(le, rb)
+    elif relation == "starts":
+        return _equi_join(lb, rb)
+    elif relation == "finishes":
+        return _equi_join(le, re)
+    elif relation == "before":
+        return _before_join(le, rb)
+    elif relation == "overlaps":
+        return _overlap_join(lb, le, rb, re)
+    else:
+        return _during_join(lb, le, rb, re)
+
+def _equi_join(lkeys, rkeys):
+    index = {}
+    for j, k in enumerate(rkeys):
+        index.setdefault(k, []).append(j)
+    for i, k in enumerate(lkeys):
+        for j in index.get(k, ()):
+            yield i, j
+
+def _before_join(lends, rbegins):
+    # the annotations of left ending before a given time are a prefix of left
+    # sorted by end, growing with the begins of right
+    by_end = sorted(xrange(len(lends)), key=lends.__getitem__)
+    n = 0
+    for j in sorted(xrange(len(rbegins)), key=rbegins.__getitem__):
+        b = rbegins[j]
+        while n < len(by_end) and lends[by_end[n]] <= b:
+            n += 1
+        for k in xrange(n):
+            yield by_end[k], j
+
+def _overlap_join(lb, le, rb, re):
+    # each overlapping pair is found when its latest annotation begins,
+    # while the other one is still active (i.e. not ended yet)
+    events = sorted(chain(( (b, 0, i) for i, b in enumerate(lb) ),
+                          ( (b, 1, j) for j, b in enumerate(rb) )))
+    active = ([], [])
+    ends = (le, re)
+    for t, side, i in events:
+        other = active[1-side]
+        other_ends = ends[1-side]
+        other[:] = [ k for k in other if other_ends[k] >= t ]
+        if side == 0:
+            for k in other:
+                yield i, k
+        else:
+            for k in other:
+                yield k, i
+        active[side].append(i)
+
+def _during_join(lb, le, rb, re):
+    # at the begin of each annotation of left, the candidate containers are
+    # the active annotations of right (those beginning at the same time
+    # included, hence the order of the events)
+    events = sorted(chain(( (b, 1, i) for i, b in enumerate(lb) ),
+                          ( (b, 0, j) for j, b in enumerate(rb) )))
+    active = []
+    for t, side, i in events:
+        if side == 0:
+            active.append(i)
+            continue
+        active[:] = [ k for k in active if re[k] >= t ]
+        e = le[i]
+        for k in active:
+            if re[k] >= e:
+                yield i, k
+
+def _column(typecode, values):
+    if numpy is not None:
+        return numpy.asarray(values, dtype=typecode)
+    elif isinstance(values, array):
+        return values
+    return array(typecode, values)
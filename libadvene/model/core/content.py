@@ -121,17 +121,22 @@ class WithContentMixin:
 
     __cached_content = staticmethod(lambda: None)
 
-    def _instantiate_content(self, mimetype, model, url):
+    def _instantiate_content(self, mimetype, model, url, data=None):
         """
         This is method is for optimization only: it is not strictly required
         (though recommended) to call it at instantiate time (see class
         docstring).
 
+        If the backend data of the content was fetched along with the other
+        attributes, it can be passed as ``data`` to be cached.
+
         No integrity constraint is checked: the backend is assumed to be sane.
         """
         self.__mimetype = mimetype
         self.__model_id = model
         self.__url = url
+        if data is not None and not url:
+            self.__data = safe_decode(data, self)
         self._update_content_handler()
         self.enter_no_event_section()
         self._automanage_storage()
@@ -706,11 +711,15 @@ class PackagedDataFile(file):
     This class fulfils two purposes:
 
     * create the packaged file when it does not exist (useful because ZIP
-      archives do not store empty files)
+      archives do not store empty files), or extract it lazily from the
+      archive the package was parsed from
     * notify the content when the file is closed
     """
     __slots__ = ["_element",]
     def __init__(self, filename, element):
+        archive = element._owner._packaged_archive
+        if archive is not None and not exists(filename):
+            archive.extract(filename)
         if exists(filename):
             file.__init__ (self, filename, "r+")
         else:
@@ -1,4 +1,14 @@
-"""I provide functions to compare elements and packages."""
+"""I provide functions to compare elements and packages.
+
+When comparing packages, the fingerprints maintained by the backend (see
+`update_fingerprints` in the sqlite backend) are compared first, so that only
+the elements which actually differ are built and compared attribute by
+attribute.
+"""
+
+from libadvene.model.backends.exceptions import InternalError
+from libadvene.model.core.element import MEDIA, ANNOTATION, RELATION, VIEW, \
+                                         RESOURCE, TAG, LIST, QUERY, IMPORT
 
 def diff_medias(m1, m2):
     return _diff_attr(m1, m2, "url") \
@@ -51,8 +61,19 @@ def diff_imports(i1, i2):
          + _diff_tags(i1, i2) \
          + _diff_meta(i1, i2)
 
-def diff_packages(p1, p2):
-    "returns the list of operation to perform on p2 to make it like p1"
+def diff_packages(p1, p2, update=True):
+    """Return the list of operation to perform on p2 to make it like p1.
+
+    Unless `update` is false, the missing fingerprints of both packages are
+    first computed and stored in their backends (see `update_fingerprints`);
+    this does not modify the packages, but it does write into the backends,
+    so callers which do not own the packages may rather pass update=False.
+    The elements without an up-to-date fingerprint are then compared
+    attribute by attribute.
+    """
+    if update:
+        update_fingerprints(p1)
+        update_fingerprints(p2)
     return _diff_attr(p1, p2, "uri") \
          + _diff_meta(p1, p2) \
          + _diff_elt_lists(p1, p2, "imports") \
@@ -66,6 +87,46 @@ def diff_packages(p1, p2):
          + _diff_elt_lists(p1, p2, "resources") \
          + _diff_external_tag_associations(p1, p2)
 
+def update_fingerprints(p):
+    """Compute the missing fingerprints of the own elements of package p.
+
+    The fingerprints are stored in the backend of p, in a transaction of its
+    own. This is done by `diff_packages`, and should be done before calling
+    `iter_changed_ids`.
+
+    Return False if the fingerprints could not be updated, because p is
+    read-only or because of a backend error; its elements without a
+    fingerprint will then be considered as changed.
+    """
+    if p._readonly:
+        return False
+    try:
+        p._backend.update_fingerprints(p._id)
+    except InternalError:
+        return False
+    return True
+
+def iter_changed_ids(p1, p2, element_type):
+    """Yield triples (id, in_p1, in_p2) for all the own elements of the given
+    type which may differ between packages p1 and p2, ordered by id.
+
+    ``in_p1`` and ``in_p2`` tell whether the element exists in each package;
+    if both are true, the elements must still be compared attribute by
+    attribute, since their fingerprints are only known to be different (or
+    unknown, if they have not been computed by `update_fingerprints`).
+
+    This only reads the backends.
+    """
+    l1 = p1._backend.iter_fingerprints(p1._id, element_type)
+    l2 = p2._backend.iter_fingerprints(p2._id, element_type)
+    for e1, e2 in _xzip(l1, l2, lambda x: x[0]):
+        if e1 is None:
+            yield e2[0], False, True
+        elif e2 is None:
+            yield e1[0], True, False
+        elif not e1[1] or e1[1] != e2[1]:
+            yield e1[0], True, True
+
 # utility functions
 
 def _diff_attr(elt1, elt2, attr):
@@ -161,18 +222,22 @@ def _diff_meta(obj1, obj2):
             r.append(("set_meta", id, typ, i1[0], i1[1], i1[1].is_id))
     return r
 
+_ELEMENT_TYPES = {
+    "medias": MEDIA, "annotations": ANNOTATION, "relations": RELATION,
+    "views": VIEW, "resources": RESOURCE, "tags": TAG, "lists": LIST,
+    "queries": QUERY, "imports": IMPORT,
+}
+
 def _diff_elt_lists(p1, p2, name):
-    l1 = _sorted_list(getattr(p1.own, name), key=lambda x: x._id)
-    l2 = _sorted_list(getattr(p2.own, name), key=lambda x: x._id)
     diff_ = globals()["diff_%s" % name]
     r = []
-    for e1, e2 in _xzip(l1, l2, lambda x: x._id):
-        if e1 is None:
-            r.append(_delete(e2))
-        elif e2 is None:
-            r.append(_create(e1))
+    for id, in1, in2 in iter_changed_ids(p1, p2, _ELEMENT_TYPES[name]):
+        if not in1:
+            r.append(_delete(id))
+        elif not in2:
+            r.append(_create(p1.get(id)))
         else:
-            r.extend(diff_(e1, e2))
+            r.extend(diff_(p1.get(id), p2.get(id)))
     return r
 
 def _diff_external_tag_associations(p1, p2):
@@ -186,8 +251,8 @@ def _diff_external_tag_associations(p1, p2):
             r.append(("associate_tag", a1[0], a1[1]))
     return r
 
-def _delete(elt):
-    return ("", "delete_element", elt._id)
+def _delete(id):
+    return ("", "delete_element", id)
 
 def _create(elt):
     return ("<create>", elt)
@@ -198,21 +263,26 @@ def _sorted_list(it, cmp=None, key=None, reverse=False):
     return r
 
 def _xzip(l1, l2, idfier=lambda x:x):
-    i1 = 0; i2 = 0
-    while i1 < len(l1) and i2 < len(l2):
-        id1 = idfier(l1[i1])
-        id2 = idfier(l2[i2])
+    # l1 and l2 are sorted iterables (possibly iterators)
+    _end = object()
+    i1 = iter(l1); i2 = iter(l2)
+    x1 = next(i1, _end); x2 = next(i2, _end)
+    while x1 is not _end and x2 is not _end:
+        id1 = idfier(x1)
+        id2 = idfier(x2)
         if id1 == id2:
-            yield l1[i1], l2[i2]
-            i1 += 1
-            i2 += 1
+            yield x1, x2
+            x1 = next(i1, _end)
+            x2 = next(i2, _end)
         elif id1 > id2:
-            yield None, l2[i2]
-            i2 += 1
+            yield None, x2
+            x2 = next(i2, _end)
         else:
-            yield l1[i1], None
-            i1 += 1
-    for i in l1[i1:]:
-        yield i, None
-    for i in l2[i2:]:
-        yield None, i
+            yield x1, None
+            x1 = next(i1, _end)
+    while x1 is not _end:
+        yield x1, None
+        x1 = next(i1, _end)
+    while x2 is not _end:
+        yield None, x2
+        x2 = next(i2, _end)
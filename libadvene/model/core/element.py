@@ -41,6 +41,11 @@ _package_event_template = {
         RESOURCE   : 'resource::%s',
 }
 
+_package_signals = dict( (typ, {}) for typ in _package_event_template )
+# maps, for each element type, each element signal to the corresponding
+# package signal and its undetailed name (filled lazily by
+# `PackageElement.emit`)
+
 class PackageElement(WithMetaMixin, WithEventsMixin, WithAbsUrlMixin, object):
     """
     I am the common subclass of all package element.
@@ -238,6 +243,24 @@ class PackageElement(WithMetaMixin, WithEventsMixin, WithAbsUrlMixin, object):
             for pid, eid, rel in be.iter_references(d, self._get_uriref()):
                 yield Reference(self, d[pid], eid, rel)
 
+    def has_references(self, package=None):
+        """
+        Return True iff some references are made to this element.
+
+        The packages searched are the same as for `iter_references`. This is
+        much cheaper than iterating over the references.
+        """
+        o = self._owner
+        if package is None:
+            referrers = o._get_referrers()
+        else:
+            referrers = {package._backend : {package._id : package}}
+        uriref = self._get_uriref()
+        for be, d in referrers.iteritems():
+            if be.has_references(d, uriref):
+                return True
+        return False
+
     def delete(self):
         """
         Delete this element.
@@ -254,6 +277,8 @@ class PackageElement(WithMetaMixin, WithEventsMixin, WithAbsUrlMixin, object):
         self._owner._backend.delete_element(self._owner._id, self._id,
                                             self.ADVENE_TYPE)
         del self._owner._elements[self._id]
+        if self._owner._recent_elements is not None:
+            self._owner._recent_elements.discard(self._id)
         self.emit("deleted")
         self.__class__ = DeletedPackageElement
 
@@ -285,6 +310,8 @@ class PackageElement(WithMetaMixin, WithEventsMixin, WithAbsUrlMixin, object):
         # actually renaming
         del o._elements[old_id]
         o._elements[new_id] = self
+        if o._recent_elements is not None:
+            o._recent_elements.discard(old_id)
         self._id = new_id
         # updating caches of packages and instantiated elements
         new_uriref = self._get_uriref()
@@ -498,15 +525,17 @@ class PackageElement(WithMetaMixin, WithEventsMixin, WithAbsUrlMixin, object):
         package signal corresponding to each element signal.
         """
         WithEventsMixin.emit(self, detailed_signal, *args)
-        def lazy_params():
+        package_signals = _package_signals[self.ADVENE_TYPE]
+        t = package_signals.get(detailed_signal)
+        if t is None:
             colon = detailed_signal.find(":")
             if colon > 0: s = detailed_signal[:colon]
             else: s = detailed_signal
-            yield _package_event_template[self.ADVENE_TYPE] % s
-            yield self
-            yield s
-            yield args
-        self._owner.emit_lazy(lazy_params)
+            t = package_signals[detailed_signal] = \
+                (_package_event_template[self.ADVENE_TYPE] % s, s)
+        o = self._owner
+        if o.has_handlers_for(t[0]):
+            o.emit(t[0], self, t[1], args)
 
     def connect(self, detailed_signal, handler, *args):
         """
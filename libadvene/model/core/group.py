@@ -111,6 +111,8 @@ class GroupMixin(object):
     @property
     def annotations(group):
         class GroupAnnotations(ElementCollection):
+            # used by query planners to call iter_annotations with filters
+            _group = group
             __iter__ = group.iter_annotations
             __len__ = group.count_annotations
             def __contains__(self, e):
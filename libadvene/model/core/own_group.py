@@ -4,6 +4,7 @@ I define the class OwnGroup.
 This class is intended to be used only inside class Package.
 """
 
+from libadvene.model.core.annotation_table import AnnotationTable
 from libadvene.model.core.group import GroupMixin
 from libadvene.util.autoproperty import autoproperty
 
@@ -35,7 +36,8 @@ class OwnGroup(GroupMixin, object):
     def iter_annotations(self, media=None,
                                begin=None, begin_min=None, begin_max=None,
                                end=None, end_min=None, end_max=None,
-                               at=None):
+                               at=None, with_content=False,
+                               meta=None, data_contains=None):
         if hasattr(media, '_get_uriref'):
             media = media._get_uriref()
         elif media is not None:
@@ -43,13 +45,34 @@ class OwnGroup(GroupMixin, object):
             media = (m._get_uriref() for m in media)
         if at is not None:
             begin_max = end_min = at
+        if meta: meta = _prepare_meta(meta)
         o = self._owner
         for i in o._backend.iter_annotations((o._id,), None,
                                               media,
                                               begin, begin_min, begin_max,
-                                              end, end_min, end_max):
+                                              end, end_min, end_max,
+                                              with_content,
+                                              meta, data_contains):
             yield o.get_element(i)
 
+    def get_annotation_table(self, media=None, key=None, meta=None):
+        """
+        Return an `AnnotationTable` of the annotations of this group.
+
+        The ``categories`` of the table are the values of the ``key``
+        metadata of the annotations; ``media`` and ``meta`` filter the
+        annotations as in `iter_annotations` and `iter_tags`.
+        """
+        if hasattr(media, '_get_uriref'):
+            media = media._get_uriref()
+        elif media is not None:
+            # It should be a sequence/iterator of medias
+            media = [ m._get_uriref() for m in media ]
+        if meta: meta = _prepare_meta(meta)
+        o = self._owner
+        rows = o._backend.iter_annotation_extents((o._id,), media, key, meta)
+        return AnnotationTable.from_backends([({o._id: o}, rows)])
+
     def iter_relations(self, member=None, position=None):
         assert position is None or member is not None
         if member:
@@ -99,7 +122,7 @@ class OwnGroup(GroupMixin, object):
     def count_annotations(self, media=None,
                                 begin=None, begin_min=None, begin_max=None,
                                 end=None, end_min=None, end_max=None,
-                                at=None):
+                                at=None, meta=None, data_contains=None):
         if hasattr(media, '_get_uriref'):
             media = media._get_uriref()
         elif media is not None:
@@ -107,10 +130,13 @@ class OwnGroup(GroupMixin, object):
             media = (m._get_uriref() for m in media)
         if at is not None:
             begin_max = end_min = at
+        if meta: meta = _prepare_meta(meta)
         o = self._owner
         return o._backend.count_annotations((o._id,), None,
                                            media,
-                                           begin, begin_min, begin_max,)
+                                           begin, begin_min, begin_max,
+                                           end, end_min, end_max,
+                                           meta, data_contains)
 
     def count_relations(self, member=None, position=None):
         assert position is None or member is not None
@@ -1,13 +1,17 @@
-from os import curdir
-from os.path import abspath, exists
+from glob import glob
+from hashlib import sha1
+from inspect import getmro
+from os import curdir, fstat, getpid, makedirs, rename, stat, unlink, utime
+from os.path import abspath, exists, isdir, join, splitext
 from shutil import rmtree
+import sys
 from urlparse import urljoin, urlparse
 from urllib import pathname2url, url2pathname
 from urllib2 import URLError
 from weakref import WeakKeyDictionary, WeakValueDictionary, ref
 
 from libadvene.model.consts import _RAISE, PARSER_META_PREFIX
-from libadvene.model.backends.exceptions import PackageInUse
+from libadvene.model.backends.exceptions import InternalError, PackageInUse
 from libadvene.model.backends.register import iter_backends
 import libadvene.model.backends.sqlite as sqlite_backend
 from libadvene.model.core.element import \
@@ -31,7 +35,8 @@ from libadvene.model.events import PackageEventDelegate, WithEventsMixin
 from libadvene.model.parsers.register import iter_parsers
 from libadvene.model.serializers.register import iter_serializers
 from libadvene.util.autoproperty import autoproperty
-from libadvene.util.files import smart_urlopen
+from libadvene.util.clock_cache import ClockCache
+from libadvene.util.files import get_path, is_local, smart_urlopen
 from libadvene.model.tales import tales_path1_function, WithAbsoluteUrlMixin
 
 _constructor = {
@@ -70,6 +75,18 @@ class Package(WithMetaMixin, WithEventsMixin, WithAbsoluteUrlMixin, object):
     tag_factory = Tag
     view_factory = View
 
+    # number of recently used elements kept alive by each package
+    # (0 disables it, only leaving the weakref cache)
+    default_element_cache_size = 0
+
+    # directory where parsed packages are cached as sqlite files, so that
+    # opening them again does not require to parse them (None disables it)
+    parse_cache_dir = None
+
+    # total size (in bytes) of the parse cache entries beyond which the
+    # least recently used ones are removed (None for no limit)
+    parse_cache_max_size = 100 * 1024 * 1024
+
     def __init__(self, url, create=False, readonly=False, force=False,
                  parser=None):
         """FIXME: missing docstring.
@@ -92,7 +109,9 @@ class Package(WithMetaMixin, WithEventsMixin, WithAbsoluteUrlMixin, object):
         self._backend = None
         self._transient = False
         self._serializer = None
+        self._packaged_archive = None
         must_parse = False
+        cache_path = None
         if create:
             for b in iter_backends():
                 claims = b.claims_for_create(url)
@@ -127,6 +146,7 @@ class Package(WithMetaMixin, WithEventsMixin, WithAbsoluteUrlMixin, object):
                 if parser is not None:
                     self._serializer = parser.SERIALIZER
                     backend, package_id = self._make_transient_backend()
+                    cache_path = self._get_parse_cache_path(f, parser)
                 else:
                     f.close()
                     raise NoClaimingError("bind %s (No parser)" % url)
@@ -135,6 +155,10 @@ class Package(WithMetaMixin, WithEventsMixin, WithAbsoluteUrlMixin, object):
         self._id             = package_id
         self._elements       = WeakValueDictionary() # weakref cache
         self._heavy_elements = set() # strong refs for heavy elements
+        self._recent_elements = None # bounded strong refs, see below
+        self._element_cache_hits = 0
+        self._element_cache_misses = 0
+        self._set_element_cache_size(self.default_element_cache_size)
         self._own_wref       = lambda: None
         self._all_wref       = lambda: None
         self._uri            = None
@@ -154,7 +178,11 @@ class Package(WithMetaMixin, WithEventsMixin, WithAbsoluteUrlMixin, object):
             # values are dicts with package-ids as keys, and packages as values
 
         if must_parse:
-            parser.parse_into(f, self)
+            if cache_path is None \
+            or not self._load_parse_cache(cache_path, f, parser):
+                parser.parse_into(f, self)
+                if cache_path is not None:
+                    self._save_parse_cache(cache_path)
             f.close()
 
         # use self.__class__ as package_class (rather than Package directly)
@@ -205,6 +233,112 @@ class Package(WithMetaMixin, WithEventsMixin, WithAbsoluteUrlMixin, object):
         self._transient = True
         return sqlite_backend.create(self, url=url)
 
+    def _get_parse_cache_path(self, f, parser):
+        """
+        Return the path of the parse cache entry for file `f` parsed with
+        `parser`, or None if it can not be cached.
+
+        Only local files are cached. Entries are named after a hash of the
+        file path, followed by a hash of its size and modification time, of
+        the backend version and of the code of the parser and package
+        classes, so that an entry is never used for a modified file, nor
+        after an upgrade.
+        """
+        cache_dir = self.parse_cache_dir
+        if cache_dir is None or not is_local(f):
+            return None
+        try:
+            st = fstat(f.fileno())
+        except (AttributeError, OSError):
+            return None
+        modules = sorted(set( c.__module__ for c in
+                              getmro(parser) + getmro(self.__class__) ))
+        key = (st.st_size, repr(st.st_mtime), sqlite_backend.BACKEND_VERSION,
+               [ (m, _get_module_signature(m)) for m in modules ],
+               self.__class__.__name__)
+        return join(cache_dir, "%s-%s.db" % (
+            sha1(abspath(get_path(f))).hexdigest(),
+            sha1(repr(key)).hexdigest()))
+
+    def _load_parse_cache(self, cache_path, f, parser):
+        """
+        Fill the backend from the parse cache entry `cache_path`, if it
+        exists, and return True on success.
+
+        The parser is given a chance to restore the resources that it
+        associates to the package beside the backend (see the
+        ``attach_into`` method of the zip parsers).
+        """
+        if not exists(cache_path):
+            return False
+        try:
+            self._backend.load_package_copy(self._id, cache_path)
+        except InternalError:
+            return False
+        try:
+            # mark the entry as recently used (see _prune_parse_cache)
+            utime(cache_path, None)
+        except OSError:
+            pass
+        attach_into = getattr(parser, "attach_into", None)
+        if attach_into is not None:
+            attach_into(f, self)
+        return True
+
+    def _save_parse_cache(self, cache_path):
+        """
+        Save the content of the backend as the parse cache entry
+        `cache_path`, replacing the outdated entries for the same file.
+
+        Failing to do so is not an error, since the cache is only an
+        optimization.
+        """
+        cache_dir = self.parse_cache_dir
+        tmp_path = "%s.%s.tmp" % (cache_path, getpid())
+        try:
+            if not isdir(cache_dir):
+                makedirs(cache_dir)
+            self._backend.save_package_copy(self._id, tmp_path)
+            prefix = cache_path[:cache_path.rindex("-")]
+            for old in glob(prefix + "-*.db"):
+                unlink(old)
+            rename(tmp_path, cache_path)
+            self._prune_parse_cache(cache_path)
+        except (InternalError, OSError, IOError):
+            if exists(tmp_path):
+                unlink(tmp_path)
+
+    def _prune_parse_cache(self, keep):
+        """
+        Remove the least recently used parse cache entries (other than
+        `keep`) until their total size is below `parse_cache_max_size`.
+
+        This also gets rid of the entries of the files which do not exist
+        anymore, or which are not opened anymore.
+        """
+        max_size = self.parse_cache_max_size
+        if max_size is None:
+            return
+        entries = []
+        for path in glob(join(self.parse_cache_dir, "*.db")):
+            try:
+                st = stat(path)
+            except OSError:
+                continue # removed in the meantime
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum( size for _, size, _ in entries )
+        entries.sort()
+        for _, size, path in entries:
+            if total <= max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                unlink(path)
+            except OSError:
+                continue
+            total -= size
+
     def _update_backends_dict(self, _firsttime=False):
         """FIXME: missing docstring.
         """
@@ -303,6 +437,9 @@ class Package(WithMetaMixin, WithEventsMixin, WithAbsoluteUrlMixin, object):
         packaged_root = self.get_meta(PACKAGED_ROOT, None)
         if packaged_root:
             rmtree(packaged_root)
+        if self._packaged_archive is not None:
+            self._packaged_archive.close()
+            self._packaged_archive = None
         # clean or close data from the backend
         if self._transient:
             self._backend.delete(self._id)
@@ -316,11 +453,45 @@ class Package(WithMetaMixin, WithEventsMixin, WithAbsoluteUrlMixin, object):
         """
         # remove references to imported packages
         self._backends_dict = None
+        self._recent_elements = None
         for p in self._imports_dict.itervalues():
             if p is not None:
                 p._importers.pop(self, None)
         self._imports_dict = None
 
+    def begin_batch(self):
+        """Enter a batch section.
+
+        All the modifications of the package performed until the matching
+        `end_batch` are done in a single backend transaction (see the
+        backend's `begin_bulk`), which makes massive edits much cheaper.
+        Batch sections can be nested.
+
+        Note that a batch section is not an undo unit: if a modification
+        fails, it is cancelled alone, as it would be outside the section.
+
+        :see: `batch`
+        """
+        self._backend.begin_bulk()
+
+    def end_batch(self):
+        """Exit a batch section (see `begin_batch`).
+
+        Raise an InternalError if the backend could not commit the section,
+        in which case all its modifications are cancelled.
+        """
+        self._backend.end_bulk()
+
+    def batch(self):
+        """Return a context manager enclosing a batch section, for use as::
+
+            with package.batch():
+                ...
+
+        :see: `begin_batch`
+        """
+        return _BatchSection(self)
+
     def save(self, serializer=None):
         """Save the package to disk if its URL is in the "file:" scheme.
 
@@ -369,6 +540,9 @@ class Package(WithMetaMixin, WithEventsMixin, WithAbsoluteUrlMixin, object):
                 raise Exception("Can not guess correct serializer for %s" %
                                 filename)
 
+        if self._packaged_archive is not None:
+            # the archive may still hold data required by the serializer
+            self._packaged_archive.release(filename)
         f = open(filename, "w")
         s.serialize_to(self, f)
         f.close()
@@ -390,6 +564,43 @@ class Package(WithMetaMixin, WithEventsMixin, WithAbsoluteUrlMixin, object):
     def _get_readonly(self):
         return self._readonly
 
+    @autoproperty
+    def _get_element_cache_size(self):
+        """
+        The number of recently used elements kept alive by this package.
+
+        Elements are otherwise only weakly cached, and instantiated again
+        from the backend whenever they have been garbage collected. Setting
+        this property empties the cache; 0 disables it.
+        """
+        r = self._recent_elements
+        return r and r.capacity or 0
+
+    @autoproperty
+    def _set_element_cache_size(self, size):
+        if size:
+            self._recent_elements = ClockCache(size)
+        else:
+            self._recent_elements = None
+
+    @autoproperty
+    def _get_element_cache_stats(self):
+        """
+        A dict with the counters of the element cache.
+
+        ``hits`` and ``misses`` count the element retrievals that found (resp.
+        did not find) an instance in the cache; ``evictions`` counts the
+        elements that were dropped from the bounded cache, and ``size`` is the
+        number of elements it currently holds.
+        """
+        r = self._recent_elements
+        return {
+            "hits": self._element_cache_hits,
+            "misses": self._element_cache_misses,
+            "evictions": r and r.evictions or 0,
+            "size": r and len(r) or 0,
+        }
+
     @autoproperty
     def _get_uri(self):
         """
@@ -541,12 +752,16 @@ class Package(WithMetaMixin, WithEventsMixin, WithAbsoluteUrlMixin, object):
             if c is None:
                 if default is _RAISE:
                     raise NoSuchElementError(id)
-                r = default
-            else:
-                type, init = c[0], c[2:]
-                factory = getattr(self, _constructor[type])
-                r = factory.instantiate(self, *init)
-                # NB: PackageElement.__init__ stores instances in _elements
+                return default
+            self._element_cache_misses += 1
+            type, init = c[0], c[2:]
+            factory = getattr(self, _constructor[type])
+            r = factory.instantiate(self, *init)
+            # NB: PackageElement.__init__ stores instances in _elements
+        else:
+            self._element_cache_hits += 1
+        if self._recent_elements is not None:
+            self._recent_elements.touch(id, r)
         return r
 
     def _can_reference(self, element):
@@ -862,6 +1077,44 @@ class Package(WithMetaMixin, WithEventsMixin, WithAbsoluteUrlMixin, object):
         return self.all.resources
 
 
+class _BatchSection(object):
+    """The context manager returned by `Package.batch`."""
+    def __init__(self, package):
+        self._package = package
+
+    def __enter__(self):
+        self._package.begin_batch()
+        return self._package
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self._package.end_batch()
+        else:
+            try:
+                self._package.end_batch()
+            except InternalError:
+                pass # the original exception is more informative
+        return False
+
+def _get_module_signature(name):
+    """
+    Return the size and modification time of the file of the given module,
+    or None if it can not be found.
+
+    This is used to identify the version of the code of a module.
+    """
+    path = getattr(sys.modules.get(name), "__file__", None)
+    if path is None:
+        return None
+    base, ext = splitext(path)
+    if ext in (".pyc", ".pyo") and exists(base + ".py"):
+        path = base + ".py"
+    try:
+        st = stat(path)
+    except OSError:
+        return None
+    return (st.st_size, repr(st.st_mtime))
+
 def _split_idref(idref):
     """
     Split an ID-ref into a list of atomic IDs.
@@ -18,6 +18,21 @@ if not libadvene.USE_GOBJECT_EVENTS:
 
     from uuid import uuid4 as uuid
 
+    _SIGNALS = {}
+    # maps each detailed signal to the signals it must be dispatched to,
+    # so that they are not computed on every emission
+
+    def _split_signal(detailed_signal):
+        detail = detailed_signal.split("::")
+        assert len(detail) <= 2, \
+            "Don't know how to handle signal %s" % detailed_signal
+        if len(detail) == 1:
+            all_signals = (detailed_signal,)
+        else:
+            all_signals = (detail[0], detailed_signal)
+        _SIGNALS[detailed_signal] = all_signals
+        return all_signals
+
     class EventDelegate(object):
         """
         Dummy class of event delegate.
@@ -127,16 +142,11 @@ if not libadvene.USE_GOBJECT_EVENTS:
                 return
             by_signal = self.__handlers[0]
 
-            detail = detailed_signal.split("::")
-            assert len(detail) <= 2, \
-                "Don't know how to handle signal %s" % detailed_signal
-            if len(detail) == 1:
-                all_signals = detail
-            else:
-                all_signals = [detail[0], detailed_signal]
+            all_signals = _SIGNALS.get(detailed_signal) \
+                       or _split_signal(detailed_signal)
             for signal in all_signals:
                 signal_handlers = by_signal.get(signal)
-                if signal_handlers is None:
+                if not signal_handlers:
                     continue
                 for handler, init_args, blocked in signal_handlers.itervalues():
                     if blocked:
@@ -154,6 +164,22 @@ if not libadvene.USE_GOBJECT_EVENTS:
             if self.__handlers is not None:
                 return self.emit(*lazy_params())
 
+        def has_handlers_for(self, detailed_signal):
+            """
+            Return True iff emitting detailed_signal could invoke a handler.
+
+            This allows emitters to avoid building the parameters of a signal
+            that nobody is listening to.
+            """
+            if self.__disabling_count > 0 or self.__handlers is None:
+                return False
+            by_signal = self.__handlers[0]
+            for signal in _SIGNALS.get(detailed_signal) \
+                       or _split_signal(detailed_signal):
+                if by_signal.get(signal):
+                    return True
+            return False
+
         def stop_emission(self, detailed_signal):
             """
             Stop the current emission of the signal specified by detailed_signal.
@@ -300,6 +326,16 @@ else:
             if self.__event_delegate is not None:
                 return self.__event_delegate.emit(*lazy_params())
 
+        def has_handlers_for(self, detailed_signal):
+            """
+            Return True iff emitting detailed_signal could invoke a handler.
+
+            This allows emitters to avoid building the parameters of a signal
+            that nobody is listening to.
+            """
+            return self.__event_delegate is not None \
+               and self.__disabling_count == 0
+
         def stop_emission(self, detailed_signal):
             """
             Stop the current emission of the signal specified by detailed_signal.
@@ -5,14 +5,15 @@ See `libadvene.model.parsers.advene_xml` for the reference implementation.
 """
 import atexit
 from tempfile import mkdtemp
-from os import path, tmpfile
-from shutil import rmtree
+from os import name, path, sep, tmpfile, unlink
+from os.path import exists
+from shutil import copyfileobj, rmtree
 from zipfile import BadZipfile, ZipFile
 
 from libadvene.model.consts import PACKAGED_ROOT
 import libadvene.model.parsers.advene_xml as advene_xml
 import libadvene.model.serializers.advene_zip as serializer
-from libadvene.util.files import get_path, recursive_mkdir
+from libadvene.util.files import get_path, is_local, recursive_mkdir
 
 class Parser(object):
 
@@ -90,13 +91,28 @@ class Parser(object):
         """
         cls(file_, package).parse()            
 
-    def parse(self):
-        "Do the actual parsing."
+    @classmethod
+    def attach_into(cls, file_, package):
+        """Attach the archive to a package already filled with its content.
+
+        This does everything `parse_into` does, except parsing the content,
+        and is used for packages restored from the parse cache (see
+        `libadvene.model.core.package.Package.parse_cache_dir`).
+        """
+        cls(file_, package).attach()
+
+    def attach(self):
+        "Attach the archive to the package."
         backend = self.package._backend
         pid = self.package._id
         backend.set_meta(pid, "", "", PACKAGED_ROOT, self.dir, False)
         # TODO use notification to clean it when package is closed
-        f = open(self.content)
+        self.package._packaged_archive = self.archive
+
+    def parse(self):
+        "Do the actual parsing."
+        self.attach()
+        f = self.archive.open("content.xml")
         self._XML_PARSER.parse_into(f, self.package)
         f.close()
 
@@ -108,28 +124,97 @@ class Parser(object):
         self.dir = d = mkdtemp(prefix="advene2_zip_")
         atexit.register(rmtree, d, True)
 
-        if hasattr(file_, "seek"):
-            g = None
-            z = ZipFile(file_, "r")
+        fpath = get_path(file_)
+        if is_local(file_) and exists(fpath):
+            # keep our own handle, since the caller will close file_
+            g = open(fpath, "rb")
+            archive_path = fpath
         else:
             # ZipFile requires seekable file, dump it in tmpfile
             g = tmpfile()
-            g.write(file_.read())
+            copyfileobj(file_, g)
             g.seek(0)
-            z = ZipFile(g, "r")
-        names = z.namelist()
-        for zname in names:
-            seq = zname.split("/")
-            dirname = recursive_mkdir(d, seq[:-1])
-            if seq[-1]:
-                fname = path.join(dirname, seq[-1])
-                h = open(fname, "w")
-                h.write(z.read(zname))
-                h.close()
-        z.close()
-        if g is not None:
-            g.close()
-
-        self.content = path.join(d, "content.xml")
+            archive_path = None
+        self.archive = PackagedArchive(g, d, archive_path)
         self.package = package
 
+
+class PackagedArchive(object):
+    """I give lazy access to the packaged data of a zipped package.
+
+    Instead of extracting the whole archive when the package is parsed, each
+    packaged data file is only extracted into the packaged root the first
+    time it is opened (see `PackagedDataFile`). The members that have not
+    been extracted are copied directly from the archive when the package is
+    serialized again (see `libadvene.model.serializers.advene_zip`).
+
+    I keep the archive file opened until `close` is called, so the archive
+    can be replaced on disk (e.g. when saving the package in place) without
+    affecting me.
+    """
+
+    def __init__(self, file_, root, filename=None):
+        self.root = root
+        self._file = file_
+        if filename is not None:
+            filename = path.normcase(path.abspath(filename))
+        self._filename = filename
+        self._zip = z = ZipFile(file_, "r")
+        self._pending = set( zname for zname in z.namelist()
+                             if zname[-1:] != "/"
+                             and zname not in ("content.xml", "mimetype") )
+
+    def open(self, zname):
+        """Return a readable file-like object on the given member."""
+        return self._zip.open(zname)
+
+    def getinfo(self, zname):
+        return self._zip.getinfo(zname)
+
+    def iter_pending(self):
+        """Iter over the names of the members not extracted yet."""
+        return iter(sorted(self._pending))
+
+    def extract(self, filename):
+        """Extract the member corresponding to `filename` if required.
+
+        `filename` is a path in the packaged root. Return True if the member
+        has been extracted.
+        """
+        if not self._pending:
+            return False
+        rel = path.relpath(filename, self.root)
+        zname = "/".join(rel.split(sep))
+        if zname not in self._pending:
+            return False
+        seq = zname.split("/")
+        recursive_mkdir(self.root, seq[:-1])
+        src = self._zip.open(zname)
+        dst = open(filename, "wb")
+        copyfileobj(src, dst)
+        dst.close()
+        src.close()
+        self._pending.discard(zname)
+        return True
+
+    def release(self, filename):
+        """Make sure that `filename` can be overwritten.
+
+        If `filename` is the archive itself, it is unlinked (our handle keeps
+        it readable) or, where an opened file can not be unlinked, all the
+        remaining members are extracted.
+        """
+        if not self._pending or self._filename is None \
+        or path.normcase(path.abspath(filename)) != self._filename:
+            return
+        if name == "posix":
+            unlink(filename)
+        else:
+            for zname in list(self._pending):
+                self.extract(path.join(self.root, *zname.split("/")))
+        self._filename = None
+
+    def close(self):
+        self._zip.close()
+        self._file.close()
+        self._pending = set()
@@ -8,7 +8,10 @@ try:
     # the error messages are much more informative
 except ImportError:
     from xml.etree.ElementTree import iterparse
-    from xml.parsers.expat import ExpatError as XmlParseError
+    try:
+        from xml.etree.ElementTree import ParseError as XmlParseError
+    except ImportError: # python < 2.7
+        from xml.parsers.expat import ExpatError as XmlParseError
 
 from libadvene.model.consts import _RAISE
 from libadvene.model.parsers.exceptions import ParserError
@@ -85,7 +88,8 @@ class XmlParserBase(object):
                               (expected, self.stream.elem.tag))
         self.package.enter_no_event_section()
         try:
-            self._handle([], {})
+            with self.package._backend.bulk():
+                self._handle([], {})
         finally:
             self.package.exit_no_event_section()
 
@@ -191,7 +195,8 @@ class Stream(object):
     the last yielded item.
     """
     def __init__(self, filelike):
-        if hasattr(filelike, "seek"):
+        if hasattr(filelike, "seek") \
+        and getattr(filelike, "seekable", lambda: True)():
             # may be required, because claims_for_url messes with seek
             filelike.seek(0)
         self._it = iterparse(filelike,
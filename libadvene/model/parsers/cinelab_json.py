@@ -95,36 +95,37 @@ class Parser(object):
         if uri:
             package.uri = uri
         try:
-            for npass in (1, 2):
-                for i in json.get("imports", ()):
-                    self._parse_import(i, package, npass)
-                for i in json.get("resources", ()):
-                    self._parse_simple(i, package, npass, "resource")
-                for i in json.get("tags", ()):
-                    self._parse_tag(i, package, npass, "user_tag")
-                for i in json.get("annotation_types", json.get("annotation-types", ())):
-                    self._parse_tag(i, package, npass, "annotation_type")
-                for i in json.get("relation_types", json.get("relation-types", ())):
-                    self._parse_tag(i, package, npass, "relation_type")
-                for i in json.get("medias", ()):
-                    self._parse_media(i, package, npass)
-                for i in json.get("annotations", ()):
-                    self._parse_annotation(i, package, npass)
-                for i in json.get("relations", ()):
-                    self._parse_relation(i, package, npass)
-                for i in json.get("views", ()):
-                    self._parse_simple(i, package, npass, "view")
-                for i in json.get("queries", ()):
-                    self._parse_simple(i, package, npass, "query")
-                for i in json.get("lists", ()):
-                    self._parse_list(i, package, npass, "user_list")
-                for i in json.get("schemas", ()):
-                    self._parse_list(i, package, npass, "schema")
-                if npass == 1:
-                    self._parse_meta(json, package, package)
-                    # required to inherit bookkeeping metadata in elements
-            for i in json.get("tagging", ()):
-                self._parse_tagging(i, package)
+            with package._backend.bulk():
+                for npass in (1, 2):
+                    for i in json.get("imports", ()):
+                        self._parse_import(i, package, npass)
+                    for i in json.get("resources", ()):
+                        self._parse_simple(i, package, npass, "resource")
+                    for i in json.get("tags", ()):
+                        self._parse_tag(i, package, npass, "user_tag")
+                    for i in json.get("annotation_types", json.get("annotation-types", ())):
+                        self._parse_tag(i, package, npass, "annotation_type")
+                    for i in json.get("relation_types", json.get("relation-types", ())):
+                        self._parse_tag(i, package, npass, "relation_type")
+                    for i in json.get("medias", ()):
+                        self._parse_media(i, package, npass)
+                    for i in json.get("annotations", ()):
+                        self._parse_annotation(i, package, npass)
+                    for i in json.get("relations", ()):
+                        self._parse_relation(i, package, npass)
+                    for i in json.get("views", ()):
+                        self._parse_simple(i, package, npass, "view")
+                    for i in json.get("queries", ()):
+                        self._parse_simple(i, package, npass, "query")
+                    for i in json.get("lists", ()):
+                        self._parse_list(i, package, npass, "user_list")
+                    for i in json.get("schemas", ()):
+                        self._parse_list(i, package, npass, "schema")
+                    if npass == 1:
+                        self._parse_meta(json, package, package)
+                        # required to inherit bookkeeping metadata in elements
+                for i in json.get("tagging", ()):
+                    self._parse_tagging(i, package)
         finally:
             package.exit_no_event_section()
 
@@ -83,47 +83,48 @@ class Parser(object):
         package.enter_no_event_section()
         sparql_ns = {"": CLD}
         try:
-            uri = URIRef(package.url)
-            if (uri, RDF.type, CLD.Package) not in graph:
-                try:
-                    uri = graph.value(None, RDF.type, CLD.Package, any=False)
-                except UniquenessError:
-                    uris = list(self.query("SELECT ?p { ?p :hasElement [] }"))
-                    if len(uris) != 1:
-                        uris = list(self.query("SELECT ?p { ?p :url ?u }",
-                                                u = Literal(uri, XSD.anyURI)))
+            with package._backend.bulk():
+                uri = URIRef(package.url)
+                if (uri, RDF.type, CLD.Package) not in graph:
+                    try:
+                        uri = graph.value(None, RDF.type, CLD.Package, any=False)
+                    except UniquenessError:
+                        uris = list(self.query("SELECT ?p { ?p :hasElement [] }"))
                         if len(uris) != 1:
-                            raise ParserError("Can not determine package URI")
-                    uri = uris[0][0]
-                package.uri = str(uri)
-            self.uri = uri
-
-            # copy RDF namespace prefixes into package metadata,
-            # except for empty namespace
-            # (as most serializers define their own empty namespace)
-            package.set_meta(PARSER_META_PREFIX+"namespaces",
-                             "\n".join("%s %s" % i for i in graph.namespaces()
-                                                   if i[0] <> ""))
-
-            # create all elements
-            self._parse_imports()
-            self._parse_wcontent(CLD.Resource, package.create_resource)
-            self._parse_simple(CLD.UserTag, package.create_user_tag)
-            self._parse_simple(CLD.AnnotationType, package.create_annotation_type)
-            self._parse_simple(CLD.RelationType, package.create_relation_type)
-            self._parse_medias()
-            self._parse_annotations()
-            self._parse_relations()
-            self._parse_wcontent(CLD.Query, package.create_query)
-            self._parse_wcontent(CLD.View, package.create_view)
-            self._parse_simple(CLD.UserList, package.create_user_list)
-            self._parse_simple(CLD.Schema, package.create_schema)
-
-            # then populates tagging and metadata
-            # (doing it only now prevents forward references)
-            self._parse_meta(uri, package)
-            self._parse_all_tagging()
-            self._parse_pass2()
+                            uris = list(self.query("SELECT ?p { ?p :url ?u }",
+                                                    u = Literal(uri, XSD.anyURI)))
+                            if len(uris) != 1:
+                                raise ParserError("Can not determine package URI")
+                        uri = uris[0][0]
+                    package.uri = str(uri)
+                self.uri = uri
+
+                # copy RDF namespace prefixes into package metadata,
+                # except for empty namespace
+                # (as most serializers define their own empty namespace)
+                package.set_meta(PARSER_META_PREFIX+"namespaces",
+                                 "\n".join("%s %s" % i for i in graph.namespaces()
+                                                       if i[0] <> ""))
+
+                # create all elements
+                self._parse_imports()
+                self._parse_wcontent(CLD.Resource, package.create_resource)
+                self._parse_simple(CLD.UserTag, package.create_user_tag)
+                self._parse_simple(CLD.AnnotationType, package.create_annotation_type)
+                self._parse_simple(CLD.RelationType, package.create_relation_type)
+                self._parse_medias()
+                self._parse_annotations()
+                self._parse_relations()
+                self._parse_wcontent(CLD.Query, package.create_query)
+                self._parse_wcontent(CLD.View, package.create_view)
+                self._parse_simple(CLD.UserList, package.create_user_list)
+                self._parse_simple(CLD.Schema, package.create_schema)
+
+                # then populates tagging and metadata
+                # (doing it only now prevents forward references)
+                self._parse_meta(uri, package)
+                self._parse_all_tagging()
+                self._parse_pass2()
         finally:
             package.exit_no_event_section()
 
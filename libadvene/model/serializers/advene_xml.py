@@ -10,7 +10,8 @@ Forward references are nevetheless still possible in meta-data, tag associated t
 import base64
 from itertools import chain
 from urlparse import urlparse
-from xml.etree.ElementTree import Element, ElementTree, SubElement
+from xml.etree.ElementTree import Element, ElementTree, SubElement, \
+                               tostring
 
 from libadvene.model.consts import ADVENE_XML, DC_NS_PREFIX
 from libadvene.model.core.media import FOREF_PREFIX
@@ -58,76 +59,40 @@ class _Serializer(object):
 
     def serialize(self):
         """Perform the actual serialization."""
-
-        root = self.root = Element("package", xmlns=self.default_ns)
         package = self.package
-        namespaces = package._get_namespaces_as_dict()
-        self.namespaces = namespaces
-        for uri, prefix in namespaces.iteritems():
-            root.set("xmlns:%s" % prefix, uri)
-        if package.uri:
-            root.set("uri", package.uri)
+        self._write_package_start()
         # imports
-        ximports = SubElement(self.root, "imports")
-        for i in package.own.imports:
-            self._serialize_import(i, ximports)
-        if len(ximports) == 0:
-            self.root.remove(ximports)
+        self._write_section("imports", package.own.imports,
+                            self._serialize_import)
         # tags
-        xtags = SubElement(self.root, "tags")
-        for t in package.own.tags:
-            self._serialize_tag(t, xtags)
-        if len(xtags) == 0:
-            self.root.remove(xtags)
+        self._write_section("tags", package.own.tags, self._serialize_tag)
         # media
-        xmedias = SubElement(self.root, "medias")
-        for m in package.own.medias:
-            self._serialize_media(m, xmedias)
-        if len(xmedias) == 0:
-            self.root.remove(xmedias)
+        self._write_section("medias", package.own.medias,
+                            self._serialize_media)
         # resources
-        xresources = SubElement(self.root, "resources")
-        for r in package.own.resources:
-            self._serialize_resource(r, xresources)
-        if len(xresources) == 0:
-            self.root.remove(xresources)
+        self._write_section("resources", package.own.resources,
+                            self._serialize_resource)
         # annotations
-        xannotations = SubElement(self.root, "annotations")
-        for a in package.own.annotations:
-            self._serialize_annotation(a, xannotations)
-        if len(xannotations) == 0:
-            self.root.remove(xannotations)
+        self._write_section("annotations",
+                            package.own.iter_annotations(with_content=True),
+                            self._serialize_annotation)
         # relations
-        xrelations = SubElement(self.root, "relations")
-        for r in package.own.relations:
-            self._serialize_relation(r, xrelations)
-        if len(xrelations) == 0:
-            self.root.remove(xrelations)
+        self._write_section("relations", package.own.relations,
+                            self._serialize_relation)
         # views
-        xviews = SubElement(self.root, "views")
-        for v in package.own.views:
-            self._serialize_view(v, xviews)
-        if len(xviews) == 0:
-            self.root.remove(xviews)
+        self._write_section("views", package.own.views, self._serialize_view)
         # queries
-        xqueries = SubElement(self.root, "queries")
-        for q in package.own.queries:
-            self._serialize_query(q, xqueries)
-        if len(xqueries) == 0:
-            self.root.remove(xqueries)
+        self._write_section("queries", package.own.queries,
+                            self._serialize_query)
         # lists
-        xlists = SubElement(self.root, "lists")
-        for L in package.own.lists:
-            self._serialize_list(L, xlists)
-        if len(xlists) == 0:
-            self.root.remove(xlists)
+        self._write_section("lists", package.own.lists, self._serialize_list)
         # external tag associations
-        self._serialize_external_tagging(self.root)
+        self._write_section("external-tag-associations",
+                            package._backend.iter_external_tagging(package._id),
+                            self._serialize_external_association)
         # package meta-data
-        self._serialize_meta(package, self.root)
-
-        _indent(self.root)
-        ElementTree(self.root).write(self.file, encoding='utf-8')
+        self._write_package_children(self._serialize_meta, package)
+        self._write_package_end()
 
     # end of the public interface
 
@@ -142,6 +107,80 @@ class _Serializer(object):
         self.default_ns = ADVENE_XML
         self.standalone_xml = _standalone_xml
 
+    # streaming
+
+    # The package is written incrementally, one top-level element at a time,
+    # so that the memory used does not depend on the size of the package.
+    # Each top-level element is still built as a small ElementTree by the
+    # element serializers below, then indented as `_indent` would do it in
+    # the whole tree, so that the output is the same as if the whole tree
+    # had been built.
+
+    def _write_package_start(self):
+        package = self.package
+        namespaces = package._get_namespaces_as_dict()
+        self.namespaces = namespaces
+        xpackage = Element("package", xmlns=self.default_ns)
+        for uri, prefix in namespaces.iteritems():
+            xpackage.set("xmlns:%s" % prefix, uri)
+        if package.uri:
+            xpackage.set("uri", package.uri)
+        # the start tag is left unclosed until we know if the package is empty
+        start = tostring(xpackage, "utf-8")
+        assert start.endswith(" />")
+        self.file.write(start[:-3])
+        self._package_is_empty = True
+
+    def _write_package_child_prefix(self):
+        if self._package_is_empty:
+            self.file.write(">")
+            self._package_is_empty = False
+        self.file.write("\n  ")
+
+    def _write_package_end(self):
+        if self._package_is_empty:
+            self.file.write(" />")
+        else:
+            self.file.write("\n</package>")
+
+    def _write_element(self, xelt, level):
+        _indent(xelt, level)
+        xelt.tail = None
+        ElementTree(xelt).write(self.file, encoding="utf-8")
+
+    def _write_section(self, tagname, elements, serialize, *args):
+        """Write a section element containing the serialization of `elements`.
+
+        `serialize` is invoked for each element, with a temporary section
+        element as its second argument and `args` as additional arguments.
+        Nothing is written if no element was serialized.
+        """
+        write = self.file.write
+        xsection = Element(tagname)
+        is_empty = True
+        for elt in elements:
+            serialize(elt, xsection, *args)
+            for xelt in xsection:
+                if is_empty:
+                    self._write_package_child_prefix()
+                    write("<%s>" % tagname)
+                    is_empty = False
+                write("\n    ")
+                self._write_element(xelt, 2)
+            del xsection[:]
+        if not is_empty:
+            write("\n  </%s>" % tagname)
+
+    def _write_package_children(self, serialize, *args):
+        """Write the elements added by `serialize` to a temporary package
+        element.
+        """
+        xpackage = Element("package")
+        serialize(*(args + (xpackage,)))
+        for xelt in xpackage:
+            self._write_package_child_prefix()
+            self._write_element(xelt, 1)
+
     # element serializers
 
     def _serialize_media(self, m, xmedias, tagname="media"):
@@ -306,14 +345,10 @@ class _Serializer(object):
         if len(xtags) == 0:
             xelt.remove(xtags)
 
-    def _serialize_external_tagging(self, xpackage):
-        xx = SubElement(xpackage, "external-tag-associations")
-        pairs = self.package._backend.iter_external_tagging(self.package._id)
-        for e, t in pairs:
-            xxt = SubElement(xx, "association", element=e)
-            xxt.attrib["tag"] = t # can not use kw-argument 'tag' above...
-        if len(xx) == 0:
-            xpackage.remove(xx)
+    def _serialize_external_association(self, pair, xx):
+        e, t = pair
+        xxt = SubElement(xx, "association", element=e)
+        xxt.attrib["tag"] = t # can not use kw-argument 'tag' above...
 
 
 def _indent(elem, level=0):
@@ -4,12 +4,17 @@ Unstable and experimental serializer implementation.
 See `libadvene.model.serializers.advene_xml` for the reference implementation.
 """
 
-from os import listdir, mkdir, path
+from cStringIO import StringIO
+from inspect import getargspec
+from os import listdir, mkdir, path, unlink, utime
 from os.path import exists, isdir
-from zipfile import ZipFile, ZIP_DEFLATED
+from shutil import copyfileobj
+from tempfile import NamedTemporaryFile
+from time import localtime, mktime, time
+from zipfile import LargeZipFile, ZipFile, ZipInfo, ZIP64_LIMIT, ZIP_DEFLATED
+from zlib import compressobj, crc32, DEFLATED, Z_DEFAULT_COMPRESSION
 
 from libadvene.model.consts import PACKAGED_ROOT
-from libadvene.model.core.content import create_temporary_packaged_root
 import libadvene.model.serializers.advene_xml as advene_xml
 
 NAME = "Generic Advene Zipped Package"
@@ -40,13 +45,25 @@ class _Serializer(object):
 
     def serialize(self):
         """Perform the actual serialization."""
-        #print "=== serializing directory", self.dir
-        f = open(path.join(self.dir, "content.xml"), "w")
+        z = ZipFile(self.file, "w", self.compression, allowZip64=True)
+        z.writestr("mimetype", self.mimetype)
+        # the size of content.xml is not known in advance
+        f = _open_member(z, "content.xml", zip64=True)
         self._xml_serializer.serialize_to(self.package, f, False)
         f.close()
-
-        z = ZipFile(self.file, "w", self.compression)
-        _recurse(z, self.dir)
+        if self.dir is not None:
+            _recurse(z, self.dir)
+        archive = self.package._packaged_archive
+        if archive is not None:
+            # copy the packaged data that has never been extracted
+            for zname in archive.iter_pending():
+                info = archive.getinfo(zname)
+                f = _open_member(z, zname, info.date_time,
+                                 info.external_attr, info.file_size)
+                g = archive.open(zname)
+                copyfileobj(g, f)
+                g.close()
+                f.close()
         z.close()
 
     def __init__(self, package, file_, compression=None):
@@ -54,24 +71,16 @@ class _Serializer(object):
             self.compression = ZIP_DEFLATED
         else:
             self.compression = compression
-        self.dir = dir_ = package.get_meta(PACKAGED_ROOT, None)
-        if dir_ is None:
-            self.dir = dir_ = create_temporary_packaged_root(package)
-
-        if not exists(path.join(dir_, "mimetype")):
-            f = open(path.join(dir_, "mimetype"), "w")
-            f.write(self.mimetype)
-            f.close()
-        if not exists(path.join(dir_, "data")):
-            mkdir(path.join(dir_, "data"))
-
-            
+        self.dir = package.get_meta(PACKAGED_ROOT, None)
         self.package = package
         self.file = file_
 
 
 def _recurse(z, dirname, base=""):
     for f in listdir(dirname):
+        if not base and f in ("mimetype", "content.xml"):
+            # written by the serializer (manually unzipped package)
+            continue
         abspath = path.join(dirname, f)
         if isdir(abspath):
             _recurse(z, abspath, path.join(base, f))
@@ -80,6 +89,128 @@ def _recurse(z, dirname, base=""):
             z.write(abspath, path.join(base, f).encode('utf-8'))
 
 
+def _open_member(z, zname, date_time=None, external_attr=0644 << 16,
+                 size_hint=0, zip64=False):
+    """Return a writable file-like object adding a member to ZipFile z.
+
+    The member is written in the ZIP64 format if ``zip64`` is true, or if
+    ``size_hint`` (the expected uncompressed size) requires it.
+
+    The data is streamed into the archive by `_ZipMemberWriter` if the
+    zipfile module provides the internals it relies on, else it is stored
+    in a temporary file by `_TempFileZipMemberWriter`.
+    """
+    if _ZIPFILE_INTERNALS:
+        cls = _ZipMemberWriter
+    else:
+        cls = _TempFileZipMemberWriter
+    return cls(z, zname, date_time or localtime(time())[:6], external_attr,
+               zip64 or size_hint * 1.05 > ZIP64_LIMIT)
+
+def _check_zipfile_internals():
+    """Check that zipfile has the private API used by `_ZipMemberWriter`.
+
+    Those are the ``fp``, ``filelist``, ``NameToInfo``, ``_didModify`` and
+    ``_allowZip64`` attributes and the ``_writecheck`` method of ZipFile
+    instances (all used by ``ZipFile.writestr`` in python 2.6 and 2.7), and
+    the ``zip64`` parameter of ``ZipInfo.FileHeader`` (python 2.7.4+).
+    """
+    try:
+        if "zip64" not in getargspec(ZipInfo.FileHeader)[0] \
+        or not hasattr(ZipFile, "_writecheck"):
+            return False
+        z = ZipFile(StringIO(), "w")
+        try:
+            return all( hasattr(z, a) for a in ("fp", "filelist",
+                        "NameToInfo", "_didModify", "_allowZip64") )
+        finally:
+            z.close()
+    except Exception:
+        return False
+
+_ZIPFILE_INTERNALS = _check_zipfile_internals()
+
+class _ZipMemberWriter(object):
+    """A writable file-like object adding a member to a ZipFile.
+
+    The data is compressed and written to the archive as it is received, so
+    that it never has to be stored in memory or in a temporary file.
+    This mimics `ZipFile.writestr` (including the requirement for the
+    archive to be seekable), and relies on the same private parts of
+    zipfile (see `_check_zipfile_internals`).
+    """
+    def __init__(self, z, zname, date_time, external_attr, zip64):
+        zinfo = ZipInfo(zname, date_time)
+        zinfo.external_attr = external_attr
+        zinfo.compress_type = z.compression
+        zinfo.file_size = zinfo.compress_size = zinfo.CRC = 0
+        zinfo.header_offset = z.fp.tell()
+        z._writecheck(zinfo)
+        z._didModify = True
+        self._zip64 = zip64 and z._allowZip64
+        z.fp.write(zinfo.FileHeader(self._zip64))
+        if zinfo.compress_type == ZIP_DEFLATED:
+            self._cmpr = compressobj(Z_DEFAULT_COMPRESSION, DEFLATED, -15)
+        else:
+            self._cmpr = None
+        self._z = z
+        self._zinfo = zinfo
+
+    def write(self, data):
+        zinfo = self._zinfo
+        zinfo.file_size += len(data)
+        zinfo.CRC = crc32(data, zinfo.CRC) & 0xffffffff
+        if self._cmpr is not None:
+            data = self._cmpr.compress(data)
+        zinfo.compress_size += len(data)
+        self._z.fp.write(data)
+
+    def close(self):
+        z, zinfo = self._z, self._zinfo
+        if self._cmpr is not None:
+            data = self._cmpr.flush()
+            zinfo.compress_size += len(data)
+            z.fp.write(data)
+        if not self._zip64 and (zinfo.file_size > ZIP64_LIMIT
+                                or zinfo.compress_size > ZIP64_LIMIT):
+            raise LargeZipFile("%s is too large" % zinfo.filename)
+        # rewrite the header with the correct CRC and sizes
+        position = z.fp.tell()
+        z.fp.seek(zinfo.header_offset, 0)
+        z.fp.write(zinfo.FileHeader(self._zip64))
+        z.fp.seek(position, 0)
+        z.filelist.append(zinfo)
+        z.NameToInfo[zinfo.filename] = zinfo
+
+class _TempFileZipMemberWriter(object):
+    """A writable file-like object adding a member to a ZipFile.
+
+    This is the fallback of `_ZipMemberWriter`, using only the public API
+    of zipfile: the data is stored in a temporary file, which is added to the
+    archive on close (ZipFile decides by itself whether ZIP64 is required).
+    """
+    def __init__(self, z, zname, date_time, external_attr, zip64):
+        self._file = NamedTemporaryFile(delete=False)
+        self._z = z
+        self._zname = zname
+        self._date_time = date_time
+        self._external_attr = external_attr
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+        filename = self._file.name
+        try:
+            mtime = mktime(self._date_time + (0, 0, -1))
+            utime(filename, (mtime, mtime))
+            self._z.write(filename, self._zname)
+        finally:
+            unlink(filename)
+        self._z.getinfo(self._zname).external_attr = self._external_attr
+
+
 if __name__ == "__main__":
     # example of using ZIP serialization and parsing
     from libadvene.model.core.package import Package
@@ -76,7 +76,7 @@ class _Serializer(object):
         root["resources"] = [ self._serialize_resource(i)
                               for i in package.own.resources ]
         root["annotations"] = [ self._serialize_annotation(i)
-                                for i in package.own.annotations ]
+                                for i in package.own.iter_annotations(with_content=True) ]
         root["relations"] = [ self._serialize_relation(i)
                               for i in package.own.relations ]
         root["views"] = [ self._serialize_resource(i)
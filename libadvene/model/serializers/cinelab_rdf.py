@@ -111,7 +111,7 @@ class _Serializer(object):
             for triple in self._serialize_resource(i, CLD.Resource):
                 add(triple)
 
-        for i in package.own.annotations:
+        for i in package.own.iter_annotations(with_content=True):
             for triple in self._serialize_annotation(i):
                 add(triple)
 
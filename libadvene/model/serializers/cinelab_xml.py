@@ -2,11 +2,10 @@
 Cinelab serializer implementation.
 """
 from bisect import insort
-from xml.etree.ElementTree import Element, ElementTree, SubElement
+from xml.etree.ElementTree import SubElement
 
 from libadvene.model.cam.consts import CAM_XML, CAMSYS_NS_PREFIX
 from libadvene.model.cam.util.bookkeeping import iter_filtered_meta_ids
-from libadvene.model.serializers.advene_xml import _indent
 from libadvene.model.serializers.advene_xml import DEFAULTS, \
     _Serializer as _AdveneSerializer
 
@@ -49,93 +48,51 @@ class _Serializer(_AdveneSerializer):
 
     def serialize(self):
         """Perform the actual serialization."""
-        root = self.root = Element("package", xmlns=self.default_ns)
         package = self.package
-        namespaces = package._get_namespaces_as_dict()
-        self.namespaces = namespaces
-        for uri, prefix in namespaces.iteritems():
-            root.set("xmlns:%s" % prefix, uri)
-        if package.uri:
-            root.set("uri", package.uri)
+        self._write_package_start()
         # package meta-data
-        self._serialize_meta(package, self.root)
+        self._write_package_children(self._serialize_meta, package)
         # imports
-        ximports = SubElement(self.root, "imports")
-        for i in package.own.imports:
-            self._serialize_import(i, ximports)
-        if len(ximports) == 0:
-            self.root.remove(ximports)
+        self._write_section("imports", package.own.imports,
+                            self._serialize_import)
         # annotation-type
-        xannotation_types = SubElement(self.root, "annotation-types")
-        for t in package.own.annotation_types:
-            self._serialize_tag(t, xannotation_types, "annotation-type")
-        if len(xannotation_types) == 0:
-            self.root.remove(xannotation_types)
+        self._write_section("annotation-types", package.own.annotation_types,
+                            self._serialize_tag, "annotation-type")
         # relation-type
-        xrelation_types = SubElement(self.root, "relation-types")
-        for t in package.own.relation_types:
-            self._serialize_tag(t, xrelation_types, "relation-type")
-        if len(xrelation_types) == 0:
-            self.root.remove(xrelation_types)
+        self._write_section("relation-types", package.own.relation_types,
+                            self._serialize_tag, "relation-type")
         # tags
-        xtags = SubElement(self.root, "tags")
-        for t in package.own.user_tags:
-            self._serialize_tag(t, xtags)
-        if len(xtags) == 0:
-            self.root.remove(xtags)
+        self._write_section("tags", package.own.user_tags,
+                            self._serialize_tag)
         # media
-        xmedias = SubElement(self.root, "medias")
-        for m in package.own.medias:
-            self._serialize_media(m, xmedias)
-        if len(xmedias) == 0:
-            self.root.remove(xmedias)
+        self._write_section("medias", package.own.medias,
+                            self._serialize_media)
         # resources
-        xresources = SubElement(self.root, "resources")
-        for r in package.own.resources:
-            self._serialize_resource(r, xresources)
-        if len(xresources) == 0:
-            self.root.remove(xresources)
+        self._write_section("resources", package.own.resources,
+                            self._serialize_resource)
         # annotations
-        xannotations = SubElement(self.root, "annotations")
-        for a in package.own.annotations:
-            self._serialize_annotation(a, xannotations)
-        if len(xannotations) == 0:
-            self.root.remove(xannotations)
+        self._write_section("annotations",
+                            package.own.iter_annotations(with_content=True),
+                            self._serialize_annotation)
         # relations
-        xrelations = SubElement(self.root, "relations")
-        for r in package.own.relations:
-            self._serialize_relation(r, xrelations)
-        if len(xrelations) == 0:
-            self.root.remove(xrelations)
+        self._write_section("relations", package.own.relations,
+                            self._serialize_relation)
         # views
-        xviews = SubElement(self.root, "views")
-        for v in package.own.views:
-            self._serialize_view(v, xviews)
-        if len(xviews) == 0:
-            self.root.remove(xviews)
+        self._write_section("views", package.own.views, self._serialize_view)
         # queries
-        xqueries = SubElement(self.root, "queries")
-        for q in package.own.queries:
-            self._serialize_query(q, xqueries)
-        if len(xqueries) == 0:
-            self.root.remove(xqueries)
+        self._write_section("queries", package.own.queries,
+                            self._serialize_query)
         # schemas
-        xschemas = SubElement(self.root, "schemas")
-        for L in package.own.schemas:
-            self._serialize_list(L, xschemas, "schema")
-        if len(xschemas) == 0:
-            self.root.remove(xschemas)
+        self._write_section("schemas", package.own.schemas,
+                            self._serialize_list, "schema")
         # lists
-        xlists = SubElement(self.root, "lists")
-        for L in package.own.user_lists:
-            self._serialize_list(L, xlists)
-        if len(xlists) == 0:
-            self.root.remove(xlists)
+        self._write_section("lists", package.own.user_lists,
+                            self._serialize_list)
         # external tag associations
-        self._serialize_external_tagging(self.root)
-
-        _indent(self.root)
-        ElementTree(self.root).write(self.file, encoding='utf-8')
+        self._write_section("external-tag-associations",
+                            package._backend.iter_external_tagging(package._id),
+                            self._serialize_external_association)
+        self._write_package_end()
 
     # end of the public interface
 
@@ -128,8 +128,13 @@ class AdveneContext(simpleTALES.Context):
                 expr = expr[1:]
         elif expr.endswith('"') or expr.endswith("'"):
             expr = expr[:-1]
-        pathList = expr.split("/")
+        return self.traverse_path_list(expr.split("/"), canCall)
 
+    def traverse_path_list(self, pathList, canCall=1):
+        """Same as traversePath, with a path already split on "/".
+
+        This spares the parsing of paths which are evaluated many times.
+        """
         val = self._traverse_first(pathList[0])
         tales_type = None
         for i, p in enumerate(pathList[1:]):
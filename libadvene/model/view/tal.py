@@ -3,10 +3,14 @@
 Note that X/Y must be either text/html or an XML based mimetype.
 """
 
+from libadvene.model.core.content import safe_decode, safe_encode
 from libadvene.model.tales import AdveneContext
 
 from cStringIO import StringIO
 from simpletal import simpleTAL
+from urllib2 import HTTPError, Request, urlopen
+from urlparse import urljoin
+from weakref import WeakKeyDictionary
 
 # general handler interface
 
@@ -32,7 +36,74 @@ def get_output_mimetype(view):
     return view.content_mimetype[:-4]
 
 def apply_to(view, obj, refpkg=None):
-    f = view.content_as_file
+    t, kw = _get_compiled_template(view)
+
+    c = AdveneContext(here=obj)
+    c.addGlobal("view", view)
+    if refpkg is None:
+        if hasattr(obj, "ADVENE_TYPE"):
+            refpkg = obj.owner
+        else:
+            refpkg = obj
+    c.addGlobal("package", refpkg)
+    out = StringIO()
+    t.expand(c, out, outputEncoding="utf-8", **kw)
+    return out.getvalue()
+
+# specific to this handler
+
+cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+"""The counters of the compiled template cache."""
+
+_compiled = WeakKeyDictionary()
+# maps views to a tuple ((url, validators), template, expand_keywords);
+# it is kept outside the views, since setting an attribute on a view makes it
+# heavy (see `PackageElement.__setattr__`)
+
+def _get_compiled_template(view):
+    """Return the compiled template of view, and the expand keywords.
+
+    The compiled template is cached for the view, and dropped whenever its
+    content (data, URL or mimetype) is modified. External contents may be
+    modified without notification, so they are revalidated before each use
+    with a conditional request (see `_open_if_modified`), then with the
+    validators of the URL (ETag, Last-Modified, Content-Length -- the latter
+    two being derived from the file status for file: URLs); if none of them
+    is available, the content is recompiled every time.
+    """
+    url = view.content_url
+    cached = _compiled.get(view)
+    validators = None
+    f = None
+    if url and not url.startswith("packaged:"):
+        if cached is not None and cached[0][0] == url:
+            validators = cached[0][1]
+        f = _open_if_modified(view, url, validators)
+        if f is None:
+            # not modified
+            cache_stats["hits"] += 1
+            return cached[1:]
+        info = f.info()
+        validators = tuple( info.get(k) for k in
+                            ("etag", "last-modified", "content-length") )
+        if validators == (None, None, None):
+            validators = None
+
+    if cached is not None and (url, validators) == cached[0] \
+    and (validators is not None or f is None):
+        cache_stats["hits"] += 1
+        if f is not None:
+            f.close()
+        return cached[1:]
+
+    cache_stats["misses"] += 1
+    if f is None:
+        f = view.content_as_file
+    else:
+        # decode/encode as content_as_file would
+        data = f.read()
+        f.close()
+        f = StringIO(safe_encode(safe_decode(data, view)))
     html = view.content_mimetype.startswith("text/html")
     if html:
         t = simpleTAL.compileHTMLTemplate(f, "utf-8")
@@ -48,23 +119,37 @@ def apply_to(view, obj, refpkg=None):
         # documents to have no XML declaration.
     f.close()
 
-    # should we cache the compiled template for future uses,
-    # and recompile it only when the content is modified?
-    # the problem is that external contents may be modified without notification
-    # (or rely on f.headers['date'], but that would require to hack content.py
-    #  to make that field *always* present - might be a good idea...)
+    if cached is None:
+        # "modified" is emitted for content_url and content_mimetype
+        view._self_connect("modified", _invalidate)
+        view._self_connect("modified-content-data", _invalidate)
+    _compiled[view] = ((url, validators), t, kw)
+    return t, kw
 
-    c = AdveneContext(here=obj)
-    c.addGlobal("view", view)
-    if refpkg is None:
-        if hasattr(obj, "ADVENE_TYPE"):
-            refpkg = obj.owner
-        else:
-            refpkg = obj
-    c.addGlobal("package", refpkg)
-    out = StringIO()
-    t.expand(c, out, outputEncoding="utf-8", **kw)
-    return out.getvalue()
+def _open_if_modified(view, url, validators):
+    """Open the external content of view, unless it is known to be unmodified.
 
-# specific to this handler
+    If validators (as stored in `_compiled`) are given, the request is made
+    conditional, so that HTTP servers do not send the content again if it
+    has not changed; None is returned in that case. Other URL schemes ignore
+    the condition, and the validators of the returned file must be checked.
+    """
+    req = Request(urljoin(view._owner._url, url))
+    if validators is not None:
+        etag, last_modified, _ = validators
+        if etag:
+            req.add_header("If-None-Match", etag)
+        if last_modified:
+            req.add_header("If-Modified-Since", last_modified)
+    try:
+        return urlopen(req)
+    except HTTPError, e:
+        if e.code == 304 and validators is not None:
+            return None
+        raise
 
+def _invalidate(view, *args):
+    cached = _compiled.get(view)
+    if cached is not None and cached[1] is not None:
+        cache_stats["invalidations"] += 1
+        _compiled[view] = ((None, None), None, None)
@@ -0,0 +1,91 @@
+"""I provide a bounded cache of strong references.
+"""
+
+class ClockCache(object):
+    """I keep strong references to at most `capacity` values.
+
+    When full, I evict values according to the CLOCK algorithm: each slot
+    has a reference bit, set whenever its key is touched; the clock hand
+    clears the bits it passes over, and evicts the first slot whose bit
+    is already cleared. This approximates LRU at the cost of a dict lookup
+    per access.
+
+    The number of evicted values is available in the `evictions`
+    attribute.
+    """
+    def __init__(self, capacity):
+        assert capacity > 0, "capacity must be positive"
+        self.capacity = capacity
+        self.evictions = 0
+        self._keys = []
+        self._values = []
+        self._refbits = []
+        self._slots = {}
+        self._free = []
+        self._hand = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def get(self, key, default=None):
+        slot = self._slots.get(key)
+        if slot is None:
+            return default
+        return self._values[slot]
+
+    def touch(self, key, value):
+        """Keep a strong reference to `value` under `key`.
+
+        If `key` is already present, its value is replaced and it is marked
+        as recently used.
+        """
+        slot = self._slots.get(key)
+        if slot is not None:
+            self._values[slot] = value
+            self._refbits[slot] = True
+            return
+        keys = self._keys
+        if self._free:
+            slot = self._free.pop()
+            keys[slot] = key
+            self._values[slot] = value
+            self._slots[key] = slot
+            return
+        if len(keys) < self.capacity:
+            self._slots[key] = len(keys)
+            keys.append(key)
+            self._values.append(value)
+            self._refbits.append(False)
+            return
+        refbits = self._refbits
+        hand = self._hand
+        while refbits[hand]:
+            refbits[hand] = False
+            hand = (hand + 1) % self.capacity
+        del self._slots[keys[hand]]
+        self.evictions += 1
+        keys[hand] = key
+        self._values[hand] = value
+        self._slots[key] = hand
+        self._hand = (hand + 1) % self.capacity
+
+    def discard(self, key):
+        """Drop the reference held under `key`, if any.
+        """
+        slot = self._slots.pop(key, None)
+        if slot is not None:
+            self._keys[slot] = None
+            self._values[slot] = None
+            self._refbits[slot] = False
+            self._free.append(slot)
+
+    def clear(self):
+        self._keys = []
+        self._values = []
+        self._refbits = []
+        self._slots.clear()
+        self._free = []
+        self._hand = 0
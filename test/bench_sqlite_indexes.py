@@ -0,0 +1,86 @@
+"""
+Measures the per-query latency of the most common backend lookups, with and
+without the secondary and temporal indexes of the sqlite backend, for
+increasing package sizes.
+"""
+from time import time
+
+import libadvene.model.backends.sqlite as backend_sqlite
+import libadvene.model.backends.sqlite_init as sqlite_init
+from libadvene.model.backends.sqlite import create, IN_MEMORY_URL
+from libadvene.model.core.element import ANNOTATION
+
+backend_sqlite._set_module_debug(False)
+
+SIZES = [1000, 10000, 100000]
+NBM = 10
+NBQ = 50 # number of times each query is repeated
+
+class P:
+    """A dummy package, kept referenced by the module."""
+    _L = []
+    def __init__ (self, url):
+        self.url = url
+        self.readonly = False
+        P._L.append(self)
+
+def populate(be, pid, nba):
+    execute = be._curs.execute
+    executemany = be._curs.executemany
+    execute("BEGIN")
+    for i in xrange(NBM):
+        execute("INSERT INTO Elements VALUES (?,?,'m')", (pid, "m%s" % i))
+        execute("INSERT INTO Medias VALUES (?,?,?,'')",
+                (pid, "m%s" % i, "http://example.com/m%s" % i))
+    executemany("INSERT INTO Elements VALUES (?,?,?)",
+                ( (pid, "a%s" % i, ANNOTATION) for i in xrange(nba) ))
+    executemany("INSERT INTO Annotations VALUES (?,?,'',?,?,?)",
+                ( (pid, "a%s" % i, "m%s" % (i%NBM), (i//NBM)*10,
+                   (i//NBM)*10+25) for i in xrange(nba) ))
+    executemany("INSERT INTO Contents VALUES (?,?,'text/plain','','','','')",
+                ( (pid, "a%s" % i) for i in xrange(nba) ))
+    executemany("INSERT INTO Elements VALUES (?,?,'r')",
+                ( (pid, "r%s" % i) for i in xrange(nba//2) ))
+    executemany("INSERT INTO Contents VALUES (?,?,'text/plain','','','','')",
+                ( (pid, "r%s" % i) for i in xrange(nba//2) ))
+    executemany("INSERT INTO RelationMembers VALUES (?,?,?,'',?)",
+                ( (pid, "r%s" % (i//2), i%2, "a%s" % i)
+                  for i in xrange(nba) ))
+    executemany("INSERT INTO Tagged VALUES (?,'',?,'',?)",
+                ( (pid, "a%s" % i, "t%s" % (i%100)) for i in xrange(nba) ))
+    execute("COMMIT")
+
+def measure(label, f):
+    t = time()
+    for i in xrange(NBQ):
+        f()
+    print "  %-32s %8.3fms" % (label, (time()-t)*1000/NBQ)
+
+def run_queries(be, pid, nba):
+    uri = be.get_url(pid)
+    mid = nba//NBM * 5
+    measure("iter_annotations(media, begin)", lambda: list(
+        be.iter_annotations((pid,), media="%s#m3" % uri,
+                            begin_min=mid, begin_max=mid+100)))
+    end = nba//NBM * 10
+    measure("iter_annotations(at)", lambda: list(
+        be.iter_annotations((pid,), begin_max=end-50, end_min=end-50)))
+    measure("iter_relations(member)", lambda: list(
+        be.iter_relations((pid,), member="%s#a%s" % (uri, nba//2))))
+    measure("iter_elements_with_tag", lambda: list(
+        be.iter_elements_with_tag((pid,), "%s#t42" % uri)))
+
+if __name__ == "__main__":
+    for nba in SIZES:
+        url = "%s;p%s" % (IN_MEMORY_URL, nba)
+        be, pid = create(P(url))
+        be.update_url(pid, "http://example.com/p%s" % nba)
+        populate(be, pid, nba)
+        print "%s annotations, with indexes" % nba
+        run_queries(be, pid, nba)
+        for sql in sqlite_init.indexes:
+            be._curs.execute("DROP INDEX %s" % sql.split()[5])
+        be._temporal_index = False
+        print "%s annotations, without indexes" % nba
+        run_queries(be, pid, nba)
+        be.delete(pid) # also closes the in-memory database
@@ -0,0 +1,70 @@
+from unittest import TestCase, main
+
+from libadvene.model.cam.package import Package
+from libadvene.util.session import session
+import advene.core.config as config
+from advene.core.controller import AdveneController
+
+class TestBatch(TestCase):
+
+    def setUp(self):
+        self.p = p = Package("x-invalid-scheme:p", create=True)
+        m = p.create_media("m", "http://example.com/m")
+        t = p.create_annotation_type("t")
+        self.annotations = [ p.create_annotation("a%s" % i, m, i, i+1,
+                                                 "text/plain", type=t)
+                             for i in range(5) ]
+        # a controller with no GUI, player nor event handler
+        self.c = c = AdveneController.__new__(AdveneController)
+        c.package = session.package = p
+        c.modifying_events = ()
+        c.batch_packages = []
+        c.batch_events = None
+        c.batched_packages = []
+        c.cancelled_packages = []
+        self.queued = []
+        self.dispatched = []
+        c.queue_action = lambda method, *param, **kw: \
+            self.queued.append( (param[0], kw) )
+        class EventHandler(object):
+            def notify(_, event_name, *param, **kw):
+                self.dispatched.append( (event_name, kw) )
+        c.event_handler = EventHandler()
+        self.threshold = config.data.preferences['batch-notify-threshold']
+        config.data.preferences['batch-notify-threshold'] = 3
+
+    def tearDown(self):
+        config.data.preferences['batch-notify-threshold'] = self.threshold
+        del session.package
+        self.p.close()
+
+    def test_notify_immediate(self):
+        c = self.c
+        c.notify('AnnotationDelete', annotation=self.annotations[0],
+                 immediate=False)
+        self.assertEqual([], self.dispatched)
+        self.failIf('immediate' in self.queued[0][1])
+        c.notify('AnnotationDelete', annotation=self.annotations[0],
+                 immediate=True)
+        self.assertEqual(1, len(self.queued))
+        self.assertEqual(True, self.dispatched[0][1]['immediate'])
+
+    def test_delete_in_batch(self):
+        c = self.c
+        with c.batch():
+            for a in self.annotations:
+                c.delete_element(a)
+            # nothing is dispatched but the edit session notifications
+            self.assertEqual([], self.queued)
+            self.assertEqual(["EditSessionStart"] * 5,
+                             [ e for e, kw in self.dispatched ])
+        self.assertEqual(0, len(self.p.own.annotations))
+        deleted = [ kw for e, kw in self.queued if e == "AnnotationDelete" ]
+        self.assertEqual(5, len(deleted))
+        self.failIf([ kw for kw in deleted if not kw.get('batched') ])
+        # the views are updated once
+        self.assertEqual(["PackageActivate"],
+                         [ e for e, kw in self.queued if e != "AnnotationDelete" ])
+
+if __name__ == "__main__":
+    main()
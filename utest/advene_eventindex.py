@@ -0,0 +1,66 @@
+from unittest import TestCase, main
+
+from libadvene.model.cam.package import Package
+from advene.core.eventindex import AnnotationEventIndex
+
+class TestAnnotationEventIndex(TestCase):
+
+    def setUp(self):
+        self.p = p = Package("x-invalid-scheme:p", create=True)
+        m = self.m = p.create_media("m", "http://example.com/m")
+        t = self.t = p.create_annotation_type("t")
+        for id, b, e in [ ("a1", 0, 10),
+                          ("a2", 5, 20),
+                          ("a3", 15, 18),
+                          ("a4", 30, 40), ]:
+            p.create_annotation(id, m, b, e, "text/plain", type=t)
+        self.index = AnnotationEventIndex(p, m)
+
+    def tearDown(self):
+        self.index = None
+        self.p.close()
+
+    def ids(self, triplets):
+        return [ a.id for a, b, e in triplets ]
+
+    def test_play(self):
+        index = self.index
+        self.assertEqual(4, len(index))
+        self.assertEqual(["a1"], self.ids(index.pop_begins(0)))
+        self.assertEqual(["a2"], self.ids(index.pop_begins(12)))
+        self.assertEqual(["a1"], self.ids(index.pop_ends(12)))
+        self.assertEqual([], self.ids(index.pop_begins(12)))
+        self.assertEqual(["a3"], self.ids(index.pop_begins(25)))
+        self.assertEqual(["a3", "a2"], self.ids(index.pop_ends(25)))
+        self.assertEqual(["a4"], self.ids(index.iter_future_begins()))
+
+    def test_seek(self):
+        index = self.index
+        index.seek(16)
+        # annotations already started are returned by the next pop_begins,
+        # so that every end event has a matching begin event
+        self.assertEqual(["a2", "a3"], self.ids(index.pop_begins(16)))
+        self.assertEqual([], self.ids(index.pop_begins(16)))
+        self.assertEqual(["a3", "a2"], self.ids(index.pop_ends(25)))
+        self.assertEqual(["a4"], self.ids(index.pop_begins(30)))
+        # seeking backward
+        index.seek(7)
+        self.assertEqual(["a1", "a2"], self.ids(index.iter_future_begins())[:2])
+        self.assertEqual(["a1", "a2", "a3"], self.ids(index.pop_begins(15)))
+        self.assertEqual(["a1"], self.ids(index.pop_ends(15)))
+
+    def test_seek_then_modify(self):
+        index = self.index
+        index.seek(16)
+        a2 = self.p.get("a2")
+        a2.delete()
+        index.remove(a2)
+        self.assertEqual(["a3"], self.ids(index.pop_begins(16)))
+        a5 = self.p.create_annotation("a5", self.m, 17, 19, "text/plain",
+                                      type=self.t)
+        index.add(a5)
+        self.assertEqual(["a5"], self.ids(index.pop_begins(17)))
+        self.assertEqual(["a3", "a5"], self.ids(index.pop_ends(19)))
+
+if __name__ == "__main__":
+    main()
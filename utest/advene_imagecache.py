@@ -0,0 +1,268 @@
+import os
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase, main, skipIf
+from StringIO import StringIO
+
+import advene.core.config as config
+from advene.core.imagecache import ImageCache, Image, RawImage, PackFile, \
+     PackedString
+
+class TestImageCache(TestCase):
+
+    def setUp(self):
+        self.ic = ic = ImageCache()
+        ic[1000] = "png1000"
+        ic[2000] = "png2000"
+        ic.init_value(3000)
+
+    def test_approximate(self):
+        ic = self.ic
+        self.assertEqual(1000, ic.approximate(1010))
+        self.assertEqual(2000, ic.approximate(1990))
+        self.assertEqual([1000, 2000], ic.valid_snapshots())
+        self.assertEqual([3000], ic.missing_snapshots())
+
+    def test_counts(self):
+        ic = self.ic
+        self.assertEqual(2, ic.valid_count())
+        self.assertEqual(1, ic.missing_count())
+        ic[3000] = "png3000"
+        ic.approximate(5000)
+        self.assertEqual(3, ic.valid_count())
+        self.assertEqual(1, ic.missing_count())
+        ic.invalidate(1000)
+        del ic[2000]
+        self.assertEqual(1, ic.valid_count())
+        self.assertEqual(2, ic.missing_count())
+        ic.clear()
+        self.assertEqual(0, ic.valid_count())
+        self.assertEqual(0, ic.missing_count())
+
+    def test_pop(self):
+        ic = self.ic
+        self.assertEqual("png1000", ic.pop(1000))
+        self.assertEqual(None, ic.pop(1000, None))
+        self.assertRaises(KeyError, ic.pop, 1000)
+        self.assertEqual([2000], ic.valid_snapshots())
+        # the removed key is no longer a valid approximation
+        self.assertEqual(1010, ic.approximate(1010))
+        self.assertEqual([1010, 3000], ic.missing_snapshots())
+
+    def test_popitem(self):
+        ic = self.ic
+        while ic:
+            ic.popitem()
+        self.assertEqual([], ic.valid_snapshots())
+        self.assertEqual([], ic.missing_snapshots())
+        self.assertRaises(KeyError, ic.popitem)
+
+    def test_update(self):
+        ic = self.ic
+        ic.update({ 3000: "png3000", 4000: "png4000" })
+        self.assertEqual([1000, 2000, 3000, 4000], ic.valid_snapshots())
+        self.assertEqual([], ic.missing_snapshots())
+        self.assertEqual("png4000", ic[4010])
+
+    def test_setdefault(self):
+        ic = self.ic
+        self.assertEqual("png1000", ic.setdefault(1000, "other"))
+        self.assertEqual("png5000", ic.setdefault(5000, "png5000"))
+        self.assert_(ic.setdefault(6000) is ic.not_yet_available_image)
+        self.assertEqual([1000, 2000, 5000], ic.valid_snapshots())
+        self.assertEqual([3000, 6000], ic.missing_snapshots())
+
+    def test_not_yet_available_copy(self):
+        ic = self.ic
+        # a copy of the placeholder image is not a valid snapshot
+        ic[4000] = str(ic.not_yet_available_image)
+        self.assertEqual([1000, 2000], ic.valid_snapshots())
+        self.assertEqual(4000, ic.approximate(4000))
+        self.assert_(dict.__getitem__(ic, 4000) is ic.not_yet_available_image)
+        self.assertEqual([3000, 4000], ic.missing_snapshots())
+        self.failIf(ic.is_initialized(4000))
+        # invalidate restores the placeholder itself
+        ic.invalidate(1000)
+        self.assert_(dict.__getitem__(ic, 1000) is ic.not_yet_available_image)
+        self.assertEqual([2000], ic.valid_snapshots())
+        self.assertEqual(1010, ic.approximate(1010))
+
+    def test_memory(self):
+        ic = self.ic
+        self.assertEqual(len("png1000") + len("png2000"), ic._memory)
+        # invalid image data has no reduced version
+        self.assert_(ic.get(1000, width=100) is ic[1000])
+        ic[1000] = "png"
+        self.assertEqual(len("png") + len("png2000"), ic._memory)
+        del ic[2000]
+        self.assertEqual(len("png"), ic._memory)
+        ic.clear()
+        self.assertEqual(0, ic._memory)
+
+class TestPackFile(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self.filename = join(self.dirname, "test.pack")
+        self.imagecache_path = config.data.path['imagecache']
+        config.data.path['imagecache'] = self.dirname
+
+    def tearDown(self):
+        config.data.path['imagecache'] = self.imagecache_path
+        rmtree(self.dirname)
+
+    def test_append_read(self):
+        pack = PackFile(self.filename)
+        o1 = pack.append(1000, "\x89PNG1000")
+        o2 = pack.append(2000, "\x00" * 100)
+        self.assertEqual("\x89PNG1000", pack.read(o1, 8))
+        self.assertEqual("\x00" * 100, pack.read(o2, 100))
+        # the file can grow after being mapped
+        o3 = pack.append(3000, "png3000")
+        self.assertEqual("png3000", pack.read(o3, 7))
+        self.assertEqual({ 1000: (o1, 8), 2000: (o2, 100), 3000: (o3, 7) },
+                         pack.index)
+        pack.close()
+
+    def test_reopen(self):
+        pack = PackFile(self.filename)
+        pack.append(1000, "png1000")
+        pack.append(2000, "png2000")
+        pack.append(1000, "other1000")
+        # a null length record cancels the previous ones
+        pack.append(2000, "")
+        pack.close()
+        pack = PackFile(self.filename)
+        self.assertEqual([1000], pack.index.keys())
+        self.assertEqual("other1000", pack.read(*pack.index[1000]))
+        pack.close()
+
+    def test_spill_file(self):
+        pack = PackFile()
+        o = pack.append(1000, "png1000")
+        self.assertEqual("png1000", str(PackedString(pack, o, 7)))
+        self.assertEqual(7, len(PackedString(pack, o, 7)))
+        pack.close()
+
+    def test_evict(self):
+        ic = ImageCache(max_memory=40)
+        for i in range(10):
+            ic[i * 1000] = "png%05d" % i
+        self.assert_(ic._memory <= 40)
+        self.assertEqual(10, ic.valid_count())
+        for i in range(10):
+            self.assertEqual("png%05d" % i, str(ic[i * 1000]))
+        # the most recently used snapshots are kept in memory
+        self.assert_(not isinstance(dict.__getitem__(ic, 9000), PackedString))
+        self.assert_(isinstance(dict.__getitem__(ic, 0), PackedString))
+        ic.clear()
+
+    def test_save_load(self):
+        ic = ImageCache()
+        ic[1000] = "png1000"
+        ic[2000] = "png2000"
+        ic.init_value(3000)
+        filename = ic.save("test")
+        self.assertEqual(join(self.dirname, "test.pack"), filename)
+        self.assert_(isinstance(dict.__getitem__(ic, 1000), PackedString))
+        self.assertEqual("png1000", str(ic[1000]))
+        self.assertEqual(0, ic._memory)
+        ic.clear()
+
+        ic = ImageCache("test")
+        self.assertEqual([1000, 2000], ic.valid_snapshots())
+        self.assertEqual("png2000", str(ic[2000]))
+        self.assertEqual(2000, ic[2000].timestamp)
+        # autosync appends the new snapshots to the pack file
+        ic.autosync = True
+        ic[3000] = "png3000"
+        ic[1000] = "new1000"
+        ic.clear()
+        ic = ImageCache("test")
+        self.assertEqual([1000, 2000, 3000], ic.valid_snapshots())
+        self.assertEqual("new1000", str(ic[1000]))
+        self.assertEqual("png3000", str(ic[3000]))
+        ic.clear()
+
+@skipIf(Image is None, "the Image module is not available")
+class TestThumbnails(TestCase):
+
+    def setUp(self):
+        # noise, so that the PNG data is larger than its reduced versions
+        frombytes = getattr(Image, "frombytes", None) or Image.fromstring
+        out = StringIO()
+        frombytes("RGB", (640, 480), os.urandom(640 * 480 * 3)).save(out, "PNG")
+        self.png = out.getvalue()
+        self.ic = ImageCache()
+
+    def test_make_thumbnails(self):
+        ic = self.ic
+        ic[1000] = self.png
+        s = ic[1000]
+        t160 = s.thumbnail(100)
+        t320 = s.thumbnail(200)
+        self.assertEqual((160, 120), (t160.width, t160.height))
+        self.assertEqual((320, 240), (t320.width, t320.height))
+        self.assertEqual("image/jpeg", t160.contenttype)
+        self.assertEqual(1000, t160.timestamp)
+        self.assertEqual((160, 120), Image.open(StringIO(t160)).size)
+        # the snapshot itself is the largest version
+        self.assert_(s.thumbnail(400) is s)
+        # reduced versions have no reduced versions
+        self.assert_(t320.thumbnail(100) is t320)
+        self.assertEqual(0, t320.thumbnails_size())
+
+    def test_thumbnail_height(self):
+        ic = self.ic
+        ic[1000] = self.png
+        self.assertEqual(240, ic.get(1000, height=200).height)
+        self.assertEqual(120, ic.get(1000, height=60).height)
+        self.assert_(ic.get(1000, height=300) is ic[1000])
+
+    def test_raw(self):
+        ic = self.ic
+        ic[1000] = self.png
+        r = ic.get(1000, width=100, raw=True)
+        self.assert_(isinstance(r, RawImage))
+        self.assertEqual((160, 120), (r.width, r.height))
+        self.assertEqual(160 * 120 * 3, len(r))
+        self.assertEqual(1000, r.timestamp)
+        # the raw version is only returned if it is large enough
+        self.assertEqual(240, ic.get(1000, width=200, raw=True).height)
+
+    def test_memory(self):
+        ic = self.ic
+        ic[1000] = self.png
+        size = ic[1000].thumbnails_size()
+        self.assert_(size > 160 * 120 * 3)
+        self.assertEqual(len(self.png) + size, ic._memory)
+        del ic[1000]
+        self.assertEqual(0, ic._memory)
+
+    def test_evict(self):
+        ic = self.ic
+        ic[1000] = self.png
+        size = ic[1000].thumbnails_size()
+        # the snapshots no longer fit, but their reduced versions do
+        # (eviction frees a quarter of the budget)
+        ic.max_memory = 2 * size * 4 / 3 + 4
+        ic[2000] = self.png
+        self.assertEqual(str(ic[1000]), self.png)
+        self.assertEqual(str(ic[2000]), self.png)
+        self.assertEqual(2 * size, ic._memory)
+        self.assertEqual(size, ic[1000].thumbnails_size())
+        self.assertEqual(160, ic.get(1000, width=100).width)
+        # the reduced versions do not fit either
+        ic.max_memory = 1
+        ic[3000] = self.png
+        self.assertEqual(0, ic._memory)
+        self.assertEqual(0, ic[1000].thumbnails_size())
+        self.assertEqual(str(ic[3000]), self.png)
+        # they are generated again when needed, within the budget
+        ic.max_memory = size + 1
+        self.assertEqual(160, ic.get(1000, width=100).width)
+        self.assertEqual(size, ic._memory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+from unittest import TestCase, main
+
+from libadvene.model.cam.package import Package
+from libadvene.model.tales import AdveneContext
+from advene.rules.elements import Condition, ConditionList, Rule
+from advene.rules.ecaengine import RuleIndex
+
+class TestConditions(TestCase):
+
+    def setUp(self):
+        self.p = p = Package("x-invalid-scheme:p", create=True)
+        m = p.create_media("m", "http://example.com/m")
+        self.t1 = p.create_annotation_type("t1")
+        self.t2 = p.create_annotation_type("t2")
+        self.a1 = p.create_annotation("a1", m, 0, 10, "text/plain", type=self.t1)
+        self.a1.content_data = "hello world"
+        self.a2 = p.create_annotation("a2", m, 20, 30, "text/plain", type=self.t2)
+        self.a2.content_data = "goodbye"
+
+    def tearDown(self):
+        self.p.close()
+
+    def context(self, **kw):
+        c = AdveneContext(here=self.p)
+        for k, v in kw.iteritems():
+            c.addGlobal(k, v)
+        return c
+
+    def test_match(self):
+        c = self.context(annotation=self.a1)
+        self.assert_(Condition("annotation/type/id", "string:t1", "equals").match(c))
+        self.failIf(Condition("annotation/type/id", "string:t2", "equals").match(c))
+        self.assert_(Condition("annotation/content/data", "string:world",
+                               "contains").match(c))
+        self.assert_(Condition("annotation/content/data", "string:^hel+o",
+                               "matches").match(c))
+        self.failIf(Condition("annotation/content/data", "string:^world",
+                              "matches").match(c))
+        self.assert_(Condition("annotation/begin", "annotation/end",
+                               "lower").match(c))
+        self.assert_(Condition("annotation", operator="value").match(c))
+        self.failIf(Condition("annotation", operator="not").match(c))
+
+    def test_match_recompiles(self):
+        c = self.context(annotation=self.a1)
+        cond = Condition("annotation/type/id", "string:t1", "equals")
+        self.assert_(cond.match(c))
+        cond.rhs = "string:t2"
+        self.failIf(cond.match(c))
+
+    def test_match_path_not_found(self):
+        c = self.context(annotation=self.a1)
+        self.failIf(Condition("annotation/nosuchattribute/id", "string:t1",
+                              "equals").match(c))
+        self.failIf(Condition("nosuchvariable", operator="value").match(c))
+        self.assert_(Condition("nosuchvariable/id", operator="not").match(c))
+
+    def test_get_prefilter(self):
+        self.assertEqual(("type", "annotation", "t1"),
+                         Condition("annotation/type/id", "string:t1",
+                                   "equals").get_prefilter())
+        self.assertEqual(("contains", "annotation", "world"),
+                         Condition("annotation/content/data", "string:world",
+                                   "contains").get_prefilter())
+        # not constant
+        self.assertEqual(None, Condition("annotation/type/id", "relation/type/id",
+                                         "equals").get_prefilter())
+        # not a type or content check
+        self.assertEqual(None, Condition("annotation/type/title", "string:t1",
+                                         "equals").get_prefilter())
+        self.assertEqual(None, Condition("annotation/type/id", "string:t1",
+                                         "different").get_prefilter())
+        self.assertEqual(None, Condition("annotation", operator="value").get_prefilter())
+
+    def test_candidates(self):
+        def rule(name, *conditions):
+            cl = ConditionList(conditions)
+            return Rule(name=name, event="AnnotationCreate", condition=cl)
+        t1 = Condition("annotation/type/id", "string:t1", "equals")
+        t2 = Condition("annotation/type/id", "string:t2", "equals")
+        hello = Condition("annotation/content/data", "string:hello", "contains")
+        any_ = ConditionList([ t1, t2 ])
+        any_.composition = "or"
+        rules = [ rule("r1", t1),
+                  rule("r2", t2),
+                  rule("r3", hello),
+                  Rule(name="r4", event="AnnotationCreate", condition=any_),
+                  rule("r5", t1, hello),
+                  rule("r6") ]
+        index = RuleIndex(rules)
+        def names(**kw):
+            return [ r.name for r in index.candidates(kw) ]
+        self.assertEqual(["r1", "r3", "r4", "r5", "r6"], names(annotation=self.a1))
+        self.assertEqual(["r2", "r4", "r6"], names(annotation=self.a2))
+        self.assertEqual(1 + 3, index.skipped)
+        # rules are not skipped when the parameter is missing
+        self.assertEqual([ r.name for r in rules ], names(relation=self.a1))
+
+if __name__ == "__main__":
+    main()
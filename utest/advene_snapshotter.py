@@ -0,0 +1,24 @@
+from unittest import TestCase, main
+
+from advene.util.snapshotter import plan_batch
+
+class TestPlanBatch(TestCase):
+
+    def test_sort_and_deduplicate(self):
+        self.assertEqual([[10, 20, 30]], plan_batch([30, 10, 20, 10]))
+        self.assertEqual([[10, 30]], plan_batch([10, 15, 30, 33], epsilon=5))
+        self.assertEqual([], plan_batch([]))
+
+    def test_epsilon_from_kept_timestamp(self):
+        # timestamps are compared to the last kept one
+        self.assertEqual([[0, 15]], plan_batch([0, 5, 10, 15, 20], epsilon=10))
+
+    def test_chunks(self):
+        chunks = plan_batch(range(10), workers=3)
+        self.assertEqual([[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]], chunks)
+        # no more chunks than timestamps
+        self.assertEqual([[1], [2]], plan_batch([2, 1], workers=4))
+        self.assertEqual([[1, 2]], plan_batch([2, 1], workers=0))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+from email.utils import formatdate
+from unittest import TestCase, main
+
+import cherrypy
+
+from libadvene.model.cam.package import Package
+from advene.server.webcherry import ResponseCache
+
+class TestResponseCache(TestCase):
+
+    def setUp(self):
+        self.p = Package("x-invalid-scheme:p", create=True)
+        self.m = self.p.create_media("m", "http://example.com/m")
+        self.cache = ResponseCache(2)
+        self.new_request()
+
+    def tearDown(self):
+        self.p.close()
+
+    def new_request(self, **headers):
+        cherrypy.request.base = "http://localhost:1234"
+        cherrypy.request.headers = headers
+        cherrypy.request.advene_cache_uses = None
+        cherrypy.response.headers = {}
+        cherrypy.response.status = 200
+
+    def store(self, tales, body, current=None):
+        cache = self.cache
+        key = cache.key("p", tales, {}, "view")
+        return cache.store(key, self.p, current, "text/html", body)
+
+    def get(self, tales, current=None):
+        cache = self.cache
+        return cache.get(cache.key("p", tales, {}, "view"), self.p, current)
+
+    def test_key(self):
+        self.assertNotEqual(None, self.cache.key("p", "annotations", {}, "view"))
+        self.assertEqual(None, self.cache.key("p", "options/x", {}, "view"))
+        self.assertEqual(None, ResponseCache(0).key("p", "annotations", {}, "view"))
+
+    def test_get(self):
+        entry = self.store("annotations", "body")
+        self.assertEqual(entry, self.get("annotations"))
+        self.assertEqual("body", entry[3])
+        self.assertEqual(None, self.get("medias"))
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+        # another package with the same alias
+        p2 = Package("x-invalid-scheme:p2", create=True)
+        key = self.cache.key("p", "annotations", {}, "view")
+        self.assertEqual(None, self.cache.get(key, p2, None))
+        p2.close()
+
+    def test_clock(self):
+        self.store("a", "a")
+        self.store("b", "b")
+        # a hit protects the entry from eviction
+        self.assertNotEqual(None, self.get("a"))
+        self.store("c", "c")
+        self.assertNotEqual(None, self.get("a"))
+        self.assertEqual(None, self.get("b"))
+        self.assertNotEqual(None, self.get("c"))
+
+    def test_invalidate(self):
+        self.store("annotations", "body")
+        t = self.p.create_annotation_type("t")
+        self.assertEqual(None, self.get("annotations"))
+        self.store("annotations", "body")
+        self.p.create_annotation("a1", self.m, 0, 10, "text/plain", type=t)
+        self.assertEqual(None, self.get("annotations"))
+        self.store("annotations", "body")
+        self.p.set_meta("http://example.com/k", "v")
+        self.assertEqual(None, self.get("annotations"))
+
+    def test_volatile(self):
+        cache = self.cache
+        uses = cache._uses()
+        uses.add("player")
+        self.assertEqual(None, self.store("player", "body"))
+        self.new_request()
+        cache.forbid()
+        self.assertEqual(None, self.store("annotations", "error"))
+        self.assertEqual(None, self.get("annotations"))
+
+    def test_current_package(self):
+        current = Package("x-invalid-scheme:current", create=True)
+        self.cache._uses().add("package")
+        self.store("annotations", "body", current)
+        self.assertNotEqual(None, self.get("annotations", current))
+        self.assertEqual(None, self.get("annotations", self.p))
+        current.close()
+
+    def test_send(self):
+        entry = self.store("annotations", "body")
+        etag, date = entry[:2]
+        self.assertEqual("body", self.cache.send(entry))
+        self.assertEqual(200, cherrypy.response.status)
+        headers = cherrypy.response.headers
+        self.assertEqual(etag, headers["ETag"])
+        self.assertEqual(formatdate(date, usegmt=True), headers["Last-Modified"])
+        self.assertEqual("text/html", headers["Content-type"])
+
+    def test_if_none_match(self):
+        entry = self.store("annotations", "body")
+        etag = entry[0]
+        for tags, status in ( (etag, 304),
+                              ('"other", %s' % etag, 304),
+                              ("*", 304),
+                              ('"other"', 200) ):
+            self.new_request(**{ "If-None-Match": tags })
+            body = self.cache.send(entry)
+            self.assertEqual(status, cherrypy.response.status)
+            self.assertEqual(status == 200 and "body" or "", body)
+
+    def test_if_modified_since(self):
+        entry = self.store("annotations", "body")
+        date = entry[1]
+        for since, status in ( (date, 304),
+                               (date + 3600, 304),
+                               (date - 3600, 200) ):
+            self.new_request(**{ "If-Modified-Since": formatdate(since, usegmt=True) })
+            self.cache.send(entry)
+            self.assertEqual(status, cherrypy.response.status)
+        # If-None-Match has precedence
+        self.new_request(**{ "If-Modified-Since": formatdate(date, usegmt=True),
+                             "If-None-Match": '"other"' })
+        self.cache.send(entry)
+        self.assertEqual(200, cherrypy.response.status)
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,15 @@ from sqlite3 import dbapi2 as sqlite
 from os        import path, rmdir, unlink
 from os.path   import exists, join
 from tempfile  import mkdtemp as mkdtemp_orig
+from threading import Thread
 from unittest  import TestCase, main
 from urllib    import pathname2url
 
 from libadvene.model.backends.sqlite \
   import claims_for_create, create, claims_for_bind, bind, IN_MEMORY_URL, \
-         PackageInUse, InternalError, _set_module_debug
+         BACKEND_VERSION, PackageInUse, InternalError, WrongFormat, \
+         _set_module_debug
+from libadvene.model.exceptions import ModelError
 from libadvene.model.core.element \
   import MEDIA, ANNOTATION, RELATION, VIEW, RESOURCE, TAG, LIST, QUERY, IMPORT
 
@@ -201,6 +204,79 @@ class TestBindBackend(TestCase):
             not claims_for_bind(self.url2)
         )
 
+    def test_claim_upgrades_backend_version(self):
+        cx = sqlite.connect(self.filename)
+        cx.execute("drop index AnnotationsByMedia")
+        cx.execute("update Version set version='1.2'")
+        cx.commit()
+        cx.close()
+        self.assert_(
+            claims_for_bind(self.url2)
+        )
+        # the claim itself does not modify the database...
+        cx = sqlite.connect(self.filename)
+        self.assertEqual([("1.2",)],
+                         cx.execute("select version from Version").fetchall())
+        cx.close()
+        # ... binding does
+        b, i = bind(P(self.url2))
+        b.close(i)
+        cx = sqlite.connect(self.filename)
+        self.assertEqual([(BACKEND_VERSION,)],
+                         cx.execute("select version from Version").fetchall())
+        self.assertEqual(1, len(cx.execute("select name from sqlite_master "
+                                           "where type = 'index' and name = "
+                                           "'AnnotationsByMedia'").fetchall()))
+        cx.close()
+
+    def test_claim_upgrades_references(self):
+        b, i = bind(P(self.url2))
+        b.create_media(i, "m1", "http://example.com/m1.avi",
+                       "http://advene.org/ns/frame_of_reference/ms;o=0")
+        b.create_annotation(i, "a1", "m1", 0, 10, "text/plain", "", "")
+        b.close(i)
+        cx = sqlite.connect(self.filename)
+        cx.execute("drop table Refs")
+        cx.execute("update Version set version='1.3'")
+        cx.commit()
+        cx.close()
+        self.assert_(
+            claims_for_bind(self.url2)
+        )
+        b, i = bind(P(self.url2))
+        self.assertEqual([(i, "a1", "media")],
+                         list(b.iter_references([i], self.url2 + "#m1")))
+        b.close(i)
+
+    def test_claim_upgrades_fingerprints(self):
+        b, i = bind(P(self.url2))
+        b.create_media(i, "m1", "http://example.com/m1.avi",
+                       "http://advene.org/ns/frame_of_reference/ms;o=0")
+        b.close(i)
+        cx = sqlite.connect(self.filename)
+        cx.execute("drop table Fingerprints")
+        cx.execute("update Version set version='1.4'")
+        cx.commit()
+        cx.close()
+        self.assert_(
+            claims_for_bind(self.url2)
+        )
+        b, i = bind(P(self.url2))
+        b.update_fingerprints(i)
+        self.assertEqual(1, len([ f for _, f in b.iter_fingerprints(i, MEDIA)
+                                  if f ]))
+        b.close(i)
+
+    def test_claim_no_upgrade_path(self):
+        cx = sqlite.connect(self.filename)
+        cx.execute("update Version set version='0.1'")
+        cx.commit()
+        cx.close()
+        self.assert_(
+            not claims_for_bind(self.url2)
+        )
+        self.assertRaises(WrongFormat, bind, P(self.url2))
+
     def test_claim_wrong_pid(self):
         self.assert_(
             not claims_for_bind("%s;bar" % self.url1)
@@ -475,6 +551,176 @@ class TestCreateElement(TestCase):
                          self.be.get_content_info(self.pid, "i1", IMPORT))
 
 
+class TestBulk(TestCase):
+    def setUp(self):
+        self.url1 = IN_MEMORY_URL
+        self.url2 = "%s;foo" % self.url1
+        self.be, self.pid = create(P(self.url2))
+
+    def tearDown(self):
+        self.be.delete(self.pid)
+        del P._L[:] # not required, but saves memory
+
+    def test_bulk_commit(self):
+        url = "http://example.com/m1.avi"
+        foref = "http://advene.org/ns/frame_of_reference/ms;o=0"
+        self.be.begin_bulk()
+        self.be.create_media(self.pid, "m1", url, foref)
+        self.be.begin_bulk() # nested bulk section
+        self.be.create_annotation(self.pid, "a1", "m1", 10, 20,
+                                  "text/plain", "", "")
+        self.be.end_bulk()
+        self.be.set_meta(self.pid, "a1", ANNOTATION, "k", "v", False)
+        # elements are visible inside the bulk section
+        self.assert_(self.be.has_element(self.pid, "a1", ANNOTATION))
+        self.be.end_bulk()
+        self.assert_(self.be.has_element(self.pid, "m1", MEDIA))
+        self.assert_(self.be.has_element(self.pid, "a1", ANNOTATION))
+        self.assertEqual(("v", False),
+                         self.be.get_meta(self.pid, "a1", ANNOTATION, "k"))
+        # normal transactions are possible again
+        self.be.create_tag(self.pid, "t1")
+        self.assert_(self.be.has_element(self.pid, "t1", TAG))
+
+    def test_bulk_failed_modification(self):
+        self.be.create_tag(self.pid, "t1")
+        self.be.begin_bulk()
+        self.be.create_tag(self.pid, "t2")
+        self.assertRaises(ModelError, self.be.create_tag, self.pid, "t1")
+        self.be.create_tag(self.pid, "t3")
+        # only the failed modification is cancelled
+        self.be.end_bulk()
+        self.assert_(self.be.has_element(self.pid, "t1", TAG))
+        self.assert_(self.be.has_element(self.pid, "t2", TAG))
+        self.assert_(self.be.has_element(self.pid, "t3", TAG))
+
+    def test_bulk_failed_after_write(self):
+        self.be.create_tag(self.pid, "t1")
+        self.be.begin_bulk()
+        self.be.create_tag(self.pid, "t2")
+        # a modification failing after writing can not be cancelled alone
+        url = "http://example.com/m1.avi"
+        foref = "http://advene.org/ns/frame_of_reference/ms;o=0"
+        self.be.create_media(self.pid, "m1", url, foref)
+        # (an unsupported URL makes the last insertion fail)
+        self.assertRaises(InternalError, self.be.create_annotation,
+                          self.pid, "a1", "m1", 10, 20,
+                          "text/plain", "", object())
+        self.assertRaises(InternalError, self.be.end_bulk)
+        self.assert_(self.be.has_element(self.pid, "t1", TAG))
+        self.failIf(self.be.has_element(self.pid, "t2", TAG))
+        self.failIf(self.be.has_element(self.pid, "m1", MEDIA))
+        self.failIf(self.be.has_element(self.pid, "a1", ANNOTATION))
+        # normal transactions are possible again
+        self.be.create_tag(self.pid, "t3")
+        self.assert_(self.be.has_element(self.pid, "t3", TAG))
+
+    def test_bulk_context(self):
+        self.be.create_tag(self.pid, "t1")
+        def create_twice():
+            with self.be.bulk():
+                self.be.create_tag(self.pid, "t2")
+                self.be.create_tag(self.pid, "t1")
+        # the original exception is not masked
+        self.assertRaises(ModelError, create_twice)
+        self.assertEqual(0, self.be._bulk)
+        self.assert_(self.be.has_element(self.pid, "t2", TAG))
+
+
+class TestConcurrentReads(TestCase):
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self.filename = join(self.dirname, "db")
+        self.url = "sqlite:%s;foo" % pathname2url(self.filename)
+        self.be, self.pid = create(P(self.url))
+
+    def tearDown(self):
+        self.be.close(self.pid)
+        for suffix in ("", "-wal", "-shm"):
+            if exists(self.filename + suffix):
+                unlink(self.filename + suffix)
+        rmdir(self.dirname)
+        del P._L[:] # not required, but saves memory
+
+    def in_thread(self, f, *args):
+        r = []
+        def run():
+            try:
+                r.append(f(*args))
+            except Exception, e:
+                r.append(e)
+        t = Thread(target=run)
+        t.start()
+        t.join()
+        return r[0]
+
+    def test_in_memory(self):
+        be, pid = create(P("%s;foo" % IN_MEMORY_URL))
+        self.assert_(not be.enable_concurrent_reads())
+        be.delete(pid)
+
+    def test_concurrent_reads(self):
+        self.assert_(self.be.enable_concurrent_reads())
+        self.be.create_tag(self.pid, "t1")
+        has = self.be.has_element
+        self.assert_(self.in_thread(has, self.pid, "t1", TAG))
+        ids = lambda: [ t[2] for t in self.be.iter_tags((self.pid,)) ]
+        self.assertEqual(["t1"], self.in_thread(ids))
+
+        # a bulk section in progress is not visible from other threads...
+        self.be.begin_bulk()
+        self.be.create_tag(self.pid, "t2")
+        self.assert_(has(self.pid, "t2", TAG))
+        self.assert_(not self.in_thread(has, self.pid, "t2", TAG))
+        # ... which do not block because of it
+        self.assertEqual(["t1"], self.in_thread(ids))
+        self.be.end_bulk()
+        self.assert_(self.in_thread(has, self.pid, "t2", TAG))
+
+        # other threads can also write
+        self.in_thread(self.be.create_tag, self.pid, "t3")
+        self.assert_(has(self.pid, "t3", TAG))
+        self.assertEqual(["t1", "t2", "t3"], sorted(self.in_thread(ids)))
+
+    def test_read_own_writes(self):
+        self.assert_(self.be.enable_concurrent_reads())
+        for i in xrange(5):
+            self.be.create_tag(self.pid, "t%s" % i)
+        it = self.be.iter_tags((self.pid,))
+        it.next()
+        # a pending iterator does not hide the writes of its thread
+        self.be.create_tag(self.pid, "u")
+        self.assert_(self.be.has_element(self.pid, "u", TAG))
+        self.assertEqual(4, len(list(it)))
+
+    def test_concurrent_writer(self):
+        self.assert_(self.be.enable_concurrent_reads())
+        be, pid = self.be, self.pid
+        n = 200
+        errors = []
+        def write():
+            try:
+                for i in xrange(n):
+                    be.create_tag(pid, "w%s" % i)
+                    be.set_meta(pid, "w%s" % i, TAG, "k", "v", False)
+            except Exception, e:
+                errors.append(e)
+        t = Thread(target=write)
+        t.start()
+        # the thread that enabled concurrent reads reads and writes meanwhile
+        i = 0
+        while t.isAlive() or i < 10:
+            for tag in be.iter_tags((pid,)):
+                self.assertEqual(pid, tag[1])
+            be.create_tag(pid, "o%s" % i)
+            self.assert_(be.has_element(pid, "o%s" % i, TAG))
+            i += 1
+        t.join()
+        self.assertEqual([], errors)
+        ids = set( tag[2] for tag in be.iter_tags((pid,)) )
+        self.assertEqual(n + i, len(ids))
+
+
 class TestHandleElements(TestCase):
 
     url1 = "http://example.com/p1"
@@ -641,6 +887,42 @@ class TestHandleElements(TestCase):
             ]),
             frozenset(self.be.iter_references([self.pid1], u2 % "a6")))
 
+    def test_has_references(self):
+        pid1 = self.pid1
+        u2 = "%s#%%s" % self.i1_uri
+        self.assert_(self.be.has_references([pid1], u2 % "m3"))
+        self.assert_(not self.be.has_references([pid1], u2 % "a5"))
+        self.be.insert_member(pid1, "r1", "i1:a5", 0)
+        self.assert_(self.be.has_references([pid1], u2 % "a5"))
+        self.assert_(not self.be.has_references([self.pid2], u2 % "a5"))
+        self.be.remove_member(pid1, "r1", 0)
+        self.assert_(not self.be.has_references([pid1], u2 % "a5"))
+
+    def test_references_follow_modifications(self):
+        pid1 = self.pid1
+        u2 = "%s#%%s" % self.i1_uri
+        key = "http://www.w3.org/2000/01/rdf-schema#seeAlso"
+        refs = lambda id: frozenset(self.be.iter_references([pid1], u2 % id))
+        self.be.insert_item(pid1, "l1", "i1:a5", 0)
+        self.be.insert_item(pid1, "l1", "i1:a6", 0)
+        self.assertEqual(frozenset([(pid1, "l1", ":item 1")]), refs("a5"))
+        self.be.remove_item(pid1, "l1", 0)
+        self.assertEqual(frozenset([(pid1, "l1", ":item 0")]), refs("a5"))
+        self.assertEqual(frozenset(), refs("a6"))
+        self.be.rename_element(pid1, "l1", LIST, "l9")
+        self.assertEqual(frozenset([(pid1, "l9", ":item 0")]), refs("a5"))
+        self.be.associate_tag(pid1, "i1:a5", "t1")
+        self.be.set_meta(pid1, "a1", ANNOTATION, key, "i1:a5", True)
+        self.be.set_meta(pid1, "a1", ANNOTATION, key, "i1:a6", True)
+        self.assertEqual(frozenset([(pid1, "l9", ":item 0"),
+                                    (pid1, "", ":tagged t1")]), refs("a5"))
+        self.assertEqual(frozenset([(pid1, "a1", ":meta "+key)]), refs("a6"))
+        self.be.set_meta(pid1, "a1", ANNOTATION, key, None, False)
+        self.be.dissociate_tag(pid1, "i1:a5", "t1")
+        self.be.delete_element(pid1, "l9", LIST)
+        self.assertEqual(frozenset(), refs("a5"))
+        self.assertEqual(frozenset(), refs("a6"))
+
     def test_iter_references_with_import(self):
         key = "http://www.w3.org/2000/01/rdf-schema#seeAlso"
         self.be.update_content_info(self.pid1, "a2", ANNOTATION,
@@ -1343,6 +1625,139 @@ class TestHandleElements(TestCase):
                           "text/plain", "", ""),
                          self.be.get_element(self.pid1, "a1"))
 
+    def test_temporal_index(self):
+        self.assert_(self.be._temporal_index)
+        get = lambda t: [ i[2] for i in self.be.iter_annotations(
+                          (self.pid1,), begin_max=t, end_min=t) ]
+        self.assertEqual(["a4", "a3", "a2", "a1"], get(18))
+        self.be.update_annotation(self.pid1, "a1", "m1", 25, 30)
+        self.assertEqual(["a4", "a3", "a2"], get(18))
+        self.assertEqual(["a2", "a1"], get(26))
+        self.be.delete_element(self.pid1, "a2", ANNOTATION)
+        self.assertEqual(["a1"], get(26))
+        self.assertEqual(1, self.be.count_annotations((self.pid1,),
+                                                      begin_max=26, end_min=26))
+        # annotations may temporarily end before they begin
+        self.be.update_annotation(self.pid1, "a1", "m1", 35, 30)
+        self.assertEqual([], get(32))
+        self.be.update_annotation(self.pid1, "a1", "m1", 31, 40)
+        self.assertEqual(["a1"], get(32))
+
+    def test_temporal_index_stable_keys(self):
+        get = lambda t: [ i[2] for i in self.be.iter_annotations(
+                          (self.pid1,), begin_max=t, end_min=t) ]
+        expected = get(18)
+        self.be.delete_element(self.pid1, "a2", ANNOTATION)
+        expected.remove("a2")
+        # a VACUUM may renumber the rowids of Annotations
+        self.be._curs.execute("VACUUM")
+        self.assertEqual(expected, get(18))
+        self.be.rename_element(self.pid1, "a1", ANNOTATION, "a1bis")
+        self.assertEqual([ i == "a1" and "a1bis" or i for i in expected ],
+                         get(18))
+
+    def test_iter_annotations_with_content(self):
+        self.be.update_content_data(self.pid1, "a2", ANNOTATION, "hello")
+        r = dict( (i[2], i) for i in self.be.iter_annotations(
+                  (self.pid1,), with_content=True) )
+        self.assertEqual("hello", r["a2"][-1])
+        self.assertEqual("", r["a1"][-1])
+        self.assertEqual(self.be.get_element(self.pid1, "a2"), r["a2"][:-1])
+
+    def test_fingerprints(self):
+        def get():
+            return dict(self.be.iter_fingerprints(self.pid1, ANNOTATION))
+        self.assertEqual(set([None]), set(get().values()))
+        self.be.update_fingerprints(self.pid1)
+        ref = get()
+        self.assertEqual(4, len(set(ref.values())))
+        self.assertTrue(None not in ref.values())
+
+        for change in [
+            lambda: self.be.update_annotation(self.pid1, "a2",
+                                              self.a2[2], 15, 25),
+            lambda: self.be.update_content_data(self.pid1, "a2", ANNOTATION,
+                                                "hello"),
+            lambda: self.be.set_meta(self.pid1, "a2", ANNOTATION, "k", "v",
+                                     False),
+            lambda: self.be.associate_tag(self.pid1, "a2", "t1"),
+        ]:
+            change()
+            fps = get()
+            self.assertEqual(None, fps["a2"])
+            self.assertEqual(ref["a1"], fps["a1"])
+            self.be.update_fingerprints(self.pid1)
+            fps = get()
+            self.assertNotEqual(ref["a2"], fps["a2"])
+            ref = fps
+
+        self.be.update_content_info(self.pid1, "a1", ANNOTATION, "text/plain",
+                                    "", "packaged:/data/a1")
+        self.be.update_fingerprints(self.pid1)
+        self.assertEqual("", get()["a1"])
+
+    def test_iter_annotations_filtered(self):
+        def get(*a, **k):
+            return [ i[2] for i in self.be.iter_annotations(*a, **k) ]
+        pids = (self.pid1, self.pid2,)
+        self.be.update_content_data(self.pid1, "a2", ANNOTATION, "foo bar")
+        self.be.update_content_data(self.pid1, "a3", ANNOTATION, "bar")
+        self.be.update_content_data(self.pid2, "a5", ANNOTATION, "a foo")
+        self.assertEqual(["a2", "a5"], get(pids, data_contains="foo"))
+        self.assertEqual(1, self.be.count_annotations(pids,
+                                                     data_contains="foo bar"))
+        # external contents can not be checked
+        self.be.update_content_info(self.pid1, "a1", ANNOTATION,
+                                    "text/plain", "", "http://example.com/")
+        self.assertEqual(["a2", "a1", "a5"], get(pids, data_contains="foo"))
+
+        self.be.set_meta(self.pid1, "a3", ANNOTATION, "k", "v", False)
+        self.be.set_meta(self.pid2, "a5", ANNOTATION, "k", "w", False)
+        self.assertEqual(["a3"], get(pids, meta=[("k", "v", False)]))
+        self.assertEqual(["a3", "a5"],
+                         get(pids, meta=[("k", "v", False)], data_contains="bar")
+                       + get(pids, meta=[("k", "w", False)], data_contains="foo"))
+        self.assertEqual(0, self.be.count_annotations(pids,
+                                                     meta=[("k", "v", False)],
+                                                     data_contains="foo"))
+
+    def test_iter_annotations_matches(self):
+        if not self.be._fulltext_index:
+            return # FTS5 not available in this sqlite build
+        self.be.update_content_data(self.pid1, "a2", ANNOTATION,
+                                    "Hello World")
+        self.be.update_content_data(self.pid1, "a1", ANNOTATION,
+                                    "hello there")
+        def search(*args):
+            ordered = [ i[2] for i in self.be.iter_annotations((self.pid1,)) ]
+            r = [ i[2] for i in self.be.iter_annotations(
+                                (self.pid1,), data_matches=args) ]
+            # the order of iter_annotations is kept
+            self.assertEqual([ i for i in ordered if i in r ], r)
+            return set(r)
+        self.assertEqual(set(["a1", "a2"]), search(("hello",), (), ()))
+        self.assertEqual(set(["a2"]), search(("hello", "world"), (), ()))
+        self.assertEqual(set(["a1"]), search(("hello",), (), ("world",)))
+        self.assertEqual(set(["a1", "a2"]), search((), ("there", "world"), ()))
+        self.assertEqual(set(["a2"]), search(("orl",), (), ()))
+        self.be.update_content_data(self.pid1, "a2", ANNOTATION, "bye")
+        self.assertEqual(set(["a1"]), search(("hello",), (), ()))
+        # terms too short for the index can not pre-select anything
+        self.assertEqual(4, len(search(("he",), (), ())))
+        # external contents can not be checked
+        self.be.update_content_info(self.pid1, "a3", ANNOTATION,
+                                    "text/plain", "", "http://example.com/")
+        self.assertEqual(set(["a1", "a3"]), search(("hello",), (), ()))
+        # the index is not keyed on rowids, which a VACUUM may change
+        self.be.delete_element(self.pid1, "a1", ANNOTATION)
+        self.be._curs.execute("VACUUM")
+        self.assertEqual(set(["a3"]), search(("hello",), (), ()))
+        self.assertEqual(set(["a2", "a3"]), search(("bye",), (), ()))
+        self.be.rename_element(self.pid1, "a2", ANNOTATION, "a2bis")
+        self.assertEqual(set(["a2bis", "a3"]), search(("bye",), (), ()))
+        self.be.update_content_data(self.pid1, "a2bis", ANNOTATION, "ciao")
+        self.assertEqual(set(["a3"]), search(("bye",), (), ()))
+
     def test_update_import(self):
         self.be.update_import(self.pid1, "i1", "http://foo.com/advene/db",
                                                 "urn:xyz")
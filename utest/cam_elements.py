@@ -9,6 +9,7 @@ from datetime import datetime
 from unittest import TestCase, main
 
 from libadvene.model.cam.package import Package
+import libadvene.model.cam.util.bookkeeping as bk
 from libadvene.util.session import session
 
 class TestBookkeeping(TestCase):
@@ -67,6 +68,37 @@ class TestBookkeeping(TestCase):
         assert r.contributor == "third_user"
         assert r.modified > r.created
 
+    def testDeferredModificationMD(self):
+        p = self.p
+        session.user = "second_user"
+        r = p.create_resource("r1", "text/plain")
+        r2 = p.create_resource("r2", "text/plain")
+        bk.begin_deferred(p)
+        session.user = "third_user"
+        r.content_data = "bla bla bla"
+        r.content_data = "bla bla bla bla"
+        r2.content_data = "bla"
+        r2.delete()
+        assert r.contributor == "second_user"
+        assert p.contributor == "second_user"
+        bk.end_deferred(p)
+        assert p.contributor == "third_user"
+        assert r.contributor == "third_user"
+        assert r.modified > r.created
+        assert p.modified >= r.modified
+    def testBatchModificationMD(self):
+        p = self.p
+        session.user = "second_user"
+        r = p.create_resource("r1", "text/plain")
+        p.begin_batch()
+        session.user = "third_user"
+        r.content_data = "bla bla bla"
+        assert r.contributor == "second_user"
+        p.end_batch()
+        assert r.contributor == "third_user"
+        assert p.contributor == "third_user"
+        assert r.modified > r.created
+
 class TestTheRest(TestCase):
     pass
     # TODO
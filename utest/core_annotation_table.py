@@ -0,0 +1,134 @@
+from unittest import TestCase, main
+
+import libadvene.model.core.annotation_table as annotation_table
+from libadvene.model.cam.package import Package
+from libadvene.model.core.package import Package as CorePackage
+
+class TestAnnotationTable(TestCase):
+
+    numpy = annotation_table.numpy
+
+    def setUp(self):
+        self._numpy = annotation_table.numpy
+        annotation_table.numpy = self.numpy
+        self.p = p = Package("x-invalid-scheme:p", create=True)
+        m = self.m = p.create_media("m", "http://example.com/m")
+        t1 = self.t1 = p.create_annotation_type("t1")
+        t2 = self.t2 = p.create_annotation_type("t2")
+        for id, b, e, t in [ ("a1", 0, 10, t1),
+                             ("a2", 5, 20, t2),
+                             ("a3", 15, 18, t1),
+                             ("a4", 30, 40, t1),
+                             ("a5", 50, 55, t2), ]:
+            p.create_annotation(id, m, b, e, "text/plain", type=t)
+
+    def tearDown(self):
+        self.p.close()
+        annotation_table.numpy = self._numpy
+
+    def test_columns(self):
+        t = self.p.all.get_annotation_table()
+        self.assertEqual(5, len(t))
+        self.assertEqual([0, 5, 15, 30, 50], list(t.begins))
+        self.assertEqual([10, 20, 18, 40, 55], list(t.ends))
+        self.assertEqual(["a1", "a2", "a3", "a4", "a5"], t.ids)
+        self.assertEqual([self.t1, self.t2], t.labels)
+        self.assertEqual([0, 1, 0, 0, 1], list(t.categories))
+        self.assertEqual([10, 15, 3, 10, 5], list(t.durations()))
+        self.assertEqual(self.p.get("a3"), t.get_annotation(2))
+        self.assertEqual(list(self.p.own.annotations),
+                         list(t.iter_annotations()))
+
+    def test_filters(self):
+        t = self.p.own.get_annotation_table(type=self.t2)
+        self.assertEqual(["a2", "a5"], t.ids)
+        t = self.p.all.get_annotation_table().select(self.t1)
+        self.assertEqual(["a1", "a3", "a4"], t.ids)
+        m2 = self.p.create_media("m2", "http://example.com/m2")
+        self.p.create_annotation("b1", m2, 0, 1, "text/plain", type=self.t1)
+        t = self.p.all.get_annotation_table(media=m2)
+        self.assertEqual(["b1"], t.ids)
+
+    def test_imported(self):
+        q = Package("x-invalid-scheme:q", create=True)
+        q.create_import("p", self.p)
+        m = q.create_media("m", "http://example.com/m")
+        q.create_annotation("b1", m, 12, 13, "text/plain", type=self.t2)
+        t = q.all.get_annotation_table()
+        self.assertEqual(["a1", "a2", "b1", "a3", "a4", "a5"], t.ids)
+        self.assertEqual([self.t1, self.t2], t.labels)
+        self.assertEqual(q.get("b1"), t.get_annotation(2))
+        q.close()
+
+    def test_overlaps(self):
+        t = self.p.all.get_annotation_table()
+        self.assertEqual([1, 2], list(t.overlapping(12, 16)))
+        self.assertEqual([], list(t.overlapping(20, 30)))
+        self.assertEqual([(0, 1), (1, 2)], t.overlap_pairs())
+
+    def test_coverage_and_gaps(self):
+        t = self.p.all.get_annotation_table()
+        self.assertEqual(20 + 10 + 5, t.coverage())
+        self.assertEqual([(20, 30), (40, 50)], t.gaps())
+        self.assertEqual([(25, 30), (40, 50), (55, 60)], t.gaps(25, 60))
+        self.assertEqual(0, t.take(()).coverage())
+
+    def test_histogram(self):
+        t = self.p.all.get_annotation_table()
+        self.assertEqual([(self.t1, 3, 23), (self.t2, 2, 20)],
+                         t.histogram())
+
+    def test_core_package(self):
+        p = CorePackage("x-invalid-scheme:c", create=True)
+        m = p.create_media("m", "http://example.com/m")
+        p.create_annotation("a1", m, 0, 10, "text/plain")
+        p.create_annotation("a2", m, 5, 10, "text/plain").set_meta("k", "v")
+        t = p.own.get_annotation_table(key="k")
+        self.assertEqual(["v"], t.labels)
+        self.assertEqual([-1, 0], list(t.categories))
+        self.assertEqual([("v", 1, 5), (None, 1, 10)], t.histogram())
+        p.close()
+
+    def test_join(self):
+        t = self.p.all.get_annotation_table()
+        def brute_force(left, right, relation):
+            rel = { "before": lambda a, b: a.end <= b.begin,
+                    "meets": lambda a, b: a.end == b.begin,
+                    "overlaps": lambda a, b: a.begin <= b.end \
+                                         and a.end >= b.begin,
+                    "during": lambda a, b: b.begin <= a.begin \
+                                       and a.end <= b.end,
+                    "starts": lambda a, b: a.begin == b.begin,
+                    "finishes": lambda a, b: a.end == b.end, }[relation]
+            return sorted( (i, j)
+                           for i, a in enumerate(left.iter_annotations())
+                           for j, b in enumerate(right.iter_annotations())
+                           if rel(a, b) )
+        self.p.create_annotation("a6", self.m, 20, 30, "text/plain",
+                                 type=self.t2)
+        self.p.create_annotation("a7", self.m, 30, 35, "text/plain",
+                                 type=self.t2)
+        t = self.p.all.get_annotation_table()
+        for left, right in [ (t, t), (t.select(self.t1), t.select(self.t2)),
+                             (t.select(self.t2), t.select(self.t1)),
+                             (t, t.take(())), ]:
+            for relation in annotation_table.ALLEN_RELATIONS:
+                self.assertEqual(brute_force(left, right, relation),
+                                 sorted(left.join(right, relation)),
+                                 relation)
+        self.assertRaises(ValueError, t.join, t, "contains")
+
+    def test_group_join(self):
+        g = self.p.all
+        pairs = [ (a.id, b.id) for a, b in g.join(self.t1, [self.t2],
+                                                 "overlaps") ]
+        self.assertEqual([("a1", "a2"), ("a3", "a2")], sorted(pairs))
+        pairs = [ (a.id, b.id) for a, b in self.t1.join(self.t2, "during",
+                                                        package=self.p) ]
+        self.assertEqual([("a3", "a2")], pairs)
+
+class TestAnnotationTableWithoutNumpy(TestAnnotationTable):
+    numpy = None
+
+if __name__ == "__main__":
+    main()
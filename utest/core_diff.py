@@ -4,7 +4,8 @@ from tempfile import mkdtemp
 
 from libadvene.model.consts import DC_NS_PREFIX, PACKAGED_ROOT, \
     PARSER_META_PREFIX, RDFS_NS_PREFIX
-from libadvene.model.core.diff import diff_packages
+from libadvene.model.core.diff import diff_packages, update_fingerprints
+from libadvene.model.core.element import MEDIA
 from libadvene.model.core.package import Package
 
 dc_creator = DC_NS_PREFIX + "creator"
@@ -93,6 +94,24 @@ class TestDiffPackage(TestCase):
             self.assertNotEqual([], diff_packages(p1, p2), i)
             self.assertNotEqual([], diff_packages(p2, p1), i)
 
+    def test_fingerprints(self):
+        p1, p2 = self.p1, self.p2
+        p1.create_media("m1", "http://example.com/m1.avi")
+        def fingerprints(p):
+            return [ fp for id, fp in p._backend.iter_fingerprints(p._id,
+                                                                    MEDIA) ]
+        self.assertNotEqual([], diff_packages(p1, p2, update=False))
+        self.assertEqual([None], fingerprints(p1))
+        p1._readonly = True
+        try:
+            self.assertEqual(False, update_fingerprints(p1))
+            self.assertNotEqual([], diff_packages(p1, p2))
+            self.assertEqual([None], fingerprints(p1))
+        finally:
+            p1._readonly = False
+        self.assertEqual(True, update_fingerprints(p1))
+        self.assertNotEqual([None], fingerprints(p1))
+
 def fix_diff(diff):
     ignored_meta = frozenset([PACKAGED_ROOT])
     return [ d for d in diff
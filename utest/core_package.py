@@ -1,11 +1,14 @@
-from os import fdopen, rmdir, unlink
-from os.path import join
+from os import fdopen, listdir, rename, rmdir, unlink
+from os.path import exists, getsize, join
+from shutil import rmtree
 from tempfile import mkdtemp as mkdtemp_orig, mkstemp as mkstemp_orig
 from unittest import TestCase, main
 from urllib import pathname2url
 
-from libadvene.model.consts import DC_NS_PREFIX
+from libadvene.model.consts import DC_NS_PREFIX, PACKAGED_ROOT
 from libadvene.model.core.package import Package, NoClaimingError
+from libadvene.model.exceptions import ModelError
+import libadvene.model.backends.sqlite as sqlite_backend
 from libadvene.model.backends.sqlite import _set_module_debug
 from libadvene.model.parsers.advene_xml import ParserError, Parser as XmlParser
 from libadvene.model.parsers.advene_zip import BadZipfile, Parser as ZipParser
@@ -32,6 +35,80 @@ class TestCreation(TestCase):
         p.close()
 
 
+class TestElementCache(TestCase):
+
+    def setUp(self):
+        self.p = Package("x-invalid-scheme:xyz", create=True)
+        self.m = self.p.create_media("m", "http://example.com/m")
+        for i in xrange(5):
+            self.p.create_annotation("a%s" % i, self.m, i*10, i*10+5,
+                                     "text/plain")
+
+    def tearDown(self):
+        self.p.close()
+
+    def test_default(self):
+        self.assertEqual(0, self.p.element_cache_size)
+        self.p.get("a0")
+        self.assertEqual(0, self.p.element_cache_stats["size"])
+
+    def test_strong_refs(self):
+        p = self.p
+        p.element_cache_size = 3
+        for i in xrange(5):
+            p.get("a%s" % i)
+        stats = p.element_cache_stats
+        self.assertEqual(3, stats["size"])
+        self.assertEqual(2, stats["evictions"])
+        # a4 is kept alive by the cache, so it is not rebuilt
+        misses = stats["misses"]
+        hits = stats["hits"]
+        p.get("a4")
+        self.assertEqual(misses, p.element_cache_stats["misses"])
+        self.assertEqual(hits+1, p.element_cache_stats["hits"])
+
+    def test_delete(self):
+        p = self.p
+        p.element_cache_size = 3
+        a = p.get("a0")
+        a.delete()
+        self.assertEqual(0, p.element_cache_stats["size"])
+
+
+class TestBatch(TestCase):
+
+    def setUp(self):
+        self.p = Package("x-invalid-scheme:xyz", create=True)
+        self.m = self.p.create_media("m", "http://example.com/m")
+
+    def tearDown(self):
+        self.p.close()
+
+    def test_batch(self):
+        p, m = self.p, self.m
+        with p.batch():
+            for i in xrange(5):
+                p.create_annotation("a%s" % i, m, i*10, i*10+5, "text/plain")
+            p.get("a0").delete()
+            p.get("a1").begin = 7
+        self.assertEqual(0, p._backend._bulk)
+        self.assertEqual(["a1", "a2", "a3", "a4"],
+                         sorted(a.id for a in p.own.annotations))
+        self.assertEqual(7, p.get("a1").begin)
+
+    def test_batch_failed_modification(self):
+        p, m = self.p, self.m
+        p.create_annotation("a0", m, 0, 5, "text/plain")
+        def create_twice():
+            with p.batch():
+                p.create_annotation("b0", m, 0, 5, "text/plain")
+                p.create_annotation("a0", m, 0, 5, "text/plain")
+        self.assertRaises(ModelError, create_twice)
+        self.assertEqual(0, p._backend._bulk)
+        # only the failed modification was cancelled
+        self.assertEqual(["a0", "b0"], [ a.id for a in p.own.annotations ])
+
+
 class TestImports(TestCase):
     def setUp(self):
         self.dirname = mkdtemp()
@@ -729,6 +806,120 @@ class TestParsing(TestCase):
         self.assertRaises(ParserError, Package, self.filename, parser=XmlParser)
         self.assertRaises(BadZipfile, Package, self.filename, parser=ZipParser)
 
+class TestParseCache(TestCase):
+
+    def setUp(self):
+        self.dirname = mkdtemp()
+        self.cache_dir = join(self.dirname, "cache")
+        Package.parse_cache_dir = self.cache_dir
+        self.parse_into = XmlParser.__dict__["parse_into"]
+
+    def tearDown(self):
+        XmlParser.parse_into = self.parse_into
+        Package.parse_cache_dir = None
+        rmtree(self.dirname)
+
+    def make_file(self, extension, n):
+        filename = join(self.dirname, "p" + extension)
+        p = Package("x-invalid-scheme:p", create=True)
+        m = p.create_media("m", "http://example.com/m")
+        for i in range(n):
+            a = p.create_annotation("a%s" % i, m, i, i+10, "text/plain")
+            a.content_data = "annotation %s" % i
+        p.set_meta("key", "value")
+        p.save_as(filename, erase=True)
+        p.close()
+        return filename
+
+    def check_package(self, p, n):
+        self.assertEqual(n, len(p.own.annotations))
+        self.assertEqual("annotation 0", p.get("a0").content_data)
+        self.assertEqual(p.get("m"), p.get("a0").media)
+        self.assertEqual("value", p.get_meta("key"))
+
+    def test_reopen(self):
+        filename = self.make_file(".bxp", 3)
+        p = Package(filename)
+        self.check_package(p, 3)
+        url = p.url
+        p.close()
+        self.assertEqual(1, len(listdir(self.cache_dir)))
+
+        def fail(cls, file_, package):
+            self.fail("package parsed again")
+        XmlParser.parse_into = classmethod(fail)
+        p = Package(filename)
+        self.check_package(p, 3)
+        self.assertEqual(url, p.url)
+        p.close()
+        XmlParser.parse_into = self.parse_into
+
+        # a modified file is parsed again, and replaces the outdated entry
+        self.make_file(".bxp", 4)
+        p = Package(filename)
+        self.check_package(p, 4)
+        p.close()
+        self.assertEqual(1, len(listdir(self.cache_dir)))
+
+    def test_reopen_zip(self):
+        filename = self.make_file(".bzp", 3)
+        p = Package(filename)
+        root = p.get_meta(PACKAGED_ROOT)
+        p.close()
+        p = Package(filename)
+        self.check_package(p, 3)
+        self.assertNotEqual(root, p.get_meta(PACKAGED_ROOT))
+        self.assert_(exists(p.get_meta(PACKAGED_ROOT)))
+        self.assert_(p._packaged_archive is not None)
+        p.close()
+
+    def test_backend_version(self):
+        filename = self.make_file(".bxp", 3)
+        Package(filename).close()
+        version = sqlite_backend.BACKEND_VERSION
+        sqlite_backend.BACKEND_VERSION = version + ".1"
+        try:
+            parsed = []
+            def parse_into(cls, file_, package):
+                parsed.append(file_)
+                self.parse_into.__get__(None, cls)(file_, package)
+            XmlParser.parse_into = classmethod(parse_into)
+            p = Package(filename)
+            self.check_package(p, 3)
+            p.close()
+            self.assertEqual(1, len(parsed))
+        finally:
+            sqlite_backend.BACKEND_VERSION = version
+        # the outdated entry was replaced
+        self.assertEqual(1, len(listdir(self.cache_dir)))
+
+    def test_max_size(self):
+        filename1 = self.make_file(".bxp", 3)
+        Package(filename1).close()
+        size = getsize(join(self.cache_dir, listdir(self.cache_dir)[0]))
+        filename2 = join(self.dirname, "p2.bxp")
+        rename(filename1, filename2)
+        filename1 = self.make_file(".bxp", 3)
+        max_size = Package.parse_cache_max_size
+        Package.parse_cache_max_size = size * 3 / 2
+        try:
+            # the entry of the former p.bxp is removed
+            Package(filename2).close()
+            entry2 = listdir(self.cache_dir)
+            self.assertEqual(1, len(entry2))
+            Package(filename1).close()
+            self.assertEqual(1, len(listdir(self.cache_dir)))
+            self.assertNotEqual(entry2, listdir(self.cache_dir))
+        finally:
+            Package.parse_cache_max_size = max_size
+
+    def test_disabled(self):
+        Package.parse_cache_dir = None
+        filename = self.make_file(".bxp", 3)
+        p = Package(filename)
+        p.close()
+        self.assert_(not exists(self.cache_dir))
+
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,101 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from os import close, unlink
+from os.path import getmtime
+from tempfile import mkstemp
+from threading import Thread
+from unittest import TestCase, main
+from urllib import pathname2url
+import gc
+import os
+
+from libadvene.model.core.package import Package
+from libadvene.model.view import tal
+
+class TestCompiledTemplateCache(TestCase):
+
+    def setUp(self):
+        self.p = Package("x-invalid-scheme:p", create=True)
+        self.v = self.p.create_view("v", "text/html+tal")
+        self.v.content_data = "<p>hello</p>"
+        self.stats = dict(tal.cache_stats)
+
+    def tearDown(self):
+        self.p.close()
+
+    def count(self, key):
+        return tal.cache_stats[key] - self.stats[key]
+
+    def test_cache(self):
+        v = self.v
+        self.assertTrue("hello" in tal.apply_to(v, self.p))
+        self.assertTrue("hello" in tal.apply_to(v, self.p))
+        self.assertEqual(1, self.count("misses"))
+        self.assertEqual(1, self.count("hits"))
+        v.content_data = "<p>bye</p>"
+        self.assertEqual(1, self.count("invalidations"))
+        self.assertTrue("bye" in tal.apply_to(v, self.p))
+        self.assertEqual(2, self.count("misses"))
+
+    def test_view_not_heavy(self):
+        v = self.v
+        tal.apply_to(v, self.p)
+        self.assertFalse(v in self.p._heavy_elements)
+        self.assertTrue(v in tal._compiled)
+        n = len(tal._compiled)
+        del v
+        self.v = None
+        gc.collect()
+        self.assertEqual(n-1, len(tal._compiled))
+
+    def test_file_url(self):
+        fd, filename = mkstemp(suffix=".html")
+        close(fd)
+        try:
+            f = open(filename, "w"); f.write("<p>hello</p>"); f.close()
+            self.v.content_url = "file:" + pathname2url(filename)
+            self.assertTrue("hello" in tal.apply_to(self.v, self.p))
+            self.assertTrue("hello" in tal.apply_to(self.v, self.p))
+            self.assertEqual(1, self.count("misses"))
+            mtime = getmtime(filename)
+            f = open(filename, "w"); f.write("<p>goodbye</p>"); f.close()
+            os.utime(filename, (mtime+2, mtime+2))
+            self.assertTrue("goodbye" in tal.apply_to(self.v, self.p))
+            self.assertEqual(2, self.count("misses"))
+        finally:
+            unlink(filename)
+
+    def test_http_url(self):
+        served = []
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.headers.get("If-None-Match") == '"1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                served.append(self.path)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html")
+                self.send_header("ETag", '"1"')
+                self.end_headers()
+                self.wfile.write("<p>hello</p>")
+            def log_message(self, *args):
+                pass
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        t = Thread(target=server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        try:
+            self.v.content_url = "http://127.0.0.1:%s/v.html" \
+                                 % server.server_address[1]
+            for i in range(3):
+                self.assertTrue("hello" in tal.apply_to(self.v, self.p))
+            # the content is only sent once
+            self.assertEqual(1, len(served))
+            self.assertEqual(1, self.count("misses"))
+            self.assertEqual(2, self.count("hits"))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == "__main__":
+    main()
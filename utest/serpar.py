@@ -1,10 +1,13 @@
 """Unit test for serialization and parsing."""
 
+from cStringIO import StringIO
 from os import close, fdopen, unlink
+from os.path import exists
 from tempfile import mkstemp
 from unittest import TestCase, main
 from urllib import pathname2url
 import warnings
+import zipfile
 
 from rdflib import BNode, Graph, Literal, RDF, URIRef
 
@@ -158,6 +161,59 @@ class TestAdveneXml(TestCase):
 class TestAdveneZip(TestAdveneXml):
     serpar = zip
 
+    def test_lazy_packaged_data(self):
+        p1 = self.p1
+        r = p1.create_resource("r", "application/binary")
+        data = "\x01\x02\x03" * 100000
+        r.content_data = data
+        self.assertTrue(r.content_url.startswith("packaged:"))
+
+        f = open(self.filename2, "w")
+        self.serpar.serialize_to(p1, f)
+        f.close()
+        p2 = self.p2 = self.pkgcls(self.url)
+        path2 = p2["r"].content_packaged_path
+        self.assertFalse(exists(path2))
+        # saving again copies the data directly from the archive
+        p2.save()
+        self.assertFalse(exists(path2))
+        self.assertEqual(data, p2["r"].content_data)
+        self.assertTrue(exists(path2))
+        p2.close()
+        p2 = self.p2 = self.pkgcls(self.url)
+        self.assertEqual(data, p2["r"].content_data)
+
+    def test_large_content_xml(self):
+        # content.xml is written in the ZIP64 format, since its size is not
+        # known in advance; check it with a lower limit
+        limit = zipfile.ZIP64_LIMIT
+        zipfile.ZIP64_LIMIT = zip.ZIP64_LIMIT = 1000
+        try:
+            for i in xrange(100):
+                self.p1.create_resource("r%s" % i, "text/plain") \
+                    .content_data = "x" * 50
+            f = open(self.filename2, "w")
+            self.serpar.serialize_to(self.p1, f)
+            f.close()
+            p2 = self.p2 = self.pkgcls(self.url)
+            self.assertEqual("x" * 50, p2["r42"].content_data)
+        finally:
+            zipfile.ZIP64_LIMIT = zip.ZIP64_LIMIT = limit
+
+    def test_member_writers(self):
+        for cls in (zip._ZipMemberWriter, zip._TempFileZipMemberWriter):
+            s = StringIO()
+            z = zipfile.ZipFile(s, "w", zipfile.ZIP_DEFLATED)
+            f = cls(z, "data/a.txt", (2001, 2, 3, 4, 5, 6), 0600 << 16, False)
+            f.write("hello " * 1000)
+            f.close()
+            z.close()
+            z = zipfile.ZipFile(StringIO(s.getvalue()))
+            info = z.getinfo("data/a.txt")
+            self.assertEqual("hello " * 1000, z.read("data/a.txt"))
+            self.assertEqual((2001, 2, 3, 4, 5, 6), info.date_time)
+            self.assertEqual(0600, info.external_attr >> 16)
+
 
 class TestCinelabXml(TestAdveneXml):
     pkgcls = CamPackage
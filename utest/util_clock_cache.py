@@ -0,0 +1,47 @@
+from unittest import TestCase, main
+
+from libadvene.util.clock_cache import ClockCache
+
+class TestClockCache(TestCase):
+    def setUp(self):
+        self.c = ClockCache(3)
+
+    def test_fill(self):
+        for i in "abc":
+            self.c.touch(i, i.upper())
+        self.assertEquals(3, len(self.c))
+        self.assertEquals("B", self.c.get("b"))
+        self.assertEquals(0, self.c.evictions)
+
+    def test_evict_unreferenced(self):
+        for i in "abc":
+            self.c.touch(i, i.upper())
+        self.c.touch("a", "A") # sets the reference bit of a
+        self.c.touch("d", "D")
+        assert "a" in self.c
+        assert "b" not in self.c
+        assert "d" in self.c
+        self.assertEquals(1, self.c.evictions)
+        self.c.touch("e", "E")
+        assert "c" not in self.c
+        self.assertEquals(2, self.c.evictions)
+
+    def test_discard(self):
+        for i in "abc":
+            self.c.touch(i, i.upper())
+        self.c.discard("b")
+        assert "b" not in self.c
+        self.assertEquals(2, len(self.c))
+        self.c.touch("d", "D") # reuses the free slot
+        self.assertEquals(0, self.c.evictions)
+        self.assertEquals(set("acd"), set(k for k in "abcd" if k in self.c))
+
+    def test_clear(self):
+        for i in "abcd":
+            self.c.touch(i, i.upper())
+        self.c.clear()
+        self.assertEquals(0, len(self.c))
+        self.assertEquals(None, self.c.get("d"))
+
+if __name__ == "__main__":
+    main()